@@ -6,19 +6,34 @@ the socket event handlers are inside of socket_routes.py
 
 
 import os
-from flask import Flask, render_template, request, abort, url_for, jsonify, redirect
+from flask import Flask, Response, render_template, request, abort, url_for, jsonify, redirect, stream_with_context
 from flask import session
-from flask_session import Session
+from markupsafe import Markup
 from flask_bcrypt import Bcrypt
 from flask_socketio import SocketIO, emit
 # from flask_cors import CORS
 from datetime import timedelta
 from functools import wraps
-from sqlalchemy.orm import sessionmaker
 import db
+import archive
+import presence
+import config
+import metrics
+import socket_queue
 import secrets
-from db import engine, Session
-from models import Article, Comment, User, FriendRequest, ToDoItem
+import search
+import hashing
+import cache
+import math
+import json
+import base64
+import hashlib
+import atexit
+import session_store
+import shared_state
+from db import engine
+from models import Article, Comment, User, FriendRequest, ToDoItem, friend_table
+from sqlalchemy import or_
 from shared_state import user_sessions
 from bleach import clean # for sanitizing user input
 
@@ -31,29 +46,68 @@ from bleach import clean # for sanitizing user input
 app = Flask(__name__)
 
 # Configure Session
-app.config['SESSION_TYPE'] = 'SQLAlchemy' 
-
-# secret key used to sign the session cookie
+# sessions are kept server side with a cache in front, see session_store.py
+if config.SESSION_BACKEND == "sqlite":
+    sessions = session_store.SessionStore(
+        db.engine,
+        max_cached=config.SESSION_CACHE_SIZE,
+        cache_ttl=config.SESSION_CACHE_TTL_S,
+        write_behind=config.SESSION_FLUSH_INTERVAL_MS > 0
+    )
+    app.session_interface = session_store.ServerSideSessionInterface(sessions, config.SESSION_TOUCH_INTERVAL_S)
+    metrics.gauge("smc_sessions_cached", "Sessions held in this process's session cache.", sessions.cached)
+    session_maintainer = session_store.Maintainer(
+        sessions, config.SESSION_FLUSH_INTERVAL_MS / 1000, config.SESSION_PURGE_INTERVAL_S
+    )
+    session_maintainer.start()
+    # write the expiries still queued when the server shuts down
+    atexit.register(session_maintainer.stop)
+
+# archive old messages in the background, see archive.py. started here rather than in db.py,
+# so scripts that only import db (migrations.py, archive.py, the benchmarks) don't archive too
+if config.ARCHIVE_INTERVAL_S > 0:
+    message_archiver = archive.Compactor(db.archive_old_messages, config.ARCHIVE_INTERVAL_S)
+    message_archiver.start()
+    atexit.register(message_archiver.stop)
+
+# secret key used to sign cookies (the session cookie with SMC_SESSION_BACKEND=cookie)
 app.config['SECRET_KEY'] = secrets.token_hex()
 app.config['SESSION_COOKIE_SECURE'] = True # secure cookies only sent over HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True # cookies not accessible over javascript
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(minutes=100)
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax" # cookies sent on same-site requests
-socketio = SocketIO(app)
+socketio = SocketIO(app, async_mode=config.SERVER_ASYNC_MODE)
 # CORS(app)  # This will enable CORS for all routes
-socketio = SocketIO(app, cors_allowed_origins="*")  # Allow CORS for WebSocket connections
-
+# Allow CORS for WebSocket connections
+# with SMC_SOCKETIO_MESSAGE_QUEUE set, several server processes share clients through a message queue
+socketio = SocketIO(app, async_mode=config.SERVER_ASYNC_MODE, cors_allowed_origins="*", **socket_queue.socketio_options(config.SOCKETIO_MESSAGE_QUEUE))
 
 
+app.config["BCRYPT_LOG_ROUNDS"] = config.BCRYPT_LOG_ROUNDS
 bcrypt = Bcrypt(app)
+# logins and signups hash passwords on a bounded pool so a login storm can't take every core
+passwords = hashing.PasswordPool(bcrypt, config.HASH_WORKERS, config.HASH_MAX_QUEUE)
+
+# record route and event latency and SQL use, served at /metrics
+# this has to happen before the socket handlers are registered
+metrics.init_app(app, socketio, [db.engine, db.read_engine])
+metrics.gauge("smc_online_users", "Users with a connected socket.", lambda: len(user_sessions))
+metrics.gauge("smc_password_hashes_pending", "Password hashes running or waiting on the hashing pool.", passwords.pending)
+
+# tell other server processes sharing the registry we are alive, and drop the sockets of ones that stopped
+def friends_offline(usernames):
+    for username in usernames:
+        socketio.emit("friend_offline", {"username": username}, to=presence.friends_room(username))
+
+registry_heartbeat = shared_state.Heartbeat(user_sessions, config.SESSION_REGISTRY_HEARTBEAT_S, friends_offline)
+registry_heartbeat.start()
+atexit.register(registry_heartbeat.stop)
 
 # don't remove this!!
 import socket_routes
 
-Session(app)
-
-# session class bound to the engine
-Session = sessionmaker(bind=engine)
+# session class bound to the engine, shared with db.py
+Session = db.SessionLocal
 
 def get_role_display(role):
     role_map = {
@@ -108,34 +162,109 @@ def profile():
     user_username = session.get("username")
     if not user_username:
         return redirect(url_for('login'))
+
+    # the page only depends on the user's role, so it is cached until that changes
+    cache.sync()
+    page = cache.get("profile", user_username)
+    if page is not None:
+        return page
+    since = cache.changes()
     user = db.get_user(user_username)
     if user is None:
         return redirect(url_for('login'))
-    user_role = db.get_role(user_username)
+    user_role = user.role
 
 
-    return render_template("profile.jinja", username=user_username, role=user_role)
+    page = render_template("profile.jinja", username=user_username, role=user_role)
+    cache.put("profile", user_username, page, cache.stamp(f"user:{user_username}"), len(page), since)
+    return page
 
 
-# fetches users for admin
+def is_admin_user():
+    """
+    Whether the logged in user is an admin user, checked against the database as their role may have changed since login.
+    """
+    user = db.get_user(session.get("username")) if session.get("username") else None
+    return user is not None and user.role == 3
+
+
+# fetches users for admin, one page at a time
 @app.route("/fetch_users", methods=['GET'])
 @login_required
 def fetch_users():
     """
-    Requests user name and role data of all users from database. 
-    Returns as json
+    Lists users as {"users": [{"username", "role"}, ...], "next": cursor}, in username order.
+    Query parameters: role (only list that role, all but admin users otherwise),
+    after (the "next" cursor of the previous page) and limit.
+    The JSON is streamed as the rows are read.
     """
-    return db.fetch_users()
+    if not is_admin_user():
+        return jsonify({'message': 'Admin users only'}), 403
+    role = request.args.get("role", type=int)
+    limit = request.args.get("limit", db.USER_PAGE_SIZE, type=int)
+    if role is not None and role not in db.ROLES:
+        return jsonify({'message': 'Unknown role'}), 400
+    rows = db.iter_users(role, request.args.get("after"), limit)
+
+    def generate():
+        yield '{"users":['
+        separator = ''
+        for username, role in rows:
+            if role is None:
+                # the last pair carries the cursor of the next page
+                yield '],"next":' + json.dumps(username) + '}'
+                return
+            yield separator + json.dumps({'username': username, 'role': role})
+            separator = ','
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @app.route("/update_user_role", methods=['POST'])
+@login_required
 def update_user_role():
+    if not is_admin_user():
+        return jsonify({'message': 'Admin users only'}), 403
     data = request.json
     username = data.get("username")
     role = int(data.get("role"))
-    print(f"Updating role for {username} to {role}")
-    response = db.update_role(username, role)
-    print(db.get_role(username))
-    return response
+    if role not in db.ROLES:
+        return jsonify({'message': 'Unknown role'}), 400
+    changed, missing = db.update_roles([(username, role)])
+    if missing:
+        return jsonify({'message': 'User not found'}), 404
+    if changed:
+        cache.invalidate(f"user:{username}")
+    return jsonify({'message': 'Role updated successfully'}), 200
+
+# changes the roles of many users at once, in one transaction
+# takes {"changes": [{"username": ..., "role": ...}, ...]}
+@app.route("/update_user_roles", methods=['POST'])
+@login_required
+def update_user_roles():
+    if not is_admin_user():
+        return jsonify({'message': 'Admin users only'}), 403
+    changes = (request.json or {}).get("changes")
+    if not isinstance(changes, list) or len(changes) > db.ROLE_UPDATE_MAX:
+        return jsonify({'message': f'Expected a list of at most {db.ROLE_UPDATE_MAX} changes'}), 400
+    try:
+        pairs = [(str(change["username"]), int(change["role"])) for change in changes]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'message': 'Every change needs a username and a role'}), 400
+    if any(role not in db.ROLES for _, role in pairs):
+        return jsonify({'message': 'Unknown role'}), 400
+
+    changed, missing = db.update_roles(pairs)
+    if changed:
+        # one invalidation for the whole batch
+        cache.invalidate(*(f"user:{username}" for username in changed))
+    unchanged = len({username for username, _ in pairs}) - len(changed) - len(missing)
+    return jsonify({'updated': len(changed), 'unchanged': unchanged, 'missing': missing}), 200
+
+# sent instead of hashing when the password hashing pool is full
+def hashing_busy():
+    response = jsonify({"error": "The server is busy, please try again in a moment."})
+    response.headers["Retry-After"] = str(config.HASH_RETRY_AFTER_S)
+    return response, 503
 
 # handles a post request when the user clicks the log in button
 @app.route("/login/user", methods=["POST"])
@@ -157,7 +286,7 @@ def login_user():
         return jsonify({"error": f"User \"{username}\" does not exist."}), 404
 
     try:
-        if user and bcrypt.check_password_hash(user.password, client_hashed_password):
+        if user and passwords.check_password_hash(user.password, client_hashed_password):
             user_role = db.get_role(username)
             # if user is student and trying to log into staff not allowed
             # however if staff and trying log into student then also nono
@@ -173,7 +302,9 @@ def login_user():
 
         else:
             return jsonify({"error": "Incorrect password"}), 401
-    except:
+    except hashing.PoolSaturated:
+        return hashing_busy()
+    except ValueError:
         # happens when trying to access old user from previous versions of password hashing
         return jsonify({"error": "An error occurred when trying to log in."}), 500 
 
@@ -195,13 +326,20 @@ def signup_user():
     username = sanitize_input(request.json.get("username"))
     client_hashed_password = request.json.get("password")
     role = 0 # student defualt role
+    # the public key generated in the browser, optional, it can also be uploaded later
+    public_key = request.json.get("public_key")
+    if public_key is not None and not valid_public_key(public_key):
+        return "Error: Invalid public key!"
 
     if db.get_user(username) is None:
 
-        hashed_password = bcrypt.generate_password_hash(
-            client_hashed_password).decode('utf-8')
+        try:
+            hashed_password = passwords.generate_password_hash(
+                client_hashed_password).decode('utf-8')
+        except hashing.PoolSaturated:
+            return hashing_busy()
         
-        db.insert_user(username, hashed_password, role)
+        db.insert_user(username, hashed_password, role, public_key)
         session.clear()
         print("just cleared session !!!!!!!!!!!singup")
 
@@ -230,28 +368,36 @@ def home():
         print("line 218")
         return redirect(url_for('login'))
 
-    db_session = Session()
+    # page reads go through the read engine
+    # every query below is a projection, so the page costs the same number of queries
+    # no matter how many friends, requests or rooms the user has
+    db_session = db.ReadSession()
     try:
-        current_user = db_session.query(User).filter_by(username=current_user_username).first()
-        if current_user is None:
+        if db_session.get(User, current_user_username) is None:
             abort(404)
         
-        friends = current_user.friends[:]
-
-        incoming_friends = db_session.query(FriendRequest).filter(FriendRequest.receiver_id == current_user_username, FriendRequest.status == "pending").all()
+        friends = db_session.query(User.username, User.role) \
+            .join(friend_table, friend_table.c.friend_id == User.username) \
+            .filter(friend_table.c.user_id == current_user_username) \
+            .all()
+
+        # incoming and sent requests in one query
+        pending_requests = db_session.query(FriendRequest.id, FriendRequest.sender_id, FriendRequest.receiver_id) \
+            .filter(FriendRequest.status == "pending") \
+            .filter(or_(FriendRequest.receiver_id == current_user_username, FriendRequest.sender_id == current_user_username)) \
+            .order_by(FriendRequest.id) \
+            .all()
         incoming_requests = [
             {
                 'id': req.id,
                 'sender_username': req.sender_id
-            } for req in incoming_friends
+            } for req in pending_requests if req.receiver_id == current_user_username
         ]
-
-        sent_requests = db_session.query(FriendRequest).filter(FriendRequest.sender_id == current_user_username, FriendRequest.status == "pending").all()
         sent_requests_list = [
             {
                 'id': sent.id,
                 'receiver_username': sent.receiver_id
-            } for sent in sent_requests
+            } for sent in pending_requests if sent.sender_id == current_user_username
         ]
     
     finally:
@@ -260,7 +406,8 @@ def home():
     rooms = db.get_user_rooms(current_user_username)
 
     return render_template("home.jinja", username=current_user_username, friends=friends, 
-                           incoming_friends=incoming_requests, sent_requests=sent_requests_list, rooms=rooms)
+                           incoming_friends=incoming_requests, sent_requests=sent_requests_list, rooms=rooms,
+                           binary_messages=config.MESSAGE_BINARY_TRANSPORT)
 
 
 @app.route("/add_friend", methods=['POST'])
@@ -312,17 +459,11 @@ def add_friend():
     db_session.add(friend_request)
     db_session.commit()
     
-    # emit request event to recipient user 
-    receiver_session_id = user_sessions.get(friend_username)
-
-    if receiver_session_id:
-        socketio.emit("update_friend_requests", {'new_friend': current_user_username, 'request_id': friend_request.id}, room=receiver_session_id)
+    # emit request event to every tab of the recipient user
+    socketio.emit("update_friend_requests", {'new_friend': current_user_username, 'request_id': friend_request.id}, to=presence.user_room(friend_username))
 
     # emit sent event to sender user
-    sender_session_id = user_sessions.get(current_user_username)
-
-    if current_user_username:
-        socketio.emit("update_sent_requests", {'receiver_username': friend_username, 'request_id': friend_request.id}, room=sender_session_id)
+    socketio.emit("update_sent_requests", {'receiver_username': friend_username, 'request_id': friend_request.id}, to=presence.user_room(current_user_username))
 
     db_session.close()
     return jsonify({"success": True}), 200
@@ -362,26 +503,26 @@ def accept_friend_request():
         
         db_session.delete(friend_request)
         db_session.commit()
+        presence.add_friendship(sender.username, receiver.username)
+        # from now on each hears about the other's presence
+        socket_routes.enter_friend_rooms(sender.username, receiver.username)
 
-        # Emit update to both users
-        # find socket session ID for sender and receiver
-        sender_session_id = user_sessions.get(sender.username)
-        receiver_session_id = user_sessions.get(receiver.username)
+        # Emit update to both users, to every tab they have open
+        sender_room = presence.user_room(sender.username)
+        receiver_room = presence.user_room(receiver.username)
 
         # emit an update to sender
-        if sender_session_id:
-            socketio.emit("update_friends_list", {'new_friend': receiver.username}, room=sender_session_id)
-            socketio.emit("update_sent_requests_status", {'request_id': request_id, 'new_status': friend_request.status}, room=sender_session_id)
+        socketio.emit("update_friends_list", {'new_friend': receiver.username}, to=sender_room)
+        socketio.emit("update_sent_requests_status", {'request_id': request_id, 'new_status': friend_request.status}, to=sender_room)
         
         # emit an update to receiver
-        if receiver_session_id:
-            socketio.emit("update_friends_list", {'new_friend': sender.username}, room=receiver_session_id)
+        socketio.emit("update_friends_list", {'new_friend': sender.username}, to=receiver_room)
 
         # emit online status to new friends
-        if sender_session_id:
-            socketio.emit("friend_online", {"username": receiver.username}, room=sender_session_id)
-        if receiver_session_id:
-            socketio.emit("friend_online", {"username": sender.username}, room=receiver_session_id)
+        if receiver.username in user_sessions:
+            socketio.emit("friend_online", {"username": receiver.username}, to=sender_room)
+        if sender.username in user_sessions:
+            socketio.emit("friend_online", {"username": sender.username}, to=receiver_room)
 
         return jsonify({"success": "Friend request accepted", "newFriendUsername": sender.username}), 200
 
@@ -422,9 +563,7 @@ def reject_friend_request():
 
         # emit an update to sender
         sender = friend_request.sender
-        sender_session_id = user_sessions.get(sender.username)
-        if sender_session_id:
-            socketio.emit("update_sent_requests_status", {'request_id': request_id, 'new_status': friend_request.status}, room=sender_session_id)
+        socketio.emit("update_sent_requests_status", {'request_id': request_id, 'new_status': friend_request.status}, to=presence.user_room(sender.username))
 
         return jsonify({"success": "Friend request rejected"}), 200
 
@@ -448,11 +587,11 @@ def remove_friend():
     success, error_message = db.remove_friend(username, friend_username)
 
     if success:
+        presence.remove_friendship(username, friend_username)
+        socket_routes.leave_friend_rooms(username, friend_username)
         # emit events to update friends list
-        if username in user_sessions:
-            socketio.emit("update_friends_list", {"removed_friend": friend_username}, room=user_sessions[username])
-        if friend_username in user_sessions:
-            socketio.emit("update_friends_list", {"removed_friend": username}, room=user_sessions[friend_username])
+        socketio.emit("update_friends_list", {"removed_friend": friend_username}, to=presence.user_room(username))
+        socketio.emit("update_friends_list", {"removed_friend": username}, to=presence.user_room(friend_username))
         return jsonify({"success": "Friend removed"}), 200
     else:
         return jsonify({"error": error_message}), 404
@@ -554,16 +693,11 @@ def delete_todo():
 def logout():
     username = session.get('username')
     print(username, "IS GOING TO LOG OUT !!!! NOOOOO")
-    if username:
-        session_id = user_sessions.get(username)
-        if session_id:
-            # Emit offline event to all friends
-            active_user_friends = db.get_friends(username)
-            for friend in active_user_friends:
-                if friend.username in user_sessions:
-                    socketio.emit("friend_offline", {"username": username}, room=user_sessions[friend.username])
-            # Emit to the user's own session to clear cookies (if needed)
-            socketio.emit("logout", to=session_id)
+    if username and username in user_sessions:
+        # Emit offline event to all friends
+        socketio.emit("friend_offline", {"username": username}, to=presence.friends_room(username))
+        # Emit to every tab of the user to clear cookies (if needed)
+        socketio.emit("logout", to=presence.user_room(username))
             
 
     session.pop('username', None)  # securely remove user details
@@ -577,11 +711,94 @@ def logout():
     return '', 204 # no content to return for a beacon request    
 
 
+def page_args():
+    # ?page= and ?per_page= query parameters, clamped to sensible values
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = request.args.get('per_page', db.ARTICLES_PER_PAGE, type=int)
+    return page, min(max(per_page, 1), db.ARTICLES_PER_PAGE_MAX)
+
+def articles_json(articles, page, per_page, total):
+    for article in articles:
+        article['created_at'] = article['created_at'].strftime('%Y-%m-%d %H:%M:%S') if article['created_at'] else None
+    return jsonify({
+        'articles': articles,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': math.ceil(total / per_page),
+    })
+
+def article_fragments(article_ids):
+    """
+    The rendered article.jinja for every id, in order. Article rows and rendered
+    fragments are cached and shared by all users: a fragment only differs by
+    whether the viewer may edit and delete the article (staff, or its author).
+    """
+    since = cache.changes()
+    articles = {}
+    for article_id in article_ids:
+        article = cache.get("article", article_id)
+        if article is not None:
+            articles[article_id] = article
+    missing = [article_id for article_id in article_ids if article_id not in articles]
+    if missing:
+        for article in db.fetch_articles_by_id(missing):
+            articles[article['id']] = article
+            cache.put("article", article['id'], article, article_stamp(article),
+                      len(article['title']) + len(article['content']) + 256, since)
+
+    username, role = session.get('username'), session.get('role')
+    fragments = []
+    for article_id in article_ids:
+        article = articles.get(article_id)
+        if article is None:
+            continue
+        can_modify = role != 0 or article['author_id'] == username
+        fragment = cache.get("fragment", (article_id, can_modify))
+        if fragment is None:
+            fragment = Markup(render_template("article.jinja", article=article, can_modify=can_modify))
+            cache.put("fragment", (article_id, can_modify), fragment, article_stamp(article), len(fragment), since)
+        fragments.append(fragment)
+    return fragments
+
+def article_stamp(article):
+    # a cached article is stale once it is edited or commented on, or its author's role changes
+    return cache.stamp(f"article:{article['id']}", f"user:{article['author_id']}")
+
 @app.route("/knowledge_repository")
 @login_required
 def knowledge_repository():
-    articles = db.fetch_articles(session)  
-    return render_template("knowledge_repository.jinja", articles=articles)
+    cache.sync()
+    page, per_page = page_args()
+    query = request.args.get('q', '').strip()
+    if query:
+        article_ids, total = db.search_article_ids(query, page, per_page)
+    else:
+        listing = cache.get("listing", (page, per_page))
+        if listing is None:
+            since = cache.changes()
+            listing = db.fetch_article_page_ids(page, per_page)
+            cache.put("listing", (page, per_page), listing, cache.stamp("articles"), 8 * len(listing[0]) + 64, since)
+        article_ids, total = listing
+    return render_template("knowledge_repository.jinja", fragments=article_fragments(article_ids), query=query,
+                           page=page, pages=math.ceil(total / per_page), total=total)
+
+@app.route("/api/articles", methods=['GET'])
+@login_required
+def api_articles():
+    page, per_page = page_args()
+    articles, total = db.fetch_articles(session, page, per_page)
+    return articles_json(articles, page, per_page, total)
+
+@app.route("/api/articles/search", methods=['GET'])
+@login_required
+def api_search_articles():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query is required'}), 400
+    page, per_page = page_args()
+    articles, total = db.search_articles(session, query, page, per_page)
+    return articles_json(articles, page, per_page, total)
 
 @app.route('/post_article', methods=['POST'])
 @login_required
@@ -601,7 +818,11 @@ def post_article():
 
         new_article = Article(title=title, content=content, author=user)
         db_session.add(new_article)
+        db_session.flush()
+        # indexed in the same transaction as the article
+        search.index_article(db_session, new_article.id, title, content)
         db_session.commit()
+        cache.invalidate("articles")
         return jsonify({'message': 'Article created', 'title': title, 'content': content, 'article_id': new_article.id}), 201
     except Exception as e:
         db_session.rollback()
@@ -628,7 +849,9 @@ def edit_article():
 
         article.title = new_title
         article.content = new_content
+        search.index_article(db_session, article.id, new_title, new_content)
         db_session.commit()
+        cache.invalidate(f"article:{article.id}")
         return jsonify({'message': 'Article updated', 'article_id': article.id}), 200
     except Exception as e:
         db_session.rollback()
@@ -653,9 +876,17 @@ def post_comment():
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
+        # count the comment in the same transaction, this also checks the article exists
+        updated = db_session.query(Article).filter_by(id=article_id) \
+            .update({Article.comment_count: Article.comment_count + 1}, synchronize_session=False)
+        if not updated:
+            return jsonify({'error': 'Article not found'}), 404
+
         new_comment = Comment(content=content, article_id=article_id, author_id=user.username)
         db_session.add(new_comment)
         db_session.commit()
+        # the comment count is part of the cached article
+        cache.invalidate(f"article:{article_id}")
         return jsonify({'message': 'Comment added', 'comment_id': new_comment.id}), 201
     except Exception as e:
         db_session.rollback()
@@ -668,7 +899,7 @@ def post_comment():
 def get_comments(article_id):
     db_session = Session()
     try:
-        comments = db_session.query(Comment).filter_by(article_id=article_id).all()
+        comments = db_session.query(Comment).filter_by(article_id=article_id).order_by(Comment.id).all()
         comments_response = [
             {
                 'id': comment.id,
@@ -681,6 +912,28 @@ def get_comments(article_id):
     finally:
         db_session.close()
 
+@app.route('/api/comments', methods=['GET'])
+@login_required
+def api_comments():
+    # ?article_ids=1,2,3 returns the newest comments of every listed article in one request,
+    # ?before_id= and ?limit= page back through older comments
+    try:
+        article_ids = list(dict.fromkeys(int(i) for i in request.args.get('article_ids', '').split(',') if i.strip()))
+    except ValueError:
+        return jsonify({'error': 'article_ids must be a comma separated list of article ids'}), 400
+    if not article_ids:
+        return jsonify({'error': 'article_ids is required'}), 400
+    if len(article_ids) > db.ARTICLES_PER_PAGE_MAX:
+        return jsonify({'error': f'At most {db.ARTICLES_PER_PAGE_MAX} articles at a time'}), 400
+
+    before_id = request.args.get('before_id', type=int)
+    limit = min(max(request.args.get('limit', db.COMMENTS_PAGE_SIZE, type=int), 1), db.COMMENTS_PAGE_MAX)
+    pages = db.fetch_comments(article_ids, before_id, limit)
+    return jsonify({
+        str(article_id): {'comments': comments, 'before_id': next_before_id}
+        for article_id, (comments, next_before_id) in pages.items()
+    })
+
 @app.route('/delete_article', methods=['DELETE'])
 @login_required
 def delete_article():
@@ -699,7 +952,9 @@ def delete_article():
             return jsonify({'error': 'You do not have permission to delete this article'}), 403
 
         db_session.delete(article)
+        search.remove_article(db_session, article.id)
         db_session.commit()
+        cache.invalidate("articles", f"article:{article.id}")
         return jsonify({'message': 'Article deleted', 'article_id': article.id}), 200
     except Exception as e:
         db_session.rollback()
@@ -708,26 +963,123 @@ def delete_article():
         db_session.close()
 
 
-###########################
-# DEPRECATED - ENCRYPTION #
-###########################
+########################
+# PUBLIC KEY DIRECTORY #
+########################
+
+# largest public key accepted, an RSA-4096 key in SPKI form is about 550 bytes
+PUBLIC_KEY_MAX_BYTES = 4096
+
+def valid_public_key(public_key) -> bool:
+    """
+    Whether public_key looks like a key exported by the browser: base64 of a DER encoded SPKI structure.
+    """
+    if not isinstance(public_key, str):
+        return False
+    try:
+        key = base64.b64decode(public_key, validate=True)
+    except ValueError:
+        return False
+    return 0 < len(key) <= PUBLIC_KEY_MAX_BYTES and key[0] == 0x30
+
+def key_set_etag(keys: dict) -> str:
+    """
+    ETag of a set of keys, from the usernames and key versions so every server process agrees on it.
+    """
+    versions = "\n".join(f"{username}\x00{keys[username][1]}" for username in sorted(keys))
+    return hashlib.sha256(versions.encode("utf-8")).hexdigest()[:32]
+
+def key_response(body: bytes, etag: str):
+    """
+    A JSON response the browser may keep, but has to revalidate with its ETag (answered with a 304).
+    """
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# uploads the logged in user's public key, uploading again rotates it.
+# login_required only logs, the key routes are called from scripts and answer
+# a missing login with a JSON 401 themselves
+@app.route("/api/keys", methods=["PUT"])
+@login_required
+def upload_public_key():
+    username = session.get("username")
+    if not username:
+        return jsonify({"error": "Not logged in"}), 401
+    public_key = (request.get_json(silent=True) or {}).get("public_key")
+    if not valid_public_key(public_key):
+        return jsonify({"error": "public_key must be a base64 SPKI public key"}), 400
+
+    key_version = db.set_public_key(username, public_key)
+    if key_version is None:
+        return jsonify({"error": "User not found"}), 404
+    # cached key sets holding the old key are stale now, in every process
+    cache.invalidate(f"key:{username}")
+    return jsonify({"username": username, "key_version": key_version}), 200
+
+# one user's public key
+@app.route("/get_public_key/<username>", methods=['GET'])
+@login_required
+def get_public_key(username):
+    if not session.get("username"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    cache.sync()
+    cached = cache.get("public_key", username)
+    if cached is None:
+        since = cache.changes()
+        key = db.get_public_key(username)
+        if key is None or key[0] is None:
+            return jsonify({"error": "User not found" if key is None else "User has no public key"}), 404
+        keys = {username: key}
+        body = json.dumps({"username": username, "public_key": key[0], "key_version": key[1]}).encode("utf-8")
+        cached = (key_set_etag(keys), body)
+        cache.put("public_key", username, cached, cache.stamp(f"key:{username}"), len(body), since)
+    return key_response(cached[1], cached[0])
+
+# the public keys of every member of a room, so starting a group room takes one request
+@app.route("/api/rooms/<int:room_id>/keys", methods=['GET'])
+@login_required
+def get_room_public_keys(room_id):
+    username = session.get("username")
+    if not username:
+        return jsonify({"error": "Not logged in"}), 401
+
+    cache.sync()
+    cached = cache.get("room_keys", room_id)
+    if cached is None:
+        since = cache.changes()
+        # membership is checked in the same query, before any keys are read. a room that
+        # doesn't exist gets the same answer as one the user isn't in, so room ids can't be probed
+        keys = db.get_room_public_keys(room_id, member=username)
+        if not keys:
+            return jsonify({"error": "Not a member of this room"}), 403
+        body = json.dumps({
+            "room_id": room_id,
+            "keys": {member: {"public_key": key, "key_version": key_version}
+                     for member, (key, key_version) in keys.items()}
+        }).encode("utf-8")
+        # members never change once a room is made, so only a member rotating their key makes this stale
+        cached = (frozenset(keys), key_set_etag(keys), body)
+        cache.put("room_keys", room_id, cached, cache.stamp(*(f"key:{member}" for member in keys)),
+                  len(body), since)
+    members, etag, body = cached
+    if username not in members:
+        return jsonify({"error": "Not a member of this room"}), 403
+    return key_response(body, etag)
 
-# encryption based methods
-# @app.route("/get_public_key/<username>", methods=['GET'])
-# @login_required
-# def get_public_key(username):
-#     user = db.get_user(username)
-#     if user:
-#         return jsonify({"public_key": user.public_key}), 200
-#     else:
-#         return jsonify({"error": "User not found"}), 404
-        
 @app.after_request
 def add_security_headers(response):
-    response.headers['Cache-Control'] = 'no-store'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    # the key directory's responses are marked private and revalidated with their ETag instead
+    if not response.cache_control.private:
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
     return response
 
+# development server, see serve.py for the production server
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True, ssl_context=("mycerts/smc.test.crt", "mycerts/smc.test.key"))
\ No newline at end of file
+    ssl_context = (config.SERVER_SSL_CERT, config.SERVER_SSL_KEY) if config.SERVER_SSL else None
+    app.run(host=config.SERVER_HOST, port=config.SERVER_PORT, debug=config.SERVER_DEBUG, ssl_context=ssl_context)
\ No newline at end of file
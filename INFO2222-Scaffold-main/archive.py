@@ -0,0 +1,278 @@
+'''
+archive
+cold storage for old chat messages
+
+messages older than their room's retention policy are moved out of the
+message table (see db.archive_old_messages) so the table, and every history
+query on it, only covers the recent window. archived messages are kept per
+room in append-only segment files under SMC_ARCHIVE_DIR:
+
+    room-<id>/<first id>.seg    zlib compressed blocks of messages, appended in id order
+    room-<id>/index             one fixed size entry per block:
+                                first id, last id, segment, offset, length, count
+
+a room's archive always holds a prefix of its history (every message older
+than the oldest one still in the table), so reading older history is a walk
+back through the index. blocks are read through a memory map of their segment.
+a crash part way through an append leaves at most a torn index entry, which is
+ignored and overwritten, or dead bytes at the end of a segment that no entry
+points to
+
+run `python archive.py` to archive old messages now, or
+`python archive.py --room 3 --after-days 7` to change one room's policy
+'''
+
+import argparse
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import timezone
+from pathlib import Path
+import config
+import metrics
+
+metrics.describe("smc_messages_archived_total", "counter", "Messages moved from the message table to the archive.")
+metrics.describe("smc_archive_blocks_read_total", "counter", "Archive blocks read to serve message history.")
+
+# id, created_at (unix time, nan if unknown), then the lengths of sender, content and packed payload (-1 for none)
+RECORD = struct.Struct("<qdHIi")
+INDEX_ENTRY = struct.Struct("<qqqQII")
+
+Block = namedtuple("Block", "first_id last_id segment offset length count")
+
+# segment memory maps kept open, each holds a file descriptor
+MAX_OPEN_MAPS = 128
+
+
+def encode_block(messages) -> bytes:
+    """
+    Compresses messages (rows with id, sender_username, content, content_blob and created_at) into one block.
+    """
+    parts = []
+    for message in messages:
+        sender = message.sender_username.encode()
+        content = (message.content or "").encode()
+        blob = message.content_blob
+        created_at = message.created_at.replace(tzinfo=timezone.utc).timestamp() if message.created_at else math.nan
+        parts.append(RECORD.pack(message.id, created_at, len(sender), len(content), -1 if blob is None else len(blob)))
+        parts += [sender, content, blob or b""]
+    return zlib.compress(b"".join(parts), config.ARCHIVE_COMPRESSION_LEVEL)
+
+
+def decode_block(data: bytes) -> list:
+    """
+    Messages of a block in id order, in the same form as db.get_messages_page.
+    """
+    data = zlib.decompress(data)
+    messages = []
+    offset = 0
+    while offset < len(data):
+        message_id, _, sender_length, content_length, blob_length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        sender = data[offset:offset + sender_length].decode()
+        offset += sender_length
+        content = data[offset:offset + content_length].decode()
+        offset += content_length
+        message = {'id': message_id, 'content': content, 'sender': sender}
+        if blob_length >= 0:
+            message['payload'] = data[offset:offset + blob_length]
+            offset += blob_length
+        messages.append(message)
+    return messages
+
+
+class ArchiveStore:
+    """
+    Per-room archive segments and their indexes under one directory.
+    """
+    def __init__(self, directory: str, segment_max_bytes: int):
+        self.directory = Path(directory)
+        self.segment_max_bytes = segment_max_bytes
+        # appends are serialised, reads only take it to swap cached maps and indexes
+        # reentrant, as append reads the index while holding it
+        self._lock = threading.RLock()
+        # room id -> (index file size, blocks), reread when another process appended
+        self._indexes = {}
+        self._maps = OrderedDict()
+
+    def _room_directory(self, room_id) -> Path:
+        return self.directory / f"room-{int(room_id)}"
+
+    def _segment_path(self, room_id, segment) -> Path:
+        return self._room_directory(room_id) / f"{segment:020d}.seg"
+
+    def blocks(self, room_id) -> list:
+        """
+        The room's index, oldest block first.
+        """
+        path = self._room_directory(room_id) / "index"
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return []
+        cached = self._indexes.get(room_id)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        data = path.read_bytes()
+        # a torn entry at the end is the trace of a crash mid-append, skip it
+        whole = len(data) - len(data) % INDEX_ENTRY.size
+        blocks = [Block(*entry) for entry in INDEX_ENTRY.iter_unpack(data[:whole])]
+        with self._lock:
+            self._indexes[room_id] = (len(data), blocks)
+        return blocks
+
+    def last_id(self, room_id) -> int:
+        """
+        Id of the newest archived message of the room, 0 if none is archived.
+        """
+        blocks = self.blocks(room_id)
+        return blocks[-1].last_id if blocks else 0
+
+    def append(self, room_id, messages) -> Block:
+        """
+        Archives messages, which must be newer than everything already archived for the room.
+        Returns once the block and its index entry are on disk.
+        """
+        with self._lock:
+            blocks = self.blocks(room_id)
+            if blocks and messages[0].id <= blocks[-1].last_id:
+                raise ValueError(f"message {messages[0].id} is already archived for room {room_id}")
+            directory = self._room_directory(room_id)
+            directory.mkdir(parents=True, exist_ok=True)
+
+            # keep appending to the newest segment until it is full
+            segment = messages[0].id
+            if blocks:
+                last = blocks[-1]
+                if last.offset + last.length < self.segment_max_bytes:
+                    segment = last.segment
+
+            data = encode_block(messages)
+            with open(self._segment_path(room_id, segment), "ab") as file:
+                offset = file.seek(0, os.SEEK_END)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+
+            block = Block(messages[0].id, messages[-1].id, segment, offset, len(data), len(messages))
+            index_path = directory / "index"
+            with open(index_path, "ab") as file:
+                size = file.seek(0, os.SEEK_END)
+                if size % INDEX_ENTRY.size:
+                    file.truncate(size - size % INDEX_ENTRY.size)
+                    file.seek(0, os.SEEK_END)
+                file.write(INDEX_ENTRY.pack(*block))
+                file.flush()
+                os.fsync(file.fileno())
+            self._indexes.pop(room_id, None)
+        metrics.inc("smc_messages_archived_total", amount=len(messages))
+        return block
+
+    def _map(self, path: Path, end: int):
+        with self._lock:
+            mapped = self._maps.get(path)
+            # segments only grow, so a map too short for this block is just out of date
+            if mapped is None or len(mapped) < end:
+                with open(path, "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                # replaced maps are closed once no reader holds them any more
+                self._maps[path] = mapped
+            self._maps.move_to_end(path)
+            while len(self._maps) > MAX_OPEN_MAPS:
+                self._maps.popitem(last=False)
+            return mapped
+
+    def read_block(self, room_id, block: Block) -> list:
+        mapped = self._map(self._segment_path(room_id, block.segment), block.offset + block.length)
+        metrics.inc("smc_archive_blocks_read_total")
+        return decode_block(mapped[block.offset:block.offset + block.length])
+
+    def read_before(self, room_id, before_id, limit: int):
+        """
+        Up to `limit` archived messages older than before_id (or the newest ones if it is None),
+        oldest first. Returns (messages, more), more being whether still older ones exist.
+        """
+        blocks = self.blocks(room_id)
+        messages = []
+        position = len(blocks)
+        # walk back from the newest block that starts before the cursor
+        while position > 0 and len(messages) < limit:
+            block = blocks[position - 1]
+            if before_id is not None and block.first_id >= before_id:
+                position -= 1
+                continue
+            rows = self.read_block(room_id, block)
+            if before_id is not None:
+                rows = [row for row in rows if row['id'] < before_id]
+            messages = rows[-(limit - len(messages)):] + messages
+            position -= 1
+        messages = messages[-limit:] if limit > 0 else []
+        oldest = messages[0]['id'] if messages else before_id
+        more = bool(blocks) and (oldest is None or blocks[0].first_id < oldest)
+        return messages, more
+
+
+store = ArchiveStore(config.ARCHIVE_DIR, config.ARCHIVE_SEGMENT_MAX_BYTES)
+
+
+class Compactor(threading.Thread):
+    """
+    Runs archive_function every interval seconds. Only one process at a time
+    archives, the others skip their turn while the lock file is held.
+    """
+    def __init__(self, archive_function, interval: float):
+        super().__init__(name="message-archiver", daemon=True)
+        self.archive_function = archive_function
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                archived = run_exclusive(self.archive_function)
+                if archived:
+                    print(f"archive: moved {archived} messages to the archive")
+            except Exception as e:
+                print(f"archive: compaction failed: {e}")
+
+    def stop(self):
+        self._stopping.set()
+
+
+def run_exclusive(archive_function):
+    """
+    Calls archive_function while holding the archive's lock file, returns None if another process holds it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        # no file locks on windows, which only runs one server process anyway
+        return archive_function()
+    store.directory.mkdir(parents=True, exist_ok=True)
+    with open(store.directory / ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return archive_function()
+
+
+if __name__ == "__main__":
+    import db
+    parser = argparse.ArgumentParser(description="Move messages past their room's retention policy to the archive.")
+    parser.add_argument("--room", type=int, help="change this room's policy instead")
+    parser.add_argument("--after-days", type=int,
+                        help=f"archive the room's messages after this many days, 0 never, -1 back to the default ({config.ARCHIVE_AFTER_DAYS})")
+    args = parser.parse_args()
+    if args.room is not None:
+        if args.after_days is None:
+            parser.error("--room needs --after-days")
+        db.set_room_archive_policy(args.room, None if args.after_days < 0 else args.after_days)
+        print(f"room {args.room} policy updated")
+    else:
+        archived = run_exclusive(db.archive_old_messages)
+        print("another process is archiving" if archived is None else f"archived {archived} messages")
@@ -0,0 +1,202 @@
+'''
+backpressure
+rate limits and bounded delivery queues for chat messages
+
+without them one client sending as fast as its socket allows gets every
+message written and broadcast: each one takes a turn on the sqlite writer
+and a slot in every member's socket, and the other rooms wait behind it.
+
+every "send" (and "safe-send") now has to get past
+    a token bucket per user    SMC_SEND_USER_RATE messages a second, bursts of SMC_SEND_USER_BURST
+    a token bucket per room    SMC_SEND_ROOM_RATE messages a second, bursts of SMC_SEND_ROOM_BURST
+    the room's outbound queue  at most SMC_ROOM_QUEUE_MAX messages waiting to be delivered
+before the message is stored. what happens to a message that doesn't is the
+policy (SMC_SEND_POLICY)
+    drop    it is turned away at once and the sender told to retry later
+    slow    the sender waits for a token or a free slot, up to SMC_SEND_MAX_WAIT_MS,
+            and is only turned away after that
+either way a message is either stored and delivered or not stored at all.
+
+each room's queue is delivered by its own background task, so a flooded room
+holds one task however many messages it is sent
+'''
+
+import threading
+import time
+from collections import OrderedDict, deque
+import metrics
+
+metrics.describe("smc_messages_throttled_total", "counter",
+                 "Chat messages held back by a rate limit or a full room queue, by limit and whether they were delayed or rejected.")
+
+
+class Throttled(Exception):
+    """
+    Raised when a message is turned away, retry_after is a hint in seconds.
+    """
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f"too many messages ({limit} limit), try again in {retry_after:.1f}s")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    rate tokens a second, up to burst of them saved up. Not thread safe, RateLimiter locks around it.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def reserve(self, now: float, max_wait: float):
+        """
+        Takes a token, returning how long to wait before using it, or None if that would be longer than max_wait.
+        A token taken in advance leaves the bucket in debt until it refills.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter:
+    """
+    A token bucket per key, rate 0 turns the limit off. Only the max_keys most
+    recently used keys keep their bucket, a forgotten key starts again full.
+    """
+    def __init__(self, name: str, rate: float, burst: float, max_keys: int = 100000):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key, max_wait: float = 0) -> float:
+        """
+        Takes a token for key, returning how long to wait before sending.
+        Raises Throttled if that would be longer than max_wait.
+        """
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(key)
+            wait = bucket.reserve(now, max_wait)
+            if wait is None:
+                retry_after = (1 - bucket.tokens) / self.rate
+        if wait is None:
+            metrics.inc("smc_messages_throttled_total", (("limit", self.name), ("action", "rejected")))
+            raise Throttled(self.name, retry_after)
+        if wait:
+            metrics.inc("smc_messages_throttled_total", (("limit", self.name), ("action", "delayed")))
+        return wait
+
+    def refund(self, key):
+        """
+        Gives back a token taken with reserve, for a message that was turned away later on.
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.refund()
+
+
+class RoomOutbox:
+    """
+    Messages waiting to be emitted to each room, at most max_queued per room (0 for no limit).
+    A sender first takes a slot with acquire, then fills it with put (or gives it back with release).
+    Each room with messages waiting has one task emitting them in order.
+    """
+    def __init__(self, emit, start_task, max_queued: int):
+        self._emit = emit
+        self._start_task = start_task
+        self.max_queued = max_queued
+        # room id -> queued (event, args), and room id -> slots taken but not filled yet
+        self._queues = {}
+        self._reserved = {}
+        self._changed = threading.Condition()
+
+    def _used(self, room_id) -> int:
+        return len(self._queues.get(room_id, ())) + self._reserved.get(room_id, 0)
+
+    def queued(self) -> int:
+        """
+        Messages waiting to be emitted, over every room.
+        """
+        return sum(len(queue) for queue in list(self._queues.values()))
+
+    def acquire(self, room_id, max_wait: float = 0):
+        """
+        Takes a slot in the room's queue, waiting up to max_wait for one to free up.
+        Raises Throttled if none did.
+        """
+        with self._changed:
+            full = self.max_queued and self._used(room_id) >= self.max_queued
+            if full and not (max_wait > 0 and self._changed.wait_for(
+                    lambda: self._used(room_id) < self.max_queued, max_wait)):
+                metrics.inc("smc_messages_throttled_total", (("limit", "queue"), ("action", "rejected")))
+                # how long the room takes to deliver what is waiting isn't known, suggest a second
+                raise Throttled("queue", 1.0)
+            self._reserved[room_id] = self._reserved.get(room_id, 0) + 1
+        if full:
+            metrics.inc("smc_messages_throttled_total", (("limit", "queue"), ("action", "delayed")))
+
+    def release(self, room_id):
+        with self._changed:
+            self._give_back(room_id)
+            self._changed.notify_all()
+
+    def _give_back(self, room_id):
+        left = self._reserved[room_id] - 1
+        if left:
+            self._reserved[room_id] = left
+        else:
+            del self._reserved[room_id]
+
+    def put(self, room_id, event: str, args: tuple):
+        """
+        Queues event to be emitted to the room, filling a slot taken with acquire.
+        """
+        with self._changed:
+            self._give_back(room_id)
+            queue = self._queues.get(room_id)
+            start = queue is None
+            if start:
+                queue = self._queues[room_id] = deque()
+            queue.append((event, args))
+        if start:
+            self._start_task(self._deliver, room_id)
+
+    def _deliver(self, room_id):
+        while True:
+            with self._changed:
+                queue = self._queues[room_id]
+                if not queue:
+                    del self._queues[room_id]
+                    return
+                event, args = queue[0]
+            try:
+                self._emit(event, args, to=room_id)
+            except Exception as e:
+                print(f"backpressure: could not deliver {event} to room {room_id}: {e}")
+            with self._changed:
+                queue.popleft()
+                self._changed.notify_all()
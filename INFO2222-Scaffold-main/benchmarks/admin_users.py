@@ -0,0 +1,121 @@
+'''
+admin_users
+cost of the admin user listing and of changing many users' roles
+
+fills the database with --users users, then
+    lists every user the way /fetch_users used to (one query loading every
+    User object, one JSON array) and by paging through the streamed listing,
+    reporting the time and the peak memory the listing allocated
+    changes --changes users' roles with one /update_user_role request per
+    user and with a single /update_user_roles request, reporting the time and
+    the SQL statements run
+
+runs in process on the flask test client
+
+usage:
+    python benchmarks/admin_users.py --users 100000 --changes 5000
+'''
+
+import argparse
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+from flask import jsonify
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+import db
+from app import app
+from models import User
+
+ADMIN = "admin"
+
+
+def populate(users):
+    with Session(db.engine) as session:
+        session.execute(insert(User), [{"username": ADMIN, "password": "x", "role": 3}] +
+                        [{"username": f"user{i:07d}", "password": "x", "role": i % 3} for i in range(users)])
+        session.commit()
+
+
+def measured(function):
+    """
+    (result, seconds, peak MiB allocated) of function().
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def list_at_once():
+    # what /fetch_users did before it was paged
+    with app.test_request_context():
+        with Session(db.engine) as session:
+            users = session.query(User).filter(User.role != 3).all()
+            users_data = [{'username': user.username, 'role': user.role} for user in users]
+        return len(jsonify(users_data).get_data())
+
+
+def list_paged(client, limit):
+    size, after = 0, None
+    while True:
+        response = client.get("/fetch_users", query_string={"limit": limit, **({"after": after} if after else {})})
+        body = response.get_data()
+        size += len(body)
+        after = json.loads(body)["next"]
+        if after is None:
+            return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--changes", type=int, default=5000, help="role changes to make")
+    parser.add_argument("--page", type=int, default=db.USER_PAGE_SIZE, help="users per listing page")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    populate(args.users)
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session["username"] = ADMIN
+        flask_session["role"] = 3
+
+    results = {}
+    _, seconds, peak = measured(list_at_once)
+    results["list_at_once"] = {"seconds": seconds, "peak_mib": peak}
+    _, seconds, peak = measured(lambda: list_paged(client, args.page))
+    results["list_paged"] = {"seconds": seconds, "peak_mib": peak}
+
+    usernames = [f"user{i:07d}" for i in range(0, args.users, max(1, args.users // args.changes))][:args.changes]
+    with db.count_queries() as statements:
+        started = time.perf_counter()
+        for username in usernames:
+            client.post("/update_user_role", json={"username": username, "role": 2})
+        results["update_one_by_one"] = {"seconds": time.perf_counter() - started, "statements": len(statements)}
+    with db.count_queries() as statements:
+        started = time.perf_counter()
+        client.post("/update_user_roles", json={"changes": [{"username": u, "role": 1} for u in usernames]})
+        results["update_bulk"] = {"seconds": time.perf_counter() - started, "statements": len(statements)}
+
+    print(f"{'run':<20} {'seconds':>8} {'peak MiB':>9} {'statements':>11}")
+    for name, result in results.items():
+        print(f"{name:<20} {result['seconds']:>8.2f} {result.get('peak_mib', float('nan')):>9.1f} "
+              f"{result.get('statements', ''):>11}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
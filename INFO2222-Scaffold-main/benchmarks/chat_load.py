@@ -0,0 +1,192 @@
+'''
+chat_load
+end-to-end chat load benchmark
+
+starts the app locally against a throwaway database, signs up N simulated
+users, befriends them in groups, has each group create and join a room and
+then every user sends messages at a fixed rate. reports how long "incoming"
+takes to reach the other members of the room, delivery throughput and the
+server's memory use
+
+everything is seeded and runs offline, so it can be used as a regression
+suite: save a run with --json and compare later runs against it with --baseline
+
+usage:
+    python benchmarks/chat_load.py --users 20 --rate 5 --seconds 10
+    python benchmarks/chat_load.py --json baseline.json
+    python benchmarks/chat_load.py --baseline baseline.json --max-regression 0.25
+    python benchmarks/chat_load.py --env SMC_MESSAGE_WRITE_BEHIND=1
+'''
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import Server, SimUser, percentile
+
+
+def set_up(server, args):
+    """
+    Signs up the users, connects them and puts each group in its own room.
+    """
+    users = [SimUser(server, f"load{args.seed}_{i}") for i in range(args.users)]
+    with ThreadPoolExecutor(args.setup_threads) as pool:
+        list(pool.map(SimUser.signup, users))
+        list(pool.map(SimUser.connect, users))
+
+    groups = [users[i:i + args.room_size] for i in range(0, len(users), args.room_size)]
+    groups = [group for group in groups if len(group) > 1]
+
+    def set_up_group(group):
+        leader, others = group[0], group[1:]
+        for other in others:
+            leader.befriend(other)
+        room_id = leader.create_room(others, name=f"{leader.username}'s room")
+        for other in others:
+            other.join(room_id)
+
+    with ThreadPoolExecutor(args.setup_threads) as pool:
+        list(pool.map(set_up_group, groups))
+    return [user for group in groups for user in group]
+
+
+def run_load(users, args):
+    """
+    Every user sends args.rate messages a second for args.seconds.
+    Returns (messages sent, latencies of every delivery to another member).
+    """
+    latencies = []
+    lock = threading.Lock()
+    start = time.time()
+    measure_from = start + args.warmup
+
+    def on_incoming(receiver, message, received_at):
+        # messages arrive as "<sender>: bench|<sender>|<sent at>"
+        _, _, body = message.partition(": ")
+        parts = body.split("|")
+        if len(parts) != 3 or parts[0] != "bench" or parts[1] == receiver.username:
+            return
+        sent_at = float(parts[2])
+        if sent_at >= measure_from:
+            with lock:
+                latencies.append(received_at - sent_at)
+
+    for user in users:
+        user.on_incoming = on_incoming
+
+    sent = [0] * len(users)
+
+    def sender(index, user):
+        rng = random.Random(args.seed * 100003 + index)
+        interval = 1 / args.rate
+        # spread the users out so they don't all send in lockstep
+        next_send = start + rng.random() * interval
+        end = start + args.warmup + args.seconds
+        while next_send < end:
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sent_at = time.time()
+            user.send(f"bench|{user.username}|{sent_at:.6f}")
+            if sent_at >= measure_from:
+                sent[index] += 1
+            next_send += interval * rng.uniform(0.5, 1.5)
+
+    threads = [threading.Thread(target=sender, args=(i, user)) for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # let the last messages arrive
+    time.sleep(args.drain)
+    return sum(sent), latencies
+
+
+def compare(result, baseline, max_regression):
+    """
+    Names of the metrics that got worse than the baseline by more than max_regression.
+    """
+    regressions = []
+    for metric in ("latency_p50_ms", "latency_p95_ms", "latency_p99_ms"):
+        if result[metric] > baseline[metric] * (1 + max_regression):
+            regressions.append(f"{metric}: {baseline[metric]:.2f} -> {result[metric]:.2f}")
+    for metric in ("deliveries_per_s", "delivery_ratio"):
+        if result[metric] < baseline[metric] * (1 - max_regression):
+            regressions.append(f"{metric}: {baseline[metric]:.2f} -> {result[metric]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--room-size", type=int, default=2, help="members per room")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second sent by each user")
+    parser.add_argument("--seconds", type=float, default=10, help="length of the measured run")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--setup-threads", type=int, default=8)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. SMC_DB_PROFILE=wal")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="fraction a metric may get worse than the baseline before failing")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    # cheap password hashing, the benchmark is about chat not signup
+    env.setdefault("SMC_BCRYPT_LOG_ROUNDS", "4")
+
+    with Server(env=env) as server:
+        users = set_up(server, args)
+        idle_memory = server.memory()
+        sent, latencies = run_load(users, args)
+        loaded_memory = server.memory()
+        for user in users:
+            user.close()
+
+    expected = sent * (args.room_size - 1)
+    result = {
+        "users": len(users),
+        "room_size": args.room_size,
+        "rate_per_user": args.rate,
+        "seconds": args.seconds,
+        "env": env,
+        "messages_sent": sent,
+        "deliveries": len(latencies),
+        "delivery_ratio": len(latencies) / expected if expected else 0.0,
+        "messages_per_s": sent / args.seconds,
+        "deliveries_per_s": len(latencies) / args.seconds,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "latency_max_ms": max(latencies, default=float("nan")) * 1000,
+        "server_rss_idle_mib": idle_memory["rss_mib"],
+        "server_rss_mib": loaded_memory["rss_mib"],
+        "server_peak_rss_mib": loaded_memory["peak_rss_mib"],
+    }
+
+    for name, value in result.items():
+        print(f"{name:<22} {value:.2f}" if isinstance(value, float) else f"{name:<22} {value}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+'''
+db_profiles
+benchmark of concurrent reads and writes under each database engine profile
+
+writer threads insert chat messages one commit at a time (like the "send"
+event) while reader threads page through room history (like "join"). each
+profile is run against its own fresh database file, with and without the
+separate read-only engine
+
+usage:
+    python benchmarks/db_profiles.py --writers 4 --readers 8 --seconds 5
+'''
+
+import argparse
+import threading
+import time
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import config
+import db
+from models import Base, User, Room, Message
+
+
+def seed(engine, messages):
+    with Session(engine) as session:
+        session.execute(insert(User), [{"username": "bench", "password": "x", "role": 0}])
+        session.execute(insert(Room), [{"id": 1, "name": "bench"}])
+        session.execute(insert(Message), [
+            {"content": f"message {i}", "sender_username": "bench", "room_id": 1} for i in range(messages)
+        ])
+        session.commit()
+
+
+def worker(engine, operation, stop, latencies, errors):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            with Session(engine) as session:
+                operation(session)
+        except OperationalError:
+            # "database is locked", the busy timeout ran out
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def write_message(session):
+    session.add(Message(content="benchmark message", sender_username="bench", room_id=1))
+    session.commit()
+
+
+def read_history(session):
+    session.query(Message.id, Message.content, Message.sender_username) \
+        .filter(Message.room_id == 1) \
+        .order_by(Message.id.desc()) \
+        .limit(db.HISTORY_PAGE_SIZE) \
+        .all()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(profile_name, read_only_engine, args):
+    path = f"{profile_name}{'-ro' if read_only_engine else ''}.db"
+    profile = config.db_profile(profile_name)
+    write_engine = db.make_engine(path, profile)
+    Base.metadata.create_all(write_engine)
+    seed(write_engine, args.messages)
+    read_engine = db.make_engine(path, profile, read_only=True) if read_only_engine else write_engine
+
+    stop = threading.Event()
+    results = {"write": ([], []), "read": ([], [])}
+    threads = [
+        threading.Thread(target=worker, args=(write_engine, write_message, stop, *results["write"]))
+        for _ in range(args.writers)
+    ] + [
+        threading.Thread(target=worker, args=(read_engine, read_history, stop, *results["read"]))
+        for _ in range(args.readers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    write_engine.dispose()
+    read_engine.dispose()
+
+    name = profile_name + (" +ro" if read_only_engine else "")
+    for kind, (latencies, errors) in results.items():
+        print(
+            f"{name:<18} {kind:<6} {len(latencies) / args.seconds:>9.1f}/s"
+            f" p50 {percentile(latencies, 0.5) * 1000:>8.2f} ms"
+            f" p99 {percentile(latencies, 0.99) * 1000:>8.2f} ms"
+            f" locked {len(errors):>5}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=sorted(config.DB_PROFILES))
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--messages", type=int, default=20000, help="messages in the room before the run")
+    args = parser.parse_args()
+
+    print(f"writers={args.writers} readers={args.readers} seconds={args.seconds}")
+    for profile_name in args.profiles:
+        for read_only_engine in (False, True):
+            run(profile_name, read_only_engine, args)
+
+
+if __name__ == "__main__":
+    main()
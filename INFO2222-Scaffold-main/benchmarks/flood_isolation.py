@@ -0,0 +1,206 @@
+'''
+flood_isolation
+how much one flooding client slows down everyone else
+
+sets up --rooms quiet rooms of two users, each sending --rate messages a
+second, and measures how long their messages take to reach the other member.
+the same load runs three times on a fresh server:
+    quiet        nobody floods
+    unlimited    one more client floods its own room with --flood-rate messages
+                 a second, with the backpressure limits turned off
+    limited      the same flood with the default limits (see backpressure.py)
+and reports the quiet rooms' delivery latency along with how many of the
+flooder's messages the server accepted and turned away
+
+exits with status 1 if the limits don't keep the flood away from the quiet
+rooms: if in the limited run their p50 latency is over --max-slowdown times the
+quiet run's plus --slack-ms, or if it delivers less than --min-delivery of what
+the quiet run did
+
+needs the socket.io client, see harness.py
+
+usage:
+    python benchmarks/flood_isolation.py --rooms 4 --flood-rate 100
+    python benchmarks/flood_isolation.py --only unlimited limited --env SMC_SEND_POLICY=slow
+'''
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import socketio
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import Server, SimUser, percentile
+
+CONFIGURATIONS = {
+    "quiet": (False, {}),
+    "unlimited": (True, {"SMC_SEND_USER_RATE": "0", "SMC_SEND_ROOM_RATE": "0", "SMC_ROOM_QUEUE_MAX": "0"}),
+    "limited": (True, {}),
+}
+
+
+def set_up(server, rooms, flood):
+    """
+    Signs up, connects and pairs up the users. Returns (quiet pairs, flooding pair or None).
+    """
+    pairs = [(SimUser(server, f"quiet{i}a"), SimUser(server, f"quiet{i}b")) for i in range(rooms)]
+    if flood:
+        pairs.append((SimUser(server, "flooder"), SimUser(server, "flooded")))
+    users = [user for pair in pairs for user in pair]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(SimUser.signup, users))
+        list(pool.map(SimUser.connect, users))
+
+    def set_up_pair(pair):
+        first, second = pair
+        first.befriend(second)
+        second.join(first.create_room([second], name=f"{first.username}'s room"))
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(set_up_pair, pairs))
+    return (pairs[:-1], pairs[-1]) if flood else (pairs, None)
+
+
+def run(pairs, flooders, args):
+    """
+    Returns (latencies of the quiet rooms' deliveries, flood messages accepted, flood messages turned away).
+    """
+    latencies = []
+    lock = threading.Lock()
+    start = time.time()
+    measure_from = start + args.warmup
+    end = measure_from + args.seconds
+
+    def on_incoming(receiver, message, received_at):
+        # messages arrive as "<sender>: bench|<sent at>"
+        _, _, body = message.partition(": ")
+        parts = body.split("|")
+        if len(parts) != 2 or parts[0] != "bench" or message.startswith(receiver.username + ":"):
+            return
+        sent_at = float(parts[1])
+        if sent_at >= measure_from:
+            with lock:
+                latencies.append(received_at - sent_at)
+
+    def sender(index, user):
+        rng = random.Random(args.seed * 100003 + index)
+        interval = 1 / args.rate
+        next_send = start + rng.random() * interval
+        while next_send < end:
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            user.send(f"bench|{time.time():.6f}")
+            next_send += interval * rng.uniform(0.5, 1.5)
+
+    flood_results = {"accepted": 0, "rejected": 0}
+
+    def acknowledged(result):
+        with lock:
+            flood_results["accepted" if result and result.get("success") else "rejected"] += 1
+
+    def flooder(user):
+        interval = 1 / args.flood_rate
+        next_send = start
+        while next_send < end:
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                user.sio.emit("send", (user.username, "flood " * 20, user.room_id), callback=acknowledged)
+            except socketio.exceptions.BadNamespaceError:
+                # the server dropped the flooder, it missed too many pings
+                print("the flooder was disconnected")
+                return
+            next_send += interval
+
+    for pair in pairs:
+        for user in pair:
+            user.on_incoming = on_incoming
+    threads = [threading.Thread(target=sender, args=(i, user))
+               for i, user in enumerate(user for pair in pairs for user in pair)]
+    if flooders is not None:
+        threads.append(threading.Thread(target=flooder, args=(flooders[0],)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    time.sleep(args.drain)
+    return latencies, flood_results["accepted"], flood_results["rejected"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=4, help="quiet rooms of two users")
+    parser.add_argument("--rate", type=float, default=1, help="messages per second sent by each quiet user")
+    parser.add_argument("--flood-rate", type=float, default=100, help="messages per second sent by the flooder")
+    parser.add_argument("--seconds", type=float, default=10, help="length of the measured run")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=3, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--only", nargs="+", choices=list(CONFIGURATIONS), help="run only these configurations")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. SMC_SEND_POLICY=slow")
+    parser.add_argument("--max-slowdown", type=float, default=2,
+                        help="most the limited run's p50 latency may be, as a multiple of the quiet run's")
+    parser.add_argument("--slack-ms", type=float, default=50,
+                        help="added to that bound, so a few ms of noise on a fast run doesn't fail it")
+    parser.add_argument("--min-delivery", type=float, default=0.95,
+                        help="fewest quiet messages the limited run must deliver, as a fraction of the quiet run's")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    base_env = dict(item.split("=", 1) for item in args.env)
+    # cheap password hashing, the benchmark is about chat not signup
+    base_env.setdefault("SMC_BCRYPT_LOG_ROUNDS", "4")
+
+    results = {}
+    print(f"{'run':<10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'delivered':>10} {'flood ok/s':>11} {'flood rejected/s':>17}")
+    for name in args.only or CONFIGURATIONS:
+        flood, env = CONFIGURATIONS[name]
+        with Server(env={**base_env, **env}) as server:
+            pairs, flooders = set_up(server, args.rooms, flood)
+            latencies, accepted, rejected = run(pairs, flooders, args)
+            for pair in pairs + ([flooders] if flooders else []):
+                for user in pair:
+                    user.close()
+
+        expected = args.rooms * 2 * args.rate * args.seconds
+        result = results[name] = {
+            "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+            "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+            "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            "delivery_ratio": len(latencies) / expected,
+            "flood_accepted_per_s": accepted / (args.warmup + args.seconds),
+            "flood_rejected_per_s": rejected / (args.warmup + args.seconds),
+        }
+        print(f"{name:<10} {result['latency_p50_ms']:>8.1f} {result['latency_p95_ms']:>8.1f} "
+              f"{result['latency_p99_ms']:>8.1f} {result['delivery_ratio']:>10.2f} "
+              f"{result['flood_accepted_per_s']:>11.0f} {result['flood_rejected_per_s']:>17.0f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+    if "quiet" in results and "limited" in results:
+        allowed_ms = results["quiet"]["latency_p50_ms"] * args.max_slowdown + args.slack_ms
+        failures = []
+        if results["limited"]["latency_p50_ms"] > allowed_ms:
+            failures.append(f"limited p50 {results['limited']['latency_p50_ms']:.1f} ms is over {allowed_ms:.1f} ms")
+        least_delivered = results["quiet"]["delivery_ratio"] * args.min_delivery
+        if results["limited"]["delivery_ratio"] < least_delivered:
+            failures.append(f"limited delivered {results['limited']['delivery_ratio']:.2f}, under {least_delivered:.2f}")
+        for failure in failures:
+            print(f"NOT ISOLATED {failure}")
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+'''
+harness
+shared pieces for the end-to-end benchmarks: starts the app in its own
+process against a throwaway database, and drives it with simulated users
+that talk to it over https and socket.io exactly like the browser does
+
+needs the socket.io client on top of the app's requirements:
+    pip install "python-socketio[client]"
+'''
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+import socketio
+import urllib3
+
+# the app serves the self-signed certificate in mycerts/
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+
+def scratch_workdir() -> Path:
+    """
+    Puts the app on the import path and moves into a new scratch directory, returned.
+    db.py creates its database relative to the working directory, so a benchmark
+    calls this before importing the app to get a throwaway database.
+    """
+    if str(APP_DIR) not in sys.path:
+        sys.path.insert(0, str(APP_DIR))
+    directory = Path(tempfile.mkdtemp(prefix="smc-bench-"))
+    os.chdir(directory)
+    return directory
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Server:
+    """
+    The app running in a child process, stopped on exit of the with block.
+    """
+    def __init__(self, env: dict = None, command: list = None, startup_timeout: float = 30):
+        self.port = free_port()
+        self.url = f"https://127.0.0.1:{self.port}"
+        self.data_dir = tempfile.mkdtemp(prefix="smc-bench-")
+        self.env = dict(
+            os.environ,
+            SMC_HOST="127.0.0.1",
+            SMC_PORT=str(self.port),
+            SMC_DEBUG="0",
+            SMC_DB_PATH=str(Path(self.data_dir) / "main.db"),
+            **(env or {})
+        )
+        # the green thread servers are started through serve.py
+        entry_point = "app.py" if self.env.get("SMC_ASYNC_MODE", "threading") == "threading" else "serve.py"
+        self.command = command or [sys.executable, entry_point]
+        self.startup_timeout = startup_timeout
+        self.process = None
+
+    def __enter__(self):
+        self.log = open(Path(self.data_dir) / "server.log", "w")
+        self.process = subprocess.Popen(
+            self.command, cwd=APP_DIR, env=self.env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited early, see {self.log.name}")
+            try:
+                requests.get(self.url + "/login", verify=False, timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise RuntimeError(f"server did not start within {self.startup_timeout}s, see {self.log.name}")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+    def memory(self) -> dict:
+        """
+        Current and peak resident memory of the server process in MiB (linux only).
+        """
+        usage = {}
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    name, _, value = line.partition(":")
+                    if name in ("VmRSS", "VmHWM"):
+                        usage[name] = int(value.split()[0]) / 1024
+        except OSError:
+            pass
+        return {"rss_mib": usage.get("VmRSS"), "peak_rss_mib": usage.get("VmHWM")}
+
+
+class SimUser:
+    """
+    One simulated user with an http session and a socket.io connection.
+    """
+    def __init__(self, server: Server, username: str, password: str = "benchmark"):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.http = requests.Session()
+        self.sio = socketio.Client(ssl_verify=False, reconnection=False)
+        self.room_id = None
+
+        # filled in by socket events
+        self.friend_requests = []
+        self.friend_request_arrived = threading.Event()
+        self.on_incoming = None
+        self.sio.on("update_friend_requests", self._friend_request)
+        self.sio.on("incoming", self._incoming)
+
+    def _friend_request(self, data):
+        self.friend_requests.append(data["request_id"])
+        self.friend_request_arrived.set()
+
+    def _incoming(self, message, color=None, message_id=None):
+        if self.on_incoming is not None:
+            self.on_incoming(self, message, time.time())
+
+    def post(self, path, json, retries: int = 20):
+        # verify is passed per request, REQUESTS_CA_BUNDLE would override a session-wide setting
+        response = self.http.post(self.server.url + path, json=json, timeout=30, verify=False)
+        # a busy server answers 503 with Retry-After, back off like a browser user would
+        while response.status_code == 503 and "Retry-After" in response.headers and retries > 0:
+            time.sleep(float(response.headers["Retry-After"]))
+            retries -= 1
+            response = self.http.post(self.server.url + path, json=json, timeout=30, verify=False)
+        response.raise_for_status()
+        return response
+
+    def signup(self):
+        self.post("/signup/user", {"username": self.username, "password": self.password})
+
+    def connect(self):
+        # the socket is the logged in user's, so it carries the session cookie of the http session
+        cookies = "; ".join(f"{name}={value}" for name, value in self.http.cookies.items())
+        self.sio.connect(
+            self.server.url,
+            headers={"Cookie": cookies},
+            transports=["websocket"],
+            wait_timeout=30,
+        )
+        self.sio.emit("online", self.username)
+
+    def befriend(self, other: "SimUser", timeout: float = 30):
+        other.friend_request_arrived.clear()
+        self.post("/add_friend", {"friend_user": other.username})
+        if not other.friend_request_arrived.wait(timeout):
+            raise RuntimeError(f"{other.username} never got the friend request from {self.username}")
+        other.post("/accept_friend_request", {"request_id": other.friend_requests[-1]})
+
+    def create_room(self, others: list, name: str = "benchmark"):
+        self.room_id = self.sio.call("create", {
+            "sender": self.username, "room_name": name, "friends": [o.username for o in others]
+        }, timeout=30)
+        return self.room_id
+
+    def join(self, room_id):
+        result = self.sio.call("join", {"sender_name": self.username, "room_id": room_id}, timeout=30)
+        if not result.get("success"):
+            raise RuntimeError(f"{self.username} could not join room {room_id}: {result}")
+        self.room_id = room_id
+
+    def send(self, message: str):
+        self.sio.emit("send", (self.username, message, self.room_id))
+
+    def close(self):
+        if self.sio.connected:
+            self.sio.disconnect()
+        self.http.close()
@@ -0,0 +1,197 @@
+'''
+idle_connections
+how many idle socket.io connections one server process holds, and at what cost
+
+starts the app, opens --connections websocket connections to it (each one a
+different user, like a logged in browser tab sitting on the home page) and
+keeps them alive, answering the server's pings, for --hold seconds. reports
+how many connected and stayed connected, how long connecting took, the
+server's memory and OS thread count, and the latency of http requests and
+of new connections while all the idle ones are held
+
+the connections speak the engine.io websocket protocol directly on one
+selector thread, so the benchmark itself can hold thousands of them
+
+usage:
+    python benchmarks/idle_connections.py --connections 1000
+    python benchmarks/idle_connections.py --connections 5000 --env SMC_ASYNC_MODE=gevent
+    python benchmarks/idle_connections.py --connections 5000 --env SMC_ASYNC_MODE=eventlet
+'''
+
+import argparse
+import json
+import selectors
+import ssl
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import websocket
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import Server, percentile
+
+SSL_OPTIONS = {"cert_reqs": ssl.CERT_NONE, "check_hostname": False}
+
+
+def open_connection(server, username, timeout=60):
+    """
+    Opens a socket.io connection to the default namespace, as username.
+    Returns the websocket, or None if the server refused or timed out.
+    """
+    url = server.url.replace("https://", "wss://") + "/socket.io/?EIO=4&transport=websocket"
+    try:
+        ws = websocket.create_connection(url, timeout=timeout, sslopt=SSL_OPTIONS,
+                                         header=[f"Cookie: username={username}"])
+        # engine.io open packet, then connect to the default socket.io namespace
+        if not ws.recv().startswith("0"):
+            ws.close()
+            return None
+        ws.send("40")
+        while True:
+            packet = ws.recv()
+            if packet == "2":
+                ws.send("3")
+            elif packet.startswith("40"):
+                return ws
+            else:
+                ws.close()
+                return None
+    except (OSError, websocket.WebSocketException):
+        return None
+
+
+class KeepAlive(threading.Thread):
+    """
+    Answers the server's pings on every held connection, from one thread.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        # connections opened by other threads, registered by this one
+        self.new = []
+        self.new_lock = threading.Lock()
+        self.stopping = False
+
+    def add(self, ws):
+        with self.new_lock:
+            self.new.append(ws)
+
+    def run(self):
+        while not self.stopping:
+            with self.new_lock:
+                new, self.new = self.new, []
+            for ws in new:
+                self.selector.register(ws.sock, selectors.EVENT_READ, ws)
+            if not self.selector.get_map():
+                time.sleep(0.05)
+                continue
+            for key, _ in self.selector.select(timeout=0.1):
+                ws = key.data
+                try:
+                    packet = ws.recv()
+                    if packet == "2":
+                        ws.send("3")
+                    elif packet == "" or packet.startswith("1"):
+                        raise websocket.WebSocketConnectionClosedException()
+                except (OSError, websocket.WebSocketException):
+                    self.selector.unregister(key.fileobj)
+
+    def held(self):
+        with self.new_lock:
+            return len(self.selector.get_map()) + len(self.new)
+
+
+def server_threads(server):
+    try:
+        with open(f"/proc/{server.process.pid}/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def probe(server, samples):
+    """
+    Latency of http requests and of opening a new socket.io connection.
+    """
+    http = []
+    connects = []
+    for i in range(samples):
+        started = time.perf_counter()
+        requests.get(server.url + "/login", verify=False, timeout=60)
+        http.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        ws = open_connection(server, f"probe{i}")
+        if ws is not None:
+            connects.append(time.perf_counter() - started)
+            ws.close()
+    return http, connects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--hold", type=float, default=30,
+                        help="seconds to hold the connections, past one server ping interval (25s) by default")
+    parser.add_argument("--connect-threads", type=int, default=16)
+    parser.add_argument("--probes", type=int, default=20, help="http requests and new connections timed under load")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. SMC_ASYNC_MODE=gevent")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+
+    with Server(env=env, startup_timeout=60) as server:
+        idle_memory = server.memory()
+        idle_threads = server_threads(server)
+
+        keep_alive = KeepAlive()
+        keep_alive.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.connect_threads) as pool:
+            for ws in pool.map(lambda i: open_connection(server, f"idle{i}"), range(args.connections)):
+                if ws is not None:
+                    keep_alive.add(ws)
+        connect_seconds = time.perf_counter() - started
+        connected = keep_alive.held()
+
+        time.sleep(args.hold)
+        http, connects = probe(server, args.probes)
+        memory = server.memory()
+        threads = server_threads(server)
+        still_connected = keep_alive.held()
+        keep_alive.stopping = True
+
+    result = {
+        "env": env,
+        "connections": args.connections,
+        "connected": connected,
+        "still_connected": still_connected,
+        "connects_per_s": connected / connect_seconds,
+        "server_rss_idle_mib": idle_memory["rss_mib"],
+        "server_rss_mib": memory["rss_mib"],
+        "rss_per_connection_kib": ((memory["rss_mib"] or 0) - (idle_memory["rss_mib"] or 0)) * 1024 / max(connected, 1),
+        "server_threads_idle": idle_threads,
+        "server_threads": threads,
+        "http_p50_ms": percentile(http, 0.50) * 1000,
+        "http_p95_ms": percentile(http, 0.95) * 1000,
+        "new_connection_p50_ms": percentile(connects, 0.50) * 1000,
+        "new_connection_p95_ms": percentile(connects, 0.95) * 1000,
+    }
+    for name, value in result.items():
+        print(f"{name:<24} {value:.2f}" if isinstance(value, float) else f"{name:<24} {value}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
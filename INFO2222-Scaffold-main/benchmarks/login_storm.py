@@ -0,0 +1,127 @@
+'''
+login_storm
+login throughput and chat latency during a login storm
+
+starts the app, sets up chatting users like chat_load.py and, while they
+chat, has --storm-clients clients log in as fast as they can. reports login
+throughput, how many logins were turned away with a 503 because the password
+hashing pool was full, login latency and the "incoming" delivery latency of
+the chat traffic while the storm was on
+
+compare the bounded hashing pool against (roughly) the old inline hashing by
+giving the pool as many workers as there are storm clients:
+    python benchmarks/login_storm.py
+    python benchmarks/login_storm.py --env SMC_HASH_WORKERS=64 --env SMC_HASH_MAX_QUEUE=1000
+and against no storm at all with --storm-clients 0
+'''
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import Server, SimUser, percentile
+from chat_load import run_load, set_up
+
+
+def storm(server, accounts, clients, stop):
+    """
+    Logs the accounts in over and over from `clients` threads until stop is set.
+    Returns {status code: count} and the latency of every successful login.
+    """
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        http = requests.Session()
+        while not stop.is_set():
+            account = accounts[index % len(accounts)]
+            started = time.perf_counter()
+            try:
+                response = http.post(server.url + "/login/user", json={
+                    "username": account.username, "password": account.password, "role": "student"
+                }, timeout=60, verify=False)
+                status = response.status_code
+            except requests.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+            index += clients
+        http.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    return threads, statuses, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="chatting users")
+    parser.add_argument("--room-size", type=int, default=2, help="members per room")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second sent by each chatting user")
+    parser.add_argument("--storm-clients", type=int, default=64, help="clients logging in concurrently")
+    parser.add_argument("--accounts", type=int, default=16, help="accounts the storm logs in as")
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt log rounds (SMC_BCRYPT_LOG_ROUNDS)")
+    parser.add_argument("--seconds", type=float, default=10, help="length of the measured run")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--setup-threads", type=int, default=8)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. SMC_HASH_WORKERS=4")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    env.setdefault("SMC_BCRYPT_LOG_ROUNDS", str(args.rounds))
+
+    with Server(env=env) as server:
+        chatters = set_up(server, args)
+        accounts = [SimUser(server, f"storm{args.seed}_{i}") for i in range(args.accounts)]
+        with ThreadPoolExecutor(args.setup_threads) as pool:
+            list(pool.map(SimUser.signup, accounts))
+
+        stop = threading.Event()
+        threads, statuses, login_latencies = storm(server, accounts, args.storm_clients, stop)
+        started = time.perf_counter()
+        sent, latencies = run_load(chatters, args)
+        stop.set()
+        elapsed = time.perf_counter() - started
+        for thread in threads:
+            thread.join()
+        for user in chatters + accounts:
+            user.close()
+
+    expected = sent * (args.room_size - 1)
+    result = {
+        "storm_clients": args.storm_clients,
+        "bcrypt_rounds": int(env["SMC_BCRYPT_LOG_ROUNDS"]),
+        "env": env,
+        "login_attempts": sum(statuses.values()),
+        "logins_ok": statuses.get(200, 0),
+        "logins_rejected_503": statuses.get(503, 0),
+        "login_other_status": {k: v for k, v in statuses.items() if k not in (200, 503)},
+        "logins_per_s": statuses.get(200, 0) / elapsed,
+        "login_p50_ms": percentile(login_latencies, 0.50) * 1000,
+        "login_p95_ms": percentile(login_latencies, 0.95) * 1000,
+        "chat_delivery_ratio": len(latencies) / expected if expected else 0.0,
+        "chat_latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "chat_latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "chat_latency_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+    for name, value in result.items():
+        print(f"{name:<22} {value:.2f}" if isinstance(value, float) else f"{name:<22} {value}")
+
+
+if __name__ == "__main__":
+    main()
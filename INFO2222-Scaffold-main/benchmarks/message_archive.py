@@ -0,0 +1,138 @@
+'''
+message_archive
+history latency and storage before and after archiving old messages
+
+fills --rooms rooms with --messages messages spread evenly over the last
+--days days, then times history pages at three depths (the newest page, the
+middle of each room and its oldest messages) and measures the database. it
+then archives everything past the retention policy (archive.py), vacuums the
+database and repeats the measurements, reporting how many rows stayed in the
+table, the archive's size and compression, and how fast archiving ran
+
+usage:
+    python benchmarks/message_archive.py --rooms 50 --messages 200000 --days 365
+'''
+
+import argparse
+import json
+import os
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+# archive only when told to
+os.environ["SMC_ARCHIVE_INTERVAL_S"] = "0"
+
+from sqlalchemy import func, insert, text
+from sqlalchemy.orm import Session
+
+import archive
+import config
+import db
+from models import Message, Room, User, user_room_table
+
+
+def populate(rooms, messages, days):
+    now = datetime.now(timezone.utc)
+    with Session(db.engine) as session:
+        session.execute(insert(User), [{"username": "alice", "password": "x", "role": 0},
+                                       {"username": "bob", "password": "x", "role": 0}])
+        session.execute(insert(Room), [{"id": room_id, "name": f"room {room_id}"} for room_id in range(1, rooms + 1)])
+        session.execute(insert(user_room_table), [{"user_id": user, "room_id": room_id}
+                                                  for room_id in range(1, rooms + 1) for user in ("alice", "bob")])
+        rows = []
+        for i in range(messages):
+            rows.append({
+                "content": f"message {i}, long enough to look like a line of chat",
+                "sender_username": "alice" if i % 2 else "bob",
+                "room_id": i % rooms + 1,
+                "created_at": now - timedelta(days=days) + timedelta(days=days) * i / messages,
+            })
+            if len(rows) == 10000:
+                session.execute(insert(Message), rows)
+                rows = []
+        if rows:
+            session.execute(insert(Message), rows)
+        session.commit()
+
+
+def room_ids(rooms):
+    """
+    (newest, middle, oldest) cursors of each room, fixed before archiving so both runs read the same pages.
+    """
+    cursors = {}
+    with Session(db.engine) as session:
+        for room_id in range(1, rooms + 1):
+            ids = [row[0] for row in session.query(Message.id).filter(Message.room_id == room_id).order_by(Message.id)]
+            cursors[room_id] = (None, ids[len(ids) // 2], ids[min(db.HISTORY_PAGE_SIZE, len(ids) - 1)])
+    return cursors
+
+
+def page_latencies(cursors):
+    latencies = {"newest": [], "middle": [], "oldest": []}
+    for room_id, room_cursors in cursors.items():
+        for depth, before_id in zip(latencies, room_cursors):
+            started = time.perf_counter()
+            db.get_messages_page(room_id, before_id)
+            latencies[depth].append((time.perf_counter() - started) * 1000)
+    return {depth: statistics.median(values) for depth, values in latencies.items()}
+
+
+def hot_rows():
+    with Session(db.engine) as session:
+        return session.query(func.count(Message.id)).scalar()
+
+
+def database_mib():
+    return Path(config.DB_PATH).stat().st_size / 2**20
+
+
+def archive_mib():
+    return sum(path.stat().st_size for path in Path(config.ARCHIVE_DIR).rglob("*") if path.is_file()) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=365, help="age of the oldest message")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    populate(args.rooms, args.messages, args.days)
+    cursors = room_ids(args.rooms)
+    before = page_latencies(cursors)
+    result = {"rows_before": hot_rows(), "db_mib_before": database_mib(),
+              **{f"{depth}_page_ms_before": value for depth, value in before.items()}}
+
+    started = time.perf_counter()
+    archived = db.archive_old_messages()
+    elapsed = time.perf_counter() - started
+    with db.engine.connect() as connection:
+        connection.execute(text("VACUUM"))
+
+    # the first read of each block maps its segment, the second finds it mapped
+    cold = page_latencies(cursors)
+    after = page_latencies(cursors)
+    result.update({
+        "archived": archived,
+        "archived_per_s": archived / elapsed,
+        "rows_after": hot_rows(),
+        "db_mib_after": database_mib(),
+        "archive_mib": archive_mib(),
+        **{f"{depth}_page_ms_cold": value for depth, value in cold.items()},
+        **{f"{depth}_page_ms_after": value for depth, value in after.items()},
+    })
+    for name, value in result.items():
+        print(f"{name:<24} {value:.2f}" if isinstance(value, float) else f"{name:<24} {value}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
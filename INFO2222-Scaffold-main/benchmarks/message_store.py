@@ -0,0 +1,125 @@
+'''
+message_store
+write and read throughput of the message backends
+
+runs each configuration in a fresh process and database: --threads threads
+insert --messages messages spread over --rooms rooms through db.insert_message
+(the time includes waiting for queued or unsynced messages to reach the disk),
+then --pages history pages are read through db.get_messages_page, half of them
+the newest page of a room and half at a random point in its history
+
+the configurations are
+    sqlite            the message table, one transaction per message
+    sqlite-wal        the same on the wal engine profile
+    sqlite-batched    wal with write-behind batching (SMC_MESSAGE_WRITE_BEHIND)
+    log               the log backend (logstore.py), fsync every 50 ms
+    log-durable       the log backend, fsync on every message
+
+usage:
+    python benchmarks/message_store.py --messages 20000 --threads 4
+    python benchmarks/message_store.py --only log sqlite-batched
+'''
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+CONFIGURATIONS = {
+    "sqlite": {"SMC_MESSAGE_BACKEND": "sqlite", "SMC_DB_PROFILE": "default"},
+    "sqlite-wal": {"SMC_MESSAGE_BACKEND": "sqlite", "SMC_DB_PROFILE": "wal"},
+    "sqlite-batched": {"SMC_MESSAGE_BACKEND": "sqlite", "SMC_DB_PROFILE": "wal", "SMC_MESSAGE_WRITE_BEHIND": "1"},
+    "log": {"SMC_MESSAGE_BACKEND": "log", "SMC_MESSAGE_LOG_FSYNC_INTERVAL_MS": "50"},
+    "log-durable": {"SMC_MESSAGE_BACKEND": "log", "SMC_MESSAGE_LOG_FSYNC_INTERVAL_MS": "0"},
+}
+
+
+def worker(messages, rooms, threads, pages):
+    """
+    Runs in the child process, configured through the environment. Prints its results as json.
+    """
+    scratch_workdir()
+    import db
+
+    db.insert_user("alice", "x", 0)
+    db.insert_user("bob", "x", 0)
+    room_ids = [db.create_room(f"room {i}", ["alice", "bob"]) for i in range(rooms)]
+
+    def send(thread):
+        for i in range(thread, messages, threads):
+            db.insert_message(f"message {i}, long enough to look like a line of chat",
+                              "alice" if i % 2 else "bob", room_ids[i % rooms])
+
+    started = time.perf_counter()
+    senders = [threading.Thread(target=send, args=(thread,)) for thread in range(threads)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    # count the time until every message is on disk
+    if db.message_log is not None:
+        db.message_log.flush()
+    db.flush_messages()
+    write_seconds = time.perf_counter() - started
+
+    # every message id of each room, as the backends number them differently
+    room_message_ids = {}
+    for room_id in room_ids:
+        ids, before_id = [], None
+        while True:
+            page, before_id = db.get_messages_page(room_id, before_id, db.HISTORY_PAGE_MAX)
+            ids += [message["id"] for message in page]
+            if before_id is None:
+                break
+        room_message_ids[room_id] = ids
+
+    random.seed(1)
+    started = time.perf_counter()
+    for page in range(pages):
+        room_id = random.choice(room_ids)
+        db.get_messages_page(room_id, None if page % 2 else random.choice(room_message_ids[room_id]))
+    read_seconds = time.perf_counter() - started
+
+    print(json.dumps({"writes_per_s": messages / write_seconds, "pages_per_s": pages / read_seconds}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--only", nargs="+", choices=sorted(CONFIGURATIONS), help="run only these configurations")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.messages, args.rooms, args.threads, args.pages)
+        return
+
+    results = {}
+    print(f"{'backend':<16} {'writes/s':>10} {'pages/s':>10}")
+    for name in args.only or CONFIGURATIONS:
+        env = {**os.environ, **CONFIGURATIONS[name], "SMC_ARCHIVE_INTERVAL_S": "0"}
+        output = subprocess.run(
+            [sys.executable, __file__, "--worker", "--messages", str(args.messages), "--rooms", str(args.rooms),
+             "--threads", str(args.threads), "--pages", str(args.pages)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        result = results[name] = json.loads(output.strip().splitlines()[-1])
+        print(f"{name:<16} {result['writes_per_s']:>10.0f} {result['pages_per_s']:>10.0f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
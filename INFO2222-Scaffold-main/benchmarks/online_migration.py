@@ -0,0 +1,167 @@
+'''
+online_migration
+cost of bringing a populated database up to date while it is in use
+
+builds a database with --users users, --messages messages and five friend
+requests per user, then puts it back to how an older version left it: the
+indexes added since migration --from are dropped, message.created_at is
+cleared and user_version is set back. it then runs migrations.migrate while
+another connection inserts --write-rate messages a second, one transaction
+each, and reports how long the migration took and how long the writer's
+inserts waited meanwhile.
+the EXPLAIN QUERY PLAN check (migrations.check_query_plans) runs before and after
+
+usage:
+    python benchmarks/online_migration.py --users 20000 --messages 1000000
+'''
+
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from harness import percentile, scratch_workdir
+
+scratch_workdir()
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+import migrations
+from models import Base, FriendRequest, Message, Room, User, user_room_table
+
+# indexes added by each migration, dropped to rewind the database
+INDEXES = {
+    7: ["ix_message_room_id_id"],
+    9: ["ix_comments_article_id_id"],
+    11: ["ix_user_role_username"],
+    12: ["ix_friendrequests_receiver_id_status", "ix_friendrequests_sender_id_receiver_id",
+         "ix_user_room_room_id", "ix_todo_items_user_id"],
+}
+
+
+def populate(engine, users, messages):
+    random.seed(1)
+    rooms = users // 2
+    with Session(engine) as session:
+        session.execute(insert(User), [{"username": f"user{i}", "password": "x", "role": i % 3} for i in range(users)])
+        session.execute(insert(FriendRequest), [
+            {"sender_id": f"user{random.randrange(users)}", "receiver_id": f"user{random.randrange(users)}",
+             "status": random.choice(("pending", "accepted", "rejected"))} for _ in range(users * 5)
+        ])
+        session.execute(insert(Room), [{"id": i + 1, "name": f"room {i}"} for i in range(rooms)])
+        session.execute(insert(user_room_table), [{"user_id": f"user{(2 * i + j) % users}", "room_id": i + 1}
+                                                  for i in range(rooms) for j in (0, 1)])
+        for start in range(0, messages, 50000):
+            session.execute(insert(Message), [
+                {"content": f"message {i}, long enough to look like a line of chat",
+                 "sender_username": f"user{i % users}", "room_id": i % rooms + 1}
+                for i in range(start, min(messages, start + 50000))
+            ])
+        session.commit()
+    return rooms
+
+
+def rewind(path, version):
+    connection = sqlite3.connect(path, isolation_level=None)
+    for migration_version, names in INDEXES.items():
+        if migration_version > version:
+            for name in names:
+                connection.execute(f"DROP INDEX IF EXISTS {name}")
+    if version < 6:
+        connection.execute("UPDATE message SET created_at = NULL")
+    connection.execute(f"PRAGMA user_version = {version}")
+    connection.close()
+
+
+def writer(path, rooms, rate, stop, waits):
+    connection = sqlite3.connect(path, isolation_level=None, timeout=60)
+    next_write = time.perf_counter()
+    while not stop.is_set():
+        delay = next_write - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        next_write += 1 / rate
+        started = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        # with its time, like the app writes it, or the created_at backfill would never run out of rows
+        connection.execute("INSERT INTO message (content, sender_username, room_id, created_at) VALUES (?, ?, ?, ?)",
+                           ("written during the migration", "user0", random.randrange(rooms) + 1,
+                            datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ")))
+        connection.execute("COMMIT")
+        waits.append(time.perf_counter() - started)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--from", dest="version", type=int, default=5,
+                        help="migration version the database is rewound to")
+    parser.add_argument("--write-rate", type=float, default=200, help="messages a second written during the migration")
+    parser.add_argument("--journal-mode", default="WAL", help="journal mode of the database file")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    path = str(Path.cwd() / "main.db")
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f"PRAGMA journal_mode={args.journal_mode}")
+    Base.metadata.create_all(engine)
+    migrations.migrate(engine)
+    rooms = populate(engine, args.users, args.messages)
+    rewind(path, args.version)
+    engine.dispose()
+
+    with engine.connect() as connection:
+        before = migrations.check_query_plans(connection)
+    for name, plan in before.items():
+        print(f"before: full table scan in {name}: {'; '.join(plan)}")
+
+    stop = threading.Event()
+    waits = []
+    thread = threading.Thread(target=writer, args=(path, rooms, args.write_rate, stop, waits))
+    thread.start()
+    # let the writer get going
+    time.sleep(0.5)
+    writes_before = len(waits)
+    started = time.perf_counter()
+    applied = migrations.migrate(engine)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    thread.join()
+    during = waits[writes_before:]
+
+    # a new connection, the old one has the plans from before cached with its statements
+    engine.dispose()
+    with engine.connect() as connection:
+        after = migrations.check_query_plans(connection)
+    for name, plan in after.items():
+        print(f"after: full table scan in {name}: {'; '.join(plan)}")
+
+    result = {
+        "migrations_applied": applied,
+        "migration_seconds": elapsed,
+        "writes_during_migration": len(during),
+        "write_wait_p50_ms": percentile(during, 0.50) * 1000,
+        "write_wait_p99_ms": percentile(during, 0.99) * 1000,
+        "write_wait_max_ms": max(during, default=float("nan")) * 1000,
+        "hot_queries_scanning_before": len(before),
+        "hot_queries_scanning_after": len(after),
+    }
+    for name, value in result.items():
+        print(f"{name:<28} {value:.2f}" if isinstance(value, float) else f"{name:<28} {value}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+    sys.exit(1 if after else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+'''
+payload_size
+size and throughput of encrypted message payloads, JSON against packed binary
+
+builds the payloads the browser produces for messages of each --sizes
+plaintext length (AES-GCM ciphertext as base64, IV as a list of numbers, HMAC
+as hex, see static/js/home-encryption/everything-encryption.js) and compares
+    json    the JSON payload in a Socket.IO text frame, stored as JSON text
+    binary  the packed payload (payload.py) as a Socket.IO binary attachment,
+            stored in Message.content_blob
+reports bytes on the wire (websocket frame payloads) and at rest per message,
+how many messages per second the server can relay (parse the "safe-send"
+packet, check the payload, encode "safe-incoming"), and the size and insert
+rate of a database holding --messages of them
+
+usage:
+    python benchmarks/payload_size.py
+    python benchmarks/payload_size.py --sizes 32 512 --messages 50000
+'''
+
+import argparse
+import base64
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+from socketio import packet
+from sqlalchemy import create_engine, insert
+
+import payload
+from models import Base, Message
+
+
+def browser_payload(length):
+    """
+    The JSON payload the browser sends for a message of `length` bytes.
+    """
+    ciphertext = os.urandom(length + 16)  # AES-GCM appends a 16 byte tag
+    return {
+        "cipherText": base64.b64encode(ciphertext).decode("ascii"),
+        "iv": list(os.urandom(12)),
+        "hmac": os.urandom(32).hex(),
+    }
+
+
+def frames(data):
+    # what Packet.encode() returns: one text frame, or a text frame and its attachments
+    encoded = packet.Packet(packet.EVENT, data=data).encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def wire_bytes(data):
+    # engine.io adds a one byte packet type to text frames, binary frames go as they are
+    return sum(len(frame) if isinstance(frame, bytes) else len(frame.encode()) + 1 for frame in frames(data))
+
+
+def decode(encoded):
+    received = packet.Packet(encoded_packet=encoded[0])
+    for attachment in encoded[1:]:
+        received.add_attachment(attachment)
+    return received.data
+
+
+def relay_json(incoming):
+    username, message, room_id = decode(incoming)[1:]
+    stored = json.dumps(message)
+    return frames(["safe-incoming", username, message]), stored
+
+
+def relay_binary(incoming):
+    username, message, room_id = decode(incoming)[1:]
+    stored = payload.to_blob(message)
+    return frames(["safe-incoming", username, stored]), stored
+
+
+def relay_rate(relay, incoming, seconds):
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for encoded in incoming:
+            relay(encoded)
+        done += len(incoming)
+    return done / (time.perf_counter() - started)
+
+
+def database(rows, directory, name):
+    """
+    Inserts rows into a fresh message table. Returns (file size in bytes, rows per second).
+    """
+    path = Path(directory) / f"{name}.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine, tables=[Message.__table__])
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        for start in range(0, len(rows), 1000):
+            connection.execute(insert(Message), rows[start:start + 1000])
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+    return path.stat().st_size, len(rows) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256, 1024, 4096],
+                        help="plaintext message lengths in bytes")
+    parser.add_argument("--messages", type=int, default=20000, help="messages per database")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent measuring each relay rate")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'size':>6} {'wire json':>10} {'wire bin':>9} {'disk json':>10} {'disk bin':>9} "
+          f"{'relay json/s':>13} {'relay bin/s':>12} {'db json':>9} {'db bin':>9} {'ins json/s':>11} {'ins bin/s':>10}")
+    with tempfile.TemporaryDirectory(prefix="smc-bench-") as directory:
+        for size in args.sizes:
+            messages = [browser_payload(size) for _ in range(200)]
+            json_in = [frames(["safe-send", "alice", message, 1]) for message in messages]
+            binary_in = [frames(["safe-send", "alice", payload.pack(message), 1]) for message in messages]
+
+            sample = messages[0]
+            result = {
+                "size": size,
+                "wire_json": wire_bytes(["safe-incoming", "alice", sample]),
+                "wire_binary": wire_bytes(["safe-incoming", "alice", payload.pack(sample)]),
+                "disk_json": len(json.dumps(sample)),
+                "disk_binary": len(payload.pack(sample)),
+                "relay_json_per_s": relay_rate(relay_json, json_in, args.seconds),
+                "relay_binary_per_s": relay_rate(relay_binary, binary_in, args.seconds),
+            }
+
+            json_rows, binary_rows = [], []
+            for i in range(args.messages):
+                message = messages[i % len(messages)]
+                json_rows.append({"content": json.dumps(message), "content_blob": None,
+                                  "sender_username": "alice", "room_id": 1})
+                binary_rows.append({"content": "", "content_blob": payload.pack(message),
+                                    "sender_username": "alice", "room_id": 1})
+            result["db_json_bytes"], result["insert_json_per_s"] = database(json_rows, directory, f"json{size}")
+            result["db_binary_bytes"], result["insert_binary_per_s"] = database(binary_rows, directory, f"binary{size}")
+            results.append(result)
+
+            print(f"{size:>6} {result['wire_json']:>10} {result['wire_binary']:>9} "
+                  f"{result['disk_json']:>10} {result['disk_binary']:>9} "
+                  f"{result['relay_json_per_s']:>13.0f} {result['relay_binary_per_s']:>12.0f} "
+                  f"{result['db_json_bytes'] / 2**20:>8.1f}M {result['db_binary_bytes'] / 2**20:>8.1f}M "
+                  f"{result['insert_json_per_s']:>11.0f} {result['insert_binary_per_s']:>10.0f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
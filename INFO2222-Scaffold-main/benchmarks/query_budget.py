@@ -0,0 +1,137 @@
+'''
+query_budget
+checks the most SQL statements each page may issue
+
+every route is requested twice, once against a small dataset and once against
+one `--scale` times bigger. a route passes when it stays within its budget at
+both sizes, which also means its query count doesn't grow with the data (no N+1)
+exits with status 1 if any route is over budget
+
+usage:
+    python benchmarks/query_budget.py --scale 20
+'''
+
+import argparse
+import sys
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+from sqlalchemy import delete, insert
+from sqlalchemy.orm import Session
+
+import cache
+import db
+import search
+from app import app
+from models import (Article, Comment, FriendRequest, Room, ToDoItem, User,
+                    friend_table, user_room_table)
+
+# route -> most statements it may run
+QUERY_BUDGETS = {
+    "/profile": 1,
+    "/fetch_users": 2,
+    "/fetch_users?role=1": 2,
+    "/home": 4,
+    "/api/get-friends": 2,
+    "/todo": 2,
+    "/knowledge_repository": 3,
+    "/knowledge_repository?q=content": 3,
+    "/api/articles": 2,
+    "/api/articles/search?q=article": 3,
+    "/get_comments/1": 1,
+    "/api/comments?article_ids=1,2,3": 1,
+    "/get_public_key/user0": 1,
+    "/api/rooms/1/keys": 1,
+}
+
+ME = "budget"
+
+
+def populate(size):
+    """
+    Gives the logged in user `size` friends, pending requests, rooms (the first
+    shared with every friend), todo items and articles with comments.
+    """
+    with Session(db.engine) as session:
+        for table in (friend_table, user_room_table, Comment.__table__, Article.__table__,
+                      FriendRequest.__table__, ToDoItem.__table__, Room.__table__, User.__table__):
+            session.execute(delete(table))
+
+        others = [f"user{i}" for i in range(size * 3)]
+        # the logged in user is an admin user, so the admin listing can be measured too
+        session.execute(insert(User), [{"username": ME, "password": "x", "role": 3, "public_key": "MA==", "key_version": 1}] +
+                        [{"username": u, "password": "x", "role": i % 3, "public_key": "MA==", "key_version": 1}
+                         for i, u in enumerate(others)])
+
+        friends = others[:size]
+        session.execute(insert(friend_table), [
+            row for friend in friends for row in ({"user_id": ME, "friend_id": friend}, {"user_id": friend, "friend_id": ME})
+        ])
+        session.execute(insert(FriendRequest), [
+            {"sender_id": u, "receiver_id": ME, "status": "pending"} for u in others[size:size * 2]
+        ] + [
+            {"sender_id": ME, "receiver_id": u, "status": "pending"} for u in others[size * 2:]
+        ])
+        session.execute(insert(Room), [{"id": i + 1, "name": f"room {i}"} for i in range(size)])
+        session.execute(insert(user_room_table), [{"user_id": ME, "room_id": i + 1} for i in range(size)] +
+                        [{"user_id": friend, "room_id": 1} for friend in friends])
+        session.execute(insert(ToDoItem), [{"user_id": ME, "description": f"todo {i}"} for i in range(size)])
+        session.execute(insert(Article), [
+            {"id": i + 1, "title": f"article {i}", "content": "content", "author_id": others[i]} for i in range(size)
+        ])
+        session.execute(insert(Comment), [
+            {"content": "comment", "article_id": article, "author_id": u} for article in (1, 2, 3) for u in others[:size]
+        ])
+        session.commit()
+
+    # bulk inserts skip the routes that keep the search index in sync
+    with db.engine.begin() as connection:
+        search.rebuild_index(connection)
+    # and the routes that invalidate cached pages, so measure with a cold cache
+    cache.clear()
+
+
+def measure():
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session["username"] = ME
+        flask_session["role"] = 3
+
+    counts = {}
+    for route in QUERY_BUDGETS:
+        with db.count_queries() as statements:
+            response = client.get(route)
+            # streamed responses only run their queries as the body is read
+            response.get_data()
+            response.close()
+        if response.status_code != 200:
+            raise SystemExit(f"{route} returned {response.status_code}")
+        counts[route] = len(statements)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=5, help="rows of each kind in the small dataset")
+    parser.add_argument("--scale", type=int, default=20, help="how many times bigger the large dataset is")
+    args = parser.parse_args()
+
+    populate(args.size)
+    small = measure()
+    populate(args.size * args.scale)
+    large = measure()
+
+    failed = False
+    print(f"{'route':<34} {'budget':>6} {'small':>6} {'large':>6}")
+    for route, budget in QUERY_BUDGETS.items():
+        ok = small[route] <= budget and large[route] <= budget
+        failed = failed or not ok
+        print(f"{route:<34} {budget:>6} {small[route]:>6} {large[route]:>6}  {'ok' if ok else 'OVER BUDGET'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
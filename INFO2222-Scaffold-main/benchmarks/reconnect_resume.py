@@ -0,0 +1,87 @@
+'''
+reconnect_resume
+what a reconnect storm costs with "resume" against rejoining the room
+
+fills a room with --history messages, then --clients clients reconnect to it
+after missing --gap messages each, either by rejoining (the "join" event, which
+resends the newest page of history) or by resuming from the last message they
+have (the "resume" event, which sends only what they missed). reports the
+bytes sent to each client, the SQL statements run per reconnect and the time
+the server spent on each
+
+runs in process on the Socket.IO test client, so the times are server work only
+
+usage:
+    python benchmarks/reconnect_resume.py --clients 200 --gap 3
+'''
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+import db
+from app import app, socketio
+
+
+def reconnect(room_id, event, data):
+    """
+    (bytes received, statements, seconds) of one client reconnecting with event.
+    """
+    http = app.test_client()
+    with http.session_transaction() as flask_session:
+        flask_session["username"] = "bob"
+    client = socketio.test_client(app, flask_test_client=http, headers={"Cookie": f"room_id={room_id}"})
+    client.get_received()
+    with db.count_queries() as statements:
+        started = time.perf_counter()
+        client.emit(event, data, callback=True)
+        elapsed = time.perf_counter() - started
+    received = client.get_received()
+    client.disconnect()
+    size = sum(len(json.dumps(packet["args"])) for packet in received)
+    return size, len(statements), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--gap", type=int, default=3, help="messages each client missed while disconnected")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    db.insert_user("alice", "x", 0)
+    db.insert_user("bob", "x", 0)
+    room_id = db.create_room("storm", ["alice", "bob"])
+    for i in range(args.history):
+        db.insert_message(f"message {i}, long enough to look like a line of chat", "alice", room_id)
+    db.flush_messages()
+    newest = db.get_messages_page(room_id, None, 1)[0][0]["id"]
+    last_seen = db.get_messages_page(room_id, None, args.gap + 1)[0][0]["id"] if args.gap else newest
+
+    results = {}
+    print(f"{'reconnect':<10} {'bytes/client':>13} {'statements':>11} {'ms/client':>10}")
+    for name, event, data in (
+        ("join", "join", {"sender_name": "bob", "room_id": room_id}),
+        ("resume", "resume", {"room_id": room_id, "last_id": last_seen}),
+    ):
+        runs = [reconnect(room_id, event, data) for _ in range(args.clients)]
+        result = results[name] = {
+            "bytes_per_client": sum(run[0] for run in runs) / len(runs),
+            "statements_per_client": sum(run[1] for run in runs) / len(runs),
+            "ms_per_client": sum(run[2] for run in runs) / len(runs) * 1000,
+        }
+        print(f"{name:<10} {result['bytes_per_client']:>13.0f} {result['statements_per_client']:>11.1f} "
+              f"{result['ms_per_client']:>10.2f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+'''
+room_keys
+cost of fetching the public keys of a room's members
+
+for rooms of each --sizes members, a member fetches everyone's public key
+    per_member    one /get_public_key/<username> request per member, cold cache
+    batch_cold    one /api/rooms/<id>/keys request, cold cache
+    batch_cached  the same request again, answered from the cache
+    revalidate    the same request with the ETag of the last response, a 304
+and reports requests, response bytes, SQL statements and server time. one
+member then rotates their key to check the old ETag stops matching
+
+runs in process on the flask test client
+
+usage:
+    python benchmarks/room_keys.py --sizes 2 10 50 200
+'''
+
+import argparse
+import base64
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+os.environ.setdefault("SMC_ARCHIVE_INTERVAL_S", "0")
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+import cache
+import db
+from app import app
+from models import Room, User, user_room_table
+
+
+def random_key(rng) -> str:
+    # the size of an RSA-2048 public key in SPKI form
+    return base64.b64encode(b"\x30" + rng.randbytes(293)).decode()
+
+
+def populate(sizes, rng):
+    """
+    Creates room i + 1 with sizes[i] members. Returns the members of each room.
+    """
+    rooms = []
+    with Session(db.engine) as session:
+        for room_id, size in enumerate(sizes, start=1):
+            members = [f"room{room_id}member{i}" for i in range(size)]
+            session.execute(insert(User), [{"username": u, "password": "x", "role": 0,
+                                            "public_key": random_key(rng), "key_version": 1} for u in members])
+            session.execute(insert(Room), [{"id": room_id, "name": f"room {room_id}"}])
+            session.execute(insert(user_room_table), [{"user_id": u, "room_id": room_id} for u in members])
+            rooms.append(members)
+        session.commit()
+    return rooms
+
+
+def measured(requests):
+    """
+    (requests, response bytes, statements, seconds) of making every request in requests, a list of functions.
+    """
+    size = 0
+    with db.count_queries() as statements:
+        started = time.perf_counter()
+        for request in requests:
+            response = request()
+            if response.status_code not in (200, 304):
+                raise SystemExit(f"request failed with {response.status_code}")
+            size += len(response.get_data())
+        elapsed = time.perf_counter() - started
+    return {"requests": len(requests), "bytes": size, "statements": len(statements), "ms": elapsed * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2, 10, 50, 200], help="members of each room")
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rooms = populate(args.sizes, rng)
+
+    results = {}
+    print(f"{'members':>7} {'run':<13} {'requests':>8} {'bytes':>8} {'statements':>10} {'ms':>7}")
+    for room_id, members in enumerate(rooms, start=1):
+        client = app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session["username"] = members[0]
+            flask_session["role"] = 0
+        url = f"/api/rooms/{room_id}/keys"
+
+        cache.clear()
+        runs = {"per_member": measured([lambda u=u: client.get(f"/get_public_key/{u}") for u in members])}
+        cache.clear()
+        runs["batch_cold"] = measured([lambda: client.get(url)])
+        runs["batch_cached"] = measured([lambda: client.get(url)])
+        etag = client.get(url).headers["ETag"]
+        runs["revalidate"] = measured([lambda: client.get(url, headers={"If-None-Match": etag})])
+
+        for name, run in runs.items():
+            print(f"{len(members):>7} {name:<13} {run['requests']:>8} {run['bytes']:>8} "
+                  f"{run['statements']:>10} {run['ms']:>7.2f}")
+        results[len(members)] = runs
+
+        # rotating one member's key has to make the old ETag stale
+        rotator = app.test_client()
+        with rotator.session_transaction() as flask_session:
+            flask_session["username"] = members[-1]
+        rotator.put("/api/keys", json={"public_key": random_key(rng)})
+        if client.get(url, headers={"If-None-Match": etag}).status_code != 200:
+            raise SystemExit("the room's keys were still served as unchanged after a key rotation")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
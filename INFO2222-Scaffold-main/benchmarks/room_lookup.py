@@ -0,0 +1,91 @@
+'''
+room_lookup
+benchmark comparing the old "scan every room" lookup against the indexed
+member_key lookup used by db.find_room_with_users
+
+runs against a throwaway database in a temporary directory, main.db is never touched
+
+usage:
+    python benchmarks/room_lookup.py --rooms 5000 --lookups 50
+'''
+
+import argparse
+import random
+import time
+
+from harness import scratch_workdir
+
+scratch_workdir()
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+import db
+from models import User, Room, user_room_table
+
+
+def legacy_find_room_with_users(usernames):
+    """
+    The original implementation: load every room and compare member lists.
+    """
+    with Session(db.engine) as session:
+        sorted_usernames = sorted(usernames)
+        for room in session.query(Room).all():
+            room_usernames = sorted([user.username for user in room.users])
+            if room_usernames == sorted_usernames:
+                return room
+        return None
+
+
+def populate(num_users, num_rooms, rng):
+    usernames = [f"user{i}" for i in range(num_users)]
+    pairs = set()
+    while len(pairs) < num_rooms:
+        a, b = rng.sample(usernames, 2)
+        pairs.add(tuple(sorted((a, b))))
+    pairs = list(pairs)
+
+    with Session(db.engine) as session:
+        session.execute(insert(User), [{"username": u, "password": "x", "role": 0} for u in usernames])
+        session.execute(insert(Room), [
+            {"id": i + 1, "name": "bench", "member_key": db.room_member_key(pair)}
+            for i, pair in enumerate(pairs)
+        ])
+        session.execute(insert(user_room_table), [
+            {"user_id": username, "room_id": i + 1}
+            for i, pair in enumerate(pairs) for username in pair
+        ])
+        session.commit()
+    return pairs
+
+
+def time_lookups(find, targets):
+    start = time.perf_counter()
+    for target in targets:
+        assert find(list(target)) is not None
+    return (time.perf_counter() - start) / len(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=2222)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pairs = populate(args.users, args.rooms, rng)
+    targets = [rng.choice(pairs) for _ in range(args.lookups)]
+
+    legacy = time_lookups(legacy_find_room_with_users, targets)
+    indexed = time_lookups(db.find_room_with_users, targets)
+
+    print(f"rooms={args.rooms} users={args.users} lookups={args.lookups}")
+    print(f"legacy scan   : {legacy * 1000:10.3f} ms/lookup")
+    print(f"member_key    : {indexed * 1000:10.3f} ms/lookup")
+    print(f"speedup       : {legacy / indexed:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
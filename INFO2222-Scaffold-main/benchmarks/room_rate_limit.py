@@ -0,0 +1,106 @@
+'''
+room_rate_limit
+checks that the chat rate limits hold however the senders spread their messages
+
+runs the real "send" handler in process on socket.io test clients, as fast as
+they can send, for --seconds each:
+    room       --users members of one room each send to it. together they may
+               not get more than the room's burst plus its rate per second through
+    renamed    one user sends with a different username every message. the
+               limit is the logged in user's, so they still get no more than
+               the user's burst plus its rate per second through
+and exits with status 1 if more messages were accepted than the limit allows
+
+usage:
+    python benchmarks/room_rate_limit.py --users 20 --seconds 2
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+os.environ.setdefault("SMC_ARCHIVE_INTERVAL_S", "0")
+os.environ.setdefault("SMC_SEND_POLICY", "drop")
+# users get a lower limit than rooms, so each run is held back by the limit it checks
+os.environ.setdefault("SMC_SEND_USER_RATE", "2")
+os.environ.setdefault("SMC_SEND_USER_BURST", "4")
+os.environ.setdefault("SMC_SEND_ROOM_RATE", "5")
+os.environ.setdefault("SMC_SEND_ROOM_BURST", "10")
+
+import config
+import db
+from app import app, socketio
+
+
+def logged_in(username):
+    """
+    A socket.io test client with username logged in.
+    """
+    http = app.test_client()
+    with http.session_transaction() as flask_session:
+        flask_session["username"] = username
+        flask_session["role"] = 0
+    return socketio.test_client(app, flask_test_client=http)
+
+
+def flood(clients, room_id, seconds, renamed=False):
+    """
+    Has clients, (username, test client) pairs, take turns sending to room_id for seconds.
+    Returns (accepted, sent).
+    """
+    accepted = sent = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for username, client in clients:
+            name = f"someone{sent}" if renamed else username
+            result = client.emit("send", name, f"message {sent}", room_id, callback=True)
+            sent += 1
+            accepted += bool(result and result.get("success"))
+    return accepted, sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="members of the flooded room")
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    usernames = [f"user{i}" for i in range(args.users)]
+    for username in usernames:
+        db.insert_user(username, "x", 0)
+    room_id = db.create_room("flooded", usernames)
+    lone_room_id = db.create_room("renamed", [usernames[0]])
+
+    runs = {
+        "room": ([(username, logged_in(username)) for username in usernames], room_id, False,
+                 config.SEND_ROOM_BURST + config.SEND_ROOM_RATE * args.seconds),
+        "renamed": ([(usernames[0], logged_in(usernames[0]))], lone_room_id, True,
+                    config.SEND_USER_BURST + config.SEND_USER_RATE * args.seconds),
+    }
+    results = {}
+    failed = False
+    print(f"{'run':<8} {'sent':>8} {'accepted':>9} {'allowed':>8}")
+    for name, (clients, target, renamed, allowed) in runs.items():
+        accepted, sent = flood(clients, target, args.seconds, renamed)
+        # a token or two may refill while the last messages are sent
+        over = accepted > allowed + 2
+        failed |= over
+        results[name] = {"sent": sent, "accepted": accepted, "allowed": allowed}
+        print(f"{name:<8} {sent:>8} {accepted:>9} {allowed:>8.0f}  {'OVER THE LIMIT' if over else 'ok'}")
+        for _, client in clients:
+            client.disconnect()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
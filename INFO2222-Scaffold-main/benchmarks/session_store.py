@@ -0,0 +1,119 @@
+'''
+session_store
+per-request cost of each way of keeping flask sessions
+
+logs in --users users, then makes --requests requests to a route that only
+reads the session, picking a user at random each time, under
+    none       no session at all, the baseline the others are measured against
+    cookie     flask's signed cookie, which is what ran before session_store.py
+               (flask_session.Session was shadowed by db.Session in app.py, so
+               the SQLAlchemy session type it was given never took effect)
+    database   the session table read and written on every request, the way a
+               server side store without a cache or coalescing works
+    cached     session_store.py as configured by default
+and reports the session's share of each request and the SQL statements it ran
+
+runs in process on the flask test client
+
+usage:
+    python benchmarks/session_store.py --users 200 --requests 2000
+    SMC_DB_PROFILE=wal python benchmarks/session_store.py
+'''
+
+import argparse
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+from harness import scratch_workdir
+
+scratch_workdir()
+os.environ.setdefault("SMC_ARCHIVE_INTERVAL_S", "0")
+
+from flask import session
+from flask.sessions import SecureCookieSessionInterface, SessionInterface
+
+import config
+import db
+import session_store
+from app import app
+
+
+class NoSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        return self.make_null_session(app)
+
+    def save_session(self, app, session, response):
+        pass
+
+
+def interfaces():
+    """
+    Name -> (session interface, its SessionStore or None) of every configuration.
+    """
+    uncached = session_store.SessionStore(db.engine, max_cached=0, cache_ttl=0, write_behind=False)
+    cached = session_store.SessionStore(db.engine, config.SESSION_CACHE_SIZE, config.SESSION_CACHE_TTL_S)
+    return {
+        "none": (NoSessionInterface(), None),
+        "cookie": (SecureCookieSessionInterface(), None),
+        "database": (session_store.ServerSideSessionInterface(uncached, touch_interval=0), uncached),
+        "cached": (session_store.ServerSideSessionInterface(cached, config.SESSION_TOUCH_INTERVAL_S), cached),
+    }
+
+
+@app.route("/bench/session")
+def bench_session():
+    return session.get("username", "")
+
+
+def run(interface, store, users, requests, seed):
+    app.session_interface = interface
+    clients = [app.test_client() for _ in range(users)]
+    if store is not None:
+        for i, client in enumerate(clients):
+            with client.session_transaction() as flask_session:
+                flask_session.permanent = True
+                flask_session["username"] = f"user{i}"
+                flask_session["role"] = 0
+    rng = random.Random(seed)
+    order = [rng.randrange(users) for _ in range(requests)]
+
+    with db.count_queries() as statements:
+        started = time.perf_counter()
+        for i in order:
+            clients[i].get("/bench/session")
+        if store is not None:
+            store.flush()
+        elapsed = time.perf_counter() - started
+    return elapsed / requests, len(statements) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="logged in users, each with their own session")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'run':<10} {'us/request':>11} {'session us':>11} {'statements':>11}")
+    for name, (interface, store) in interfaces().items():
+        per_request, statements = run(interface, store, args.users, args.requests, args.seed)
+        baseline = results["none"]["us_per_request"] if results else per_request * 1e6
+        result = results[name] = {
+            "us_per_request": per_request * 1e6,
+            "session_us_per_request": per_request * 1e6 - baseline,
+            "statements_per_request": statements,
+        }
+        print(f"{name:<10} {result['us_per_request']:>11.0f} {result['session_us_per_request']:>11.0f} "
+              f"{result['statements_per_request']:>11.2f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+'''
+cache
+bounded LRU cache for rendered page fragments and query results
+
+entries are stamped with the versions of the data they were built from.
+a route that changes some data calls invalidate() with its version names:
+    "articles"          which articles exist (post_article, delete_article)
+    "article:<id>"      one article's title, content or comment count
+    "user:<username>"   one user's role (update_user_role, update_user_roles)
+    "key:<username>"    one user's public key (upload_public_key)
+get() only returns an entry if every version it was stamped with is unchanged,
+so a change makes exactly the entries built from that data stale, and the LRU
+eventually evicts them
+
+with several server processes each has its own cache. every invalidate() also
+bumps a generation counter in the shared session registry, and a process that
+sees another one bumped it drops its whole cache
+'''
+
+import threading
+from collections import OrderedDict
+import config
+import metrics
+from shared_state import user_sessions
+
+metrics.describe("smc_cache_requests_total", "counter", "Fragment cache lookups, by kind and result.")
+
+GENERATION = "cache"
+
+
+class LRUCache:
+    """
+    Least recently used cache holding at most max_bytes of values
+    (by the size given to set()).
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = LRUCache(config.CACHE_MAX_BYTES)
+# version name -> counter, bumped by invalidate()
+_versions = {}
+_versions_lock = threading.Lock()
+# registry generation this process's cache is up to date with
+_generation = 0
+# bumped by every invalidate(), see put()
+_changes = 0
+
+metrics.gauge("smc_cache_bytes", "Bytes held by the fragment cache.", lambda: _cache.size)
+metrics.gauge("smc_cache_entries", "Entries in the fragment cache.", lambda: len(_cache))
+
+
+def version(name: str) -> int:
+    return _versions.get(name, 0)
+
+
+def sync():
+    """
+    Drops the cache if another server process changed cached data. Call once per request.
+    """
+    global _generation
+    if not config.CACHE_ENABLED:
+        return
+    generation = user_sessions.get_generation(GENERATION)
+    if generation != _generation:
+        _cache.clear()
+        _generation = generation
+
+
+def invalidate(*names: str):
+    """
+    Makes every entry built from the named data stale. Call after the change is committed.
+    """
+    global _generation, _changes
+    with _versions_lock:
+        _changes += 1
+        for name in names:
+            _versions[name] = _versions.get(name, 0) + 1
+        # same as presence: if no other process bumped the generation since we
+        # last synced, our cache is still accurate and doesn't need dropping
+        generation = user_sessions.get_generation(GENERATION)
+        user_sessions.bump_generation(GENERATION)
+        if generation == _generation:
+            _generation = generation + 1
+
+
+def get(kind: str, key):
+    """
+    The cached value for key, or None if there is none or the data it was built from changed.
+    """
+    if not config.CACHE_ENABLED:
+        return None
+    entry = _cache.get((kind, key))
+    if entry is not None:
+        stamp, value = entry
+        if all(version(name) == number for name, number in stamp):
+            metrics.inc("smc_cache_requests_total", (("kind", kind), ("result", "hit")))
+            return value
+    metrics.inc("smc_cache_requests_total", (("kind", kind), ("result", "miss")))
+    return None
+
+
+def stamp(*names: str) -> tuple:
+    """
+    The current versions of the named data.
+    """
+    return tuple((name, version(name)) for name in names)
+
+
+def changes() -> int:
+    """
+    Take this before reading data to cache and pass it to put().
+    """
+    return _changes
+
+
+def put(kind: str, key, value, stamp: tuple, size: int, since: int):
+    """
+    Caches value, valid while the versions in stamp are unchanged. Nothing is
+    cached if anything was invalidated since `since`, as value may have been
+    read before the change while stamp was taken after it.
+    """
+    if config.CACHE_ENABLED and since == _changes:
+        _cache.set((kind, key), (stamp, value), size)
+
+
+def clear():
+    _cache.clear()
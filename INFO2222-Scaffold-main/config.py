@@ -0,0 +1,226 @@
+'''
+config
+runtime settings for the server
+every setting can be overridden with an environment variable, so a deployment
+can be tuned without touching the code
+'''
+
+import os
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return default if value is None else int(value)
+
+def env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+# where chat messages are stored
+#   sqlite  the message table (the default)
+#   log     append-only log segments per room, see logstore.py (single process only)
+MESSAGE_BACKEND = env_str("SMC_MESSAGE_BACKEND", "sqlite")
+if MESSAGE_BACKEND not in ("sqlite", "log"):
+    raise ValueError(f"unknown SMC_MESSAGE_BACKEND {MESSAGE_BACKEND!r}")
+MESSAGE_LOG_DIR = env_str("SMC_MESSAGE_LOG_DIR", "database/messages")
+# size at which a room starts a new log segment
+MESSAGE_LOG_SEGMENT_MAX_BYTES = env_int("SMC_MESSAGE_LOG_SEGMENT_MAX_BYTES", 64 * 1024 * 1024)
+# one sparse index entry every this many messages
+MESSAGE_LOG_INDEX_INTERVAL = env_int("SMC_MESSAGE_LOG_INDEX_INTERVAL", 64)
+# how often appended messages are fsynced, 0 fsyncs every message
+# this is also how much a power cut can lose
+MESSAGE_LOG_FSYNC_INTERVAL_MS = env_int("SMC_MESSAGE_LOG_FSYNC_INTERVAL_MS", 50)
+
+# write-behind message persistence, see message_writer.py
+# when enabled, "send" only queues the message and a background thread commits
+# queued messages in batches, one transaction per batch instead of per message
+# (sqlite backend only, the log backend already batches its fsyncs)
+MESSAGE_WRITE_BEHIND = env_bool("SMC_MESSAGE_WRITE_BEHIND", False)
+# most messages written in one transaction
+MESSAGE_BATCH_SIZE = env_int("SMC_MESSAGE_BATCH_SIZE", 100)
+# longest a queued message waits before its batch is committed
+MESSAGE_FLUSH_INTERVAL_MS = env_int("SMC_MESSAGE_FLUSH_INTERVAL_MS", 50)
+# most messages waiting to be committed, senders block once it is reached
+# this is also the most messages that can be lost if the process crashes
+MESSAGE_MAX_PENDING = env_int("SMC_MESSAGE_MAX_PENDING", 10000)
+# how long shutdown waits for queued messages to be committed
+MESSAGE_SHUTDOWN_TIMEOUT_S = env_int("SMC_MESSAGE_SHUTDOWN_TIMEOUT_S", 10)
+# message retention, see archive.py
+# messages older than this are moved out of the message table into compressed
+# archive segments, rooms can override it (archive.py --room), 0 never archives
+ARCHIVE_AFTER_DAYS = env_int("SMC_ARCHIVE_AFTER_DAYS", 30)
+# the newest messages of each room stay in the table whatever their age
+ARCHIVE_KEEP_RECENT = env_int("SMC_ARCHIVE_KEEP_RECENT", 200)
+# how often the server archives old messages, 0 leaves it to `python archive.py`
+ARCHIVE_INTERVAL_S = env_int("SMC_ARCHIVE_INTERVAL_S", 3600)
+ARCHIVE_DIR = env_str("SMC_ARCHIVE_DIR", "database/archive")
+# messages per compressed block, and the size at which a new segment file is started
+ARCHIVE_BLOCK_MESSAGES = env_int("SMC_ARCHIVE_BLOCK_MESSAGES", 256)
+ARCHIVE_SEGMENT_MAX_BYTES = env_int("SMC_ARCHIVE_SEGMENT_MAX_BYTES", 8 * 1024 * 1024)
+ARCHIVE_COMPRESSION_LEVEL = env_int("SMC_ARCHIVE_COMPRESSION_LEVEL", 6)
+# most missed messages sent to a reconnecting client, one that missed more
+# gets the newest page of history instead (see the "resume" event)
+RESUME_MAX_MESSAGES = env_int("SMC_RESUME_MAX_MESSAGES", 200)
+# backpressure on "send" and "safe-send", see backpressure.py
+# messages a second each user and each room may send on average, and how many
+# may be sent in a burst, a rate of 0 turns that limit off
+SEND_USER_RATE = env_int("SMC_SEND_USER_RATE", 10)
+SEND_USER_BURST = env_int("SMC_SEND_USER_BURST", 20)
+SEND_ROOM_RATE = env_int("SMC_SEND_ROOM_RATE", 50)
+SEND_ROOM_BURST = env_int("SMC_SEND_ROOM_BURST", 100)
+# most messages waiting to be delivered to a room, 0 for no limit
+ROOM_QUEUE_MAX = env_int("SMC_ROOM_QUEUE_MAX", 100)
+# what happens to a message over a limit
+#   drop  turned away at once, the sender is told to retry
+#   slow  the sender waits up to SMC_SEND_MAX_WAIT_MS for the limit, then it is turned away
+SEND_POLICY = env_str("SMC_SEND_POLICY", "drop")
+if SEND_POLICY not in ("drop", "slow"):
+    raise ValueError(f"unknown SMC_SEND_POLICY {SEND_POLICY!r}")
+SEND_MAX_WAIT_MS = env_int("SMC_SEND_MAX_WAIT_MS", 2000)
+# send encrypted message payloads to clients as packed bytes (Socket.IO binary
+# attachments) instead of base64 JSON, see payload.py
+MESSAGE_BINARY_TRANSPORT = env_bool("SMC_BINARY_MESSAGES", False)
+
+# database engine, see db.make_engine
+DB_PATH = env_str("SMC_DB_PATH", "database/main.db")
+
+# named engine profiles, pick one with SMC_DB_PROFILE
+# None leaves sqlite's own default in place
+DB_PROFILES = {
+    # sqlite defaults: rollback journal, readers and the writer block each other
+    "default": {
+        "journal_mode": None,
+        "synchronous": None,
+        "busy_timeout_ms": None,
+        "pool_size": 5,
+        "max_overflow": 10,
+    },
+    # write-ahead log: readers never block the writer or each other,
+    # commits only fsync at checkpoints (safe against app crashes, not power loss)
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout_ms": 5000,
+        "pool_size": 10,
+        "max_overflow": 20,
+    },
+    # write-ahead log with an fsync on every commit
+    "wal-durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout_ms": 5000,
+        "pool_size": 10,
+        "max_overflow": 20,
+    },
+}
+DB_PROFILE = env_str("SMC_DB_PROFILE", "default")
+
+# per-setting overrides on top of the chosen profile
+DB_JOURNAL_MODE = os.environ.get("SMC_DB_JOURNAL_MODE")
+DB_SYNCHRONOUS = os.environ.get("SMC_DB_SYNCHRONOUS")
+DB_BUSY_TIMEOUT_MS = os.environ.get("SMC_DB_BUSY_TIMEOUT_MS")
+DB_POOL_SIZE = os.environ.get("SMC_DB_POOL_SIZE")
+DB_MAX_OVERFLOW = os.environ.get("SMC_DB_MAX_OVERFLOW")
+
+# separate read-only engine for heavy read paths (home page, article listing)
+# so page reads get their own connection pool and can never take a write lock
+DB_READ_ENGINE = env_bool("SMC_DB_READ_ENGINE", False)
+DB_READ_POOL_SIZE = env_int("SMC_DB_READ_POOL_SIZE", 10)
+
+def db_profile(name: str = None) -> dict:
+    """
+    Settings of an engine profile (the chosen one by default) with any overrides applied.
+    """
+    name = name or DB_PROFILE
+    if name not in DB_PROFILES:
+        raise ValueError(f"unknown database profile {name!r}, expected one of {sorted(DB_PROFILES)}")
+    profile = dict(DB_PROFILES[name])
+    overrides = {
+        "journal_mode": DB_JOURNAL_MODE,
+        "synchronous": DB_SYNCHRONOUS,
+        "busy_timeout_ms": DB_BUSY_TIMEOUT_MS and int(DB_BUSY_TIMEOUT_MS),
+        "pool_size": DB_POOL_SIZE and int(DB_POOL_SIZE),
+        "max_overflow": DB_MAX_OVERFLOW and int(DB_MAX_OVERFLOW),
+    }
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    return profile
+
+# scaling out to several server processes
+# where the username -> socket session id registry lives, see shared_state.py
+#   memory                  a dict in this process (single process only)
+#   sqlite:///path/file.db  a file shared by every process on this machine
+#   redis://host:port/db    a redis server shared by every process
+SESSION_REGISTRY_URL = env_str("SMC_SESSION_REGISTRY", "memory")
+# how often each process tells the shared registry it is alive, and how long after its
+# last heartbeat a process counts as stopped and the sockets it owned are dropped
+SESSION_REGISTRY_HEARTBEAT_S = env_int("SMC_SESSION_REGISTRY_HEARTBEAT_S", 10)
+SESSION_REGISTRY_EXPIRY_S = env_int("SMC_SESSION_REGISTRY_EXPIRY_S", 60)
+# message queue that lets a process emit to clients connected to another process, see socket_queue.py
+#   empty                   no queue (single process only)
+#   sqlite:///path/file.db  a file based queue for every process on this machine
+#   redis://, amqp://, kafka://, zmq+tcp://  any backend python-socketio supports
+SOCKETIO_MESSAGE_QUEUE = env_str("SMC_SOCKETIO_MESSAGE_QUEUE", "")
+# how often the sqlite message queue checks for new messages
+SOCKETIO_QUEUE_POLL_MS = env_int("SMC_SOCKETIO_QUEUE_POLL_MS", 10)
+# how often each process asks the registry whose friends another process changed, see presence.py
+PRESENCE_SYNC_INTERVAL_MS = env_int("SMC_PRESENCE_SYNC_INTERVAL_MS", 1000)
+
+# development server started by "python app.py"
+SERVER_HOST = env_str("SMC_HOST", "0.0.0.0")
+SERVER_PORT = env_int("SMC_PORT", 5000)
+SERVER_DEBUG = env_bool("SMC_DEBUG", True)
+# concurrency model of the server: "threading" (one thread per connection, the
+# default), or "eventlet" / "gevent" (green threads, run with serve.py)
+SERVER_ASYNC_MODE = env_str("SMC_ASYNC_MODE", "threading")
+if SERVER_ASYNC_MODE not in ("threading", "eventlet", "gevent"):
+    raise ValueError(f"unknown SMC_ASYNC_MODE {SERVER_ASYNC_MODE!r}")
+# most connections a green thread server holds open at once
+SERVER_MAX_CONNECTIONS = env_int("SMC_MAX_CONNECTIONS", 10000)
+# native threads that run database queries and password hashes for the green
+# thread servers, 0 sizes the pool from the database pool and hashing workers
+OFFLOAD_THREADS = env_int("SMC_OFFLOAD_THREADS", 0)
+
+# serve over https with the certificates in mycerts/
+SERVER_SSL = env_bool("SMC_SSL", True)
+SERVER_SSL_CERT = env_str("SMC_SSL_CERT", "mycerts/smc.test.crt")
+SERVER_SSL_KEY = env_str("SMC_SSL_KEY", "mycerts/smc.test.key")
+
+# bcrypt work factor for password hashes, each step doubles the cost
+BCRYPT_LOG_ROUNDS = env_int("SMC_BCRYPT_LOG_ROUNDS", 12)
+# password hashes run on this many worker threads, see hashing.py
+HASH_WORKERS = env_int("SMC_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+# hashes allowed to wait for a worker, logins and signups beyond that get a 503
+HASH_MAX_QUEUE = env_int("SMC_HASH_MAX_QUEUE", 32)
+# Retry-After sent with that 503, in seconds
+HASH_RETRY_AFTER_S = env_int("SMC_HASH_RETRY_AFTER_S", 1)
+
+# cache of rendered article fragments and query results, see cache.py
+CACHE_ENABLED = env_bool("SMC_CACHE", True)
+CACHE_MAX_BYTES = env_int("SMC_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+
+# where flask sessions (who is logged in) are kept, see session_store.py
+#   sqlite   server side in the sessions table, with a cache in each process
+#   cookie   in a signed cookie (flask's default), nothing kept on the server
+SESSION_BACKEND = env_str("SMC_SESSION_BACKEND", "sqlite")
+if SESSION_BACKEND not in ("sqlite", "cookie"):
+    raise ValueError(f"unknown SMC_SESSION_BACKEND {SESSION_BACKEND!r}")
+# sessions cached in each process, and for how long before they are read again
+SESSION_CACHE_SIZE = env_int("SMC_SESSION_CACHE_SIZE", 10000)
+SESSION_CACHE_TTL_S = env_int("SMC_SESSION_CACHE_TTL_S", 30)
+# a session's expiry is only pushed back once it would move by this much
+SESSION_TOUCH_INTERVAL_S = env_int("SMC_SESSION_TOUCH_INTERVAL_S", 60)
+# how often pushed back expiries are written, 0 writes each one straight away
+SESSION_FLUSH_INTERVAL_MS = env_int("SMC_SESSION_FLUSH_INTERVAL_MS", 1000)
+# how often expired sessions are deleted
+SESSION_PURGE_INTERVAL_S = env_int("SMC_SESSION_PURGE_INTERVAL_S", 600)
+
+# request/event latency and SQL metrics served at /metrics, see metrics.py
+METRICS_ENABLED = env_bool("SMC_METRICS", True)
+# when set, /metrics requires an "Authorization: Bearer <token>" header,
+# when empty it only answers requests from this machine, and only with SMC_DEBUG on
+METRICS_TOKEN = env_str("SMC_METRICS_TOKEN", "")
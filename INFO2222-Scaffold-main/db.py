@@ -3,29 +3,166 @@ db
 database file, containing all the logic to interface with the sql database
 '''
 
-from flask import jsonify
 import json
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+import atexit
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine, event, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
 from models import *
 from pathlib import Path
+from message_writer import MessageWriter
+from logstore import LogStore
+import archive
+import migrations
+import search
+import offload
+import config
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_LEVELS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+def make_engine(path: str, profile: dict, read_only: bool = False, echo: bool = False):
+    """
+    Creates an sqlite engine for the database file at path, tuned by an engine
+    profile from config.DB_PROFILES. A read_only engine opens the file in
+    read-only mode and refuses writes.
+    """
+    journal_mode = profile.get("journal_mode")
+    synchronous = profile.get("synchronous")
+    busy_timeout_ms = profile.get("busy_timeout_ms")
+
+    # pragma values can't be bound as parameters, so only allow known values through
+    if journal_mode is not None and journal_mode.upper() not in JOURNAL_MODES:
+        raise ValueError(f"unknown journal mode {journal_mode!r}")
+    if synchronous is not None and synchronous.upper() not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"unknown synchronous level {synchronous!r}")
+
+    if read_only:
+        url = f"sqlite:///file:{path}?mode=ro&uri=true"
+    else:
+        url = f"sqlite:///{path}"
+
+    new_engine = create_engine(
+        url,
+        echo=echo,
+        pool_size=profile.get("pool_size", 5),
+        max_overflow=profile.get("max_overflow", 10),
+    )
+
+    if offload.offloading():
+        # on a green thread hub, queries run on native threads so they don't stall it
+        @event.listens_for(new_engine, "do_connect")
+        def offloaded_connect(dialect, connection_record, cargs, cparams):
+            cparams["check_same_thread"] = False
+            return offload.OffloadedConnection(dialect.loaded_dbapi.connect(*cargs, **cparams))
+
+    @event.listens_for(new_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # the journal mode is stored in the file, a read-only connection can't change it
+        if journal_mode is not None and not read_only:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode.upper()}")
+        if synchronous is not None:
+            cursor.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        if busy_timeout_ms is not None:
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    return new_engine
 
 # creates the database directory
-Path("database") \
-    .mkdir(exist_ok=True)
+Path(config.DB_PATH).parent \
+    .mkdir(parents=True, exist_ok=True)
 
-# "database/main.db" specifies the database file
-# change it if you wish
+# the database file defaults to "database/main.db", set SMC_DB_PATH to change it
+# the engine is tuned by the profile chosen with SMC_DB_PROFILE, see config.py
 # turn echo = True to display the sql output
-engine = create_engine("sqlite:///database/main.db", echo=False)
+engine = make_engine(config.DB_PATH, config.db_profile(), echo=False)
 
 # initializes the database
 Base.metadata.create_all(engine)
 
+# bring databases created by older versions up to date, see migrations.py
+migrations.migrate(engine)
+
+# heavy read paths use read_engine, which is a separate read-only engine when
+# SMC_DB_READ_ENGINE is on and the main engine otherwise
+if config.DB_READ_ENGINE:
+    read_engine = make_engine(
+        config.DB_PATH,
+        dict(config.db_profile(), pool_size=config.DB_READ_POOL_SIZE),
+        read_only=True
+    )
+else:
+    read_engine = engine
+
+# session factories bound to the engines
+SessionLocal = sessionmaker(bind=engine)
+ReadSession = sessionmaker(bind=read_engine)
+
+# statement recorders active in each thread, see count_queries
+_query_recorders = threading.local()
+
+def _record_query(connection, cursor, statement, parameters, context, executemany):
+    for recorder in getattr(_query_recorders, "active", ()):
+        recorder.append(statement)
+
+for _engine in {engine, read_engine}:
+    event.listen(_engine, "before_cursor_execute", _record_query)
+
+@contextmanager
+def count_queries():
+    """
+    Records every SQL statement this thread runs inside the block.
+
+        with db.count_queries() as statements:
+            ...
+        print(len(statements))
+    """
+    statements = []
+    active = getattr(_query_recorders, "active", None)
+    if active is None:
+        active = _query_recorders.active = []
+    active.append(statements)
+    try:
+        yield statements
+    finally:
+        active.remove(statements)
+
+# the alternative, log based message store, see logstore.py
+message_log = None
+if config.MESSAGE_BACKEND == "log":
+    message_log = LogStore(
+        config.MESSAGE_LOG_DIR,
+        segment_max_bytes=config.MESSAGE_LOG_SEGMENT_MAX_BYTES,
+        index_interval=config.MESSAGE_LOG_INDEX_INTERVAL,
+        fsync_interval=config.MESSAGE_LOG_FSYNC_INTERVAL_MS / 1000
+    )
+    atexit.register(message_log.close)
+
+# optional write-behind queue for chat messages, see message_writer.py
+message_writer = None
+if config.MESSAGE_WRITE_BEHIND and message_log is None:
+    message_writer = MessageWriter(
+        engine,
+        batch_size=config.MESSAGE_BATCH_SIZE,
+        flush_interval=config.MESSAGE_FLUSH_INTERVAL_MS / 1000,
+        max_pending=config.MESSAGE_MAX_PENDING
+    )
+    message_writer.start()
+    # commit whatever is still queued when the server shuts down
+    atexit.register(message_writer.close, config.MESSAGE_SHUTDOWN_TIMEOUT_S)
+
 # inserts a user to the database
-def insert_user(username: str, password: str, role: int):
+def insert_user(username: str, password: str, role: int, public_key: str = None):
     with Session(engine) as session:
-        user = User(username=username, password=password, role=role)
+        user = User(username=username, password=password, role=role,
+                    public_key=public_key, key_version=1 if public_key else 0)
         session.add(user)
         session.commit()
 
@@ -61,6 +198,49 @@ def remove_friend(current_username: str, friend_username: str):
         else:
             return False, "Friend relationship not found"
 
+def set_public_key(username: str, public_key: str):
+    """
+    Replaces a user's public key. Returns its new key_version, or None if there is no such user.
+    """
+    with Session(engine) as session:
+        key_version = session.execute(
+            update(User)
+            .where(User.username == username)
+            .values(public_key=public_key, key_version=User.key_version + 1)
+            .returning(User.key_version)
+        ).scalar()
+        session.commit()
+        return key_version
+
+def get_public_key(username: str):
+    """
+    (public_key, key_version) of a user, or None if there is no such user.
+    """
+    with ReadSession() as session:
+        row = session.execute(
+            select(User.public_key, User.key_version).where(User.username == username)
+        ).first()
+        return tuple(row) if row else None
+
+def get_room_public_keys(room_id, member: str = None) -> dict:
+    """
+    username -> (public_key, key_version) of every member of a room, in one query.
+    Empty if the room doesn't exist, or if member is given and isn't one of its members.
+    """
+    query = select(User.username, User.public_key, User.key_version) \
+        .join(user_room_table, user_room_table.c.user_id == User.username) \
+        .where(user_room_table.c.room_id == room_id)
+    if member is not None:
+        membership = user_room_table.alias()
+        query = query.where(
+            select(membership.c.room_id)
+            .where(membership.c.user_id == member, membership.c.room_id == room_id)
+            .exists()
+        )
+    with ReadSession() as session:
+        rows = session.execute(query).all()
+        return {row.username: (row.public_key, row.key_version) for row in rows}
+
 # Adds user to existing room - wont be used. Wanted feature
 # def add_user_to_room(username, room_id):
 #     """
@@ -75,106 +255,432 @@ def remove_friend(current_username: str, friend_username: str):
 
 def get_user_rooms(username):
     """
-    Retrieves all rooms a user is part of.
+    Retrieves the id and name of all rooms a user is part of, in one query.
     """
-    with Session(engine) as session:
-        user = session.query(User).filter_by(username=username).first()
-        if user:
-            return user.rooms
-        return []
+    with ReadSession() as session:
+        rooms = session.query(Room.id, Room.name) \
+            .join(user_room_table, user_room_table.c.room_id == Room.id) \
+            .filter(user_room_table.c.user_id == username) \
+            .order_by(Room.id) \
+            .all()
+        return [{'id': room.id, 'name': room.name} for room in rooms]
         
+def is_room_member(username: str, room_id: int) -> bool:
+    """
+    Whether a user is a member of a room, one primary key lookup.
+    """
+    with ReadSession() as session:
+        return session.execute(
+            select(user_room_table.c.room_id)
+            .where(user_room_table.c.user_id == username, user_room_table.c.room_id == room_id)
+        ).first() is not None
+
 def find_room_with_users(usernames):
     """
     Tries to find an existing room with given usernames. 
     """
     with Session(engine) as session:
-        # normalise names by sorting
-        sorted_usernames = sorted(usernames)
-
-        # query our rooms table to see if there is such a room
-        rooms = session.query(Room).all()
-        for room in rooms:
-            # get all usernames in current room
-            room_usernames = sorted([user.username for user in room.users])
-            if room_usernames == sorted_usernames:
-                return room
-        
-        # if no room found
-        return None
+        # rooms are indexed by a digest of their members, so this is a single lookup
+        return session.query(Room).filter_by(member_key=room_member_key(usernames)).first()
 
 def create_room(name: str, usernames: list) -> int:
     """
     Creates a new room and adds users to it.
     """
     with Session(engine) as session:
+        # the room only gets the users that exist, so it is looked up by the key of those,
+        # otherwise an unknown username would never match and every call made another room
+        users = session.query(User).filter(User.username.in_(usernames)).all()
+        member_key = room_member_key([user.username for user in users])
+        existing_room_id = session.query(Room.id).filter_by(member_key=member_key).scalar()
+        if existing_room_id is not None:
+            return existing_room_id
 
-        existing_room = find_room_with_users(usernames)
-        if existing_room:
-            return existing_room.id
-
-        # if no existing room found
-        new_room = Room(name=name)
+        new_room = Room(name=name, users=users, member_key=member_key)
         session.add(new_room)
-        session.commit()
-        
-        # add users to the room 
-        for username in usernames:
-            user = session.query(User).filter_by(username=username).first()
-            if user:
-                new_room.users.append(user)
-        
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # member_key is unique, a concurrent create for the same members got there first
+            session.rollback()
+            return session.query(Room.id).filter_by(member_key=member_key).scalar()
         return new_room.id
 
-def fetch_users():
-    with Session(engine) as session:
-        users = session.query(User).filter(User.role != 3).all()  # Exclude Admin User role
-        users_data = [{'username': user.username, 'role': user.role} for user in users]
-    return jsonify(users_data)
+USER_PAGE_SIZE = 500
+USER_PAGE_MAX = 5000
+# most role changes accepted in one update_roles call
+ROLE_UPDATE_MAX = 10000
+ROLES = (0, 1, 2, 3)
+
+def iter_users(role=None, after=None, limit=USER_PAGE_SIZE):
+    """
+    Yields (username, role) of up to `limit` users in username order, starting after the
+    username `after`, then one last (next cursor, None) pair, the cursor being None on the last page.
+    Only users with `role` are listed if it is given, otherwise everyone but admin users.
+    Rows are read as they are sent instead of loading the whole page first.
+    """
+    limit = max(1, min(limit, USER_PAGE_MAX))
+    query = select(User.username, User.role).order_by(User.username).limit(limit + 1)
+    query = query.where(User.role == role) if role is not None else query.where(User.role != 3)
+    if after is not None:
+        query = query.where(User.username > after)
+    with ReadSession() as session:
+        sent = 0
+        last = None
+        for username, user_role in session.execute(query).yield_per(500):
+            if sent == limit:
+                # the extra row only says there is another page
+                yield last, None
+                return
+            yield username, user_role
+            last = username
+            sent += 1
+    yield None, None
 
-def update_role(username: str, role: int):
+def update_roles(changes) -> tuple:
+    """
+    Sets the roles of many users in one transaction, changes being (username, role) pairs.
+    Returns (usernames whose role changed, usernames that don't exist).
+    """
+    changes = dict(changes)
+    changed, missing = [], []
     with Session(engine) as session:
-        new_role = role
-        user = session.query(User).filter_by(username=username).first()
-        print(f"New role: {new_role}. Old role: {user.role}")
-        if user:
-            print("updating role now")
-            user.role = role
+        names = list(changes)
+        current = {}
+        # sqlite caps the number of bound parameters, so look the users up in chunks
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            current.update(session.execute(
+                select(User.username, User.role).where(User.username.in_(chunk))
+            ).all())
+        for username, role in changes.items():
+            if username not in current:
+                missing.append(username)
+            elif current[username] != role:
+                changed.append(username)
+        if changed:
+            # one executemany of UPDATE ... WHERE username = ?
+            session.execute(update(User), [{'username': username, 'role': changes[username]} for username in changed])
             session.commit()
-        else:
-            return jsonify({'message': 'User not found'}), 404
-    return jsonify({'message': 'Role updated successfully'}), 200
+    return changed, missing
+
+def insert_message(content, sender_username, room_id, content_blob=None):
+    """
+    Stores a message and returns its id, or None with write-behind on, where the id
+    is only known once the message's batch is committed.
+    """
+    if message_log is not None:
+        return message_log.append(room_id, sender_username, content, content_blob)
+
+    # with write-behind on, the message is only queued and committed later in a batch
+    if message_writer is not None:
+        message_writer.submit(content, sender_username, room_id, content_blob)
+        return None
 
-def insert_message(content, sender_username, room_id):
     with Session(engine) as session:
-        message = Message(content=content, sender_username=sender_username, room_id=room_id)
+        message = Message(content=content, content_blob=content_blob, sender_username=sender_username, room_id=room_id)
         session.add(message)
+        # read the id before the commit expires it
+        session.flush()
+        message_id = message.id
         session.commit()
+    return message_id
+
+def flush_messages():
+    """
+    Waits for queued messages to be committed, so history reads include them.
+    """
+    if message_writer is not None:
+        message_writer.flush(config.MESSAGE_SHUTDOWN_TIMEOUT_S)
 
 
 def get_messages(room_id):
+    if message_log is not None:
+        return [{'content': message['content'], 'sender': message['sender']}
+                for message in message_log.read(room_id, 1, message_log.last_id(room_id))]
+    flush_messages()
     with Session(engine) as session:
         messages = session.query(Message).filter_by(room_id=room_id).order_by(Message.id).all()
         return [{'content': msg.content, 'sender': msg.sender_username} for msg in messages]
 
+# number of messages sent per history page, and the most a client may ask for
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
+def _message_dict(row) -> dict:
+    message = {'id': row.id, 'content': row.content, 'sender': row.sender_username}
+    if row.content_blob is not None:
+        message['payload'] = row.content_blob
+    return message
+
+def get_messages_page(room_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Keyset pagination over a room's history, walking backwards from the newest message.
+    Returns (messages, before_id): up to `limit` messages older than before_id in display
+    order (oldest first), and the cursor for the next older page, or None at the start of the room.
+    Encrypted messages carry their packed payload as 'payload'. Once the table runs out,
+    the page carries on into the room's archive (see archive.py).
+    """
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    if message_log is not None:
+        return message_log.page(room_id, before_id, limit)
+    flush_messages()
+    with Session(engine) as session:
+        query = session.query(Message.id, Message.content, Message.content_blob, Message.sender_username) \
+            .filter(Message.room_id == room_id)
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        # messages left behind by an interrupted archive run are read from the archive
+        archived_up_to = archive.store.last_id(room_id)
+        if archived_up_to:
+            query = query.filter(Message.id > archived_up_to)
+
+        # fetch one extra row to know whether an older page exists
+        rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+
+    has_older = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    messages = [_message_dict(row) for row in rows]
+
+    # everything older than the oldest message in the table has been archived
+    if not has_older:
+        cursor = messages[0]['id'] if messages else before_id
+        archived, has_older = archive.store.read_before(room_id, cursor, limit - len(messages))
+        messages = archived + messages
+
+    next_before_id = messages[0]['id'] if has_older else None
+    return messages, next_before_id
+
+
+def get_messages_after(room_id, after_id, limit=config.RESUME_MAX_MESSAGES):
+    """
+    The room's messages newer than after_id, oldest first, for a client catching up
+    after a reconnect. Returns (messages, complete). complete is False when more than
+    `limit` messages are newer, or some of them are archived, and the client is better
+    off starting again from the newest page.
+    """
+    if message_log is not None:
+        newest = message_log.last_id(room_id)
+        if newest - after_id > limit:
+            return [], False
+        return message_log.read(room_id, after_id + 1, newest), True
+
+    flush_messages()
+    if after_id < archive.store.last_id(room_id):
+        return [], False
+    with Session(engine) as session:
+        rows = session.query(Message.id, Message.content, Message.content_blob, Message.sender_username) \
+            .filter(Message.room_id == room_id, Message.id > after_id) \
+            .order_by(Message.id).limit(limit + 1).all()
+    if len(rows) > limit:
+        return [], False
+    return [_message_dict(row) for row in rows], True
+
+
+def set_room_archive_policy(room_id, after_days):
+    """
+    Archives the room's messages after `after_days` days, 0 never, None for config.ARCHIVE_AFTER_DAYS.
+    """
+    with Session(engine) as session:
+        session.query(Room).filter(Room.id == room_id).update({Room.archive_after_days: after_days})
+        session.commit()
+
+
+def archive_old_messages(now=None) -> int:
+    """
+    Moves every room's messages past its retention policy to the archive.
+    Returns how many messages were moved.
+    """
+    # the log backend keeps its messages in segments of its own, nothing to archive
+    if message_log is not None:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    flush_messages()
+    with Session(engine) as session:
+        rooms = session.query(Room.id, Room.archive_after_days).all()
+    archived = 0
+    for room_id, after_days in rooms:
+        if after_days is None:
+            after_days = config.ARCHIVE_AFTER_DAYS
+        if after_days > 0:
+            archived += archive_room_messages(room_id, now - timedelta(days=after_days))
+    return archived
+
+
+def archive_room_messages(room_id, cutoff) -> int:
+    """
+    Moves the room's messages sent before cutoff to the archive, oldest first, in blocks.
+    Only a prefix of the room's history is ever archived: archiving stops at the first
+    message newer than cutoff, and at the newest config.ARCHIVE_KEEP_RECENT messages.
+    """
+    archived = 0
+    with Session(engine) as session:
+        room_messages = session.query(Message).filter(Message.room_id == room_id)
+
+        # a crash between archiving a block and deleting it leaves those messages in both places
+        archived_up_to = archive.store.last_id(room_id)
+        if archived_up_to:
+            room_messages.filter(Message.id <= archived_up_to).delete(synchronize_session=False)
+            session.commit()
+
+        keep_from = session.query(Message.id).filter(Message.room_id == room_id) \
+            .order_by(Message.id.desc()).offset(max(config.ARCHIVE_KEEP_RECENT, 1) - 1).limit(1).scalar()
+        if keep_from is None:
+            return 0
+        # walks the room in id order and stops at the first recent message
+        first_recent = session.query(Message.id) \
+            .filter(Message.room_id == room_id, Message.created_at >= cutoff.replace(tzinfo=None)) \
+            .order_by(Message.id).limit(1).scalar()
+        end = min(keep_from, first_recent or keep_from)
+
+        while True:
+            rows = session.query(Message.id, Message.content, Message.content_blob,
+                                 Message.sender_username, Message.created_at) \
+                .filter(Message.room_id == room_id, Message.id < end) \
+                .order_by(Message.id).limit(config.ARCHIVE_BLOCK_MESSAGES).all()
+            if not rows:
+                return archived
+            # written and synced to disk before the rows are deleted
+            offload.run_blocking(archive.store.append, room_id, rows)
+            room_messages.filter(Message.id >= rows[0].id, Message.id <= rows[-1].id) \
+                .delete(synchronize_session=False)
+            session.commit()
+            archived += len(rows)
+
+
+# articles per page of the knowledge repository
+ARTICLES_PER_PAGE = 20
+ARTICLES_PER_PAGE_MAX = 100
+
+
+def _article_query(session):
+    # one query: the author's role comes from a join instead of a lazy load per article
+    return session.query(
+        Article.id, Article.title, Article.content, Article.author_id, Article.created_at,
+        Article.comment_count, User.role.label('author_role')
+    ).outerjoin(User, Article.author_id == User.username)
+
+
+def _article_dicts(articles, app_session):
+    articles_list = []
+    current_user_role = app_session.get('role')
+    current_user_username = app_session.get('username')
+    for article in articles:
+        is_editable = (article.author_id == current_user_username) or (current_user_role != 0)
+        is_deletable = (current_user_role != 0 or article.author_id == current_user_username)
+        articles_list.append({
+            'id': article.id,
+            'title': article.title,
+            'content': article.content,
+            'author_id': article.author_id,
+            'author_role': article.author_role,
+            'created_at': article.created_at,
+            'comment_count': article.comment_count,
+            'is_editable': is_editable,
+            'is_deletable': is_deletable,
+        })
+    return articles_list
+
+
+def fetch_articles(app_session, page: int = 1, per_page: int = ARTICLES_PER_PAGE):
+    """
+    One page of articles, oldest first, and the total number of articles.
+    """
+    with ReadSession() as session:
+        total = session.query(func.count(Article.id)).scalar()
+        articles = _article_query(session).order_by(Article.id) \
+            .limit(per_page).offset((page - 1) * per_page).all()
+        return _article_dicts(articles, app_session), total
+
+
+def fetch_article_page_ids(page: int = 1, per_page: int = ARTICLES_PER_PAGE):
+    """
+    Ids of one page of articles, oldest first, and the total number of articles.
+    """
+    with ReadSession() as session:
+        total = session.query(func.count(Article.id)).scalar()
+        ids = session.scalars(
+            select(Article.id).order_by(Article.id).limit(per_page).offset((page - 1) * per_page)
+        ).all()
+        return ids, total
+
+
+def search_article_ids(query: str, page: int = 1, per_page: int = ARTICLES_PER_PAGE):
+    """
+    Ids of one page of the articles matching query, best match first, and the total number of matches.
+    """
+    with ReadSession() as session:
+        return search.search(session, query, (page - 1) * per_page, per_page)
+
+
+def fetch_articles_by_id(article_ids):
+    """
+    The articles with the given ids, without the per-user is_editable/is_deletable flags.
+    """
+    with ReadSession() as session:
+        return [{
+            'id': article.id,
+            'title': article.title,
+            'content': article.content,
+            'author_id': article.author_id,
+            'author_role': article.author_role,
+            'created_at': article.created_at,
+            'comment_count': article.comment_count,
+        } for article in _article_query(session).filter(Article.id.in_(article_ids))]
+
+
+def search_articles(app_session, query: str, page: int = 1, per_page: int = ARTICLES_PER_PAGE):
+    """
+    One page of the articles matching query, best match first, and the total number of matches.
+    """
+    with ReadSession() as session:
+        ids, total = search.search(session, query, (page - 1) * per_page, per_page)
+        if not ids:
+            return [], total
+        rank = {article_id: i for i, article_id in enumerate(ids)}
+        articles = _article_query(session).filter(Article.id.in_(ids)).all()
+        articles.sort(key=lambda article: rank[article.id])
+        return _article_dicts(articles, app_session), total
+
+
+# comments per article returned by one page of fetch_comments
+COMMENTS_PAGE_SIZE = 5
+COMMENTS_PAGE_MAX = 100
+
+
+def fetch_comments(article_ids, before_id=None, limit=COMMENTS_PAGE_SIZE):
+    """
+    The newest `limit` comments of each article (older than before_id, if given), in one query.
+    Returns {article_id: (comments oldest first, next_before_id or None)},
+    next_before_id is what to pass as before_id to get the article's previous page.
+    """
+    # number each article's comments newest first and keep the first limit + 1,
+    # the extra one only tells whether there is an older page
+    numbered = select(
+        Comment.id, Comment.content, Comment.author_id, Comment.article_id, Comment.created_at,
+        func.row_number().over(partition_by=Comment.article_id, order_by=Comment.id.desc()).label('position')
+    ).where(Comment.article_id.in_(article_ids))
+    if before_id is not None:
+        numbered = numbered.where(Comment.id < before_id)
+    numbered = numbered.subquery()
+    query = select(numbered).where(numbered.c.position <= limit + 1) \
+        .order_by(numbered.c.article_id, numbered.c.id)
 
-def fetch_articles(app_session):
-    with Session(engine) as session:
-        articles = session.query(Article).all()
-        articles_list = []
-        current_user_role = app_session.get('role')
-        current_user_username = app_session.get('username')
-        for article in articles:
-            is_editable = (article.author_id == current_user_username) or (current_user_role != 0)
-            is_deletable = (current_user_role != 0 or article.author_id == current_user_username)
-            articles_list.append({
-                'id': article.id,
-                'title': article.title,
-                'content': article.content,
-                'author_id': article.author_id,
-                'author_role': article.author.role,
-                'created_at': article.created_at,
-                'is_editable': is_editable,
-                'is_deletable': is_deletable,
+    comments = {article_id: [] for article_id in article_ids}
+    older = set()
+    with ReadSession() as session:
+        for row in session.execute(query):
+            if row.position > limit:
+                older.add(row.article_id)
+                continue
+            comments[row.article_id].append({
+                'id': row.id,
+                'content': row.content,
+                'author_id': row.author_id,
+                'created_at': row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else None,
             })
-        return articles_list
\ No newline at end of file
+    return {
+        article_id: (page, page[0]['id'] if article_id in older else None)
+        for article_id, page in comments.items()
+    }
@@ -0,0 +1,90 @@
+'''
+hashing
+password hashing on a bounded worker pool
+
+bcrypt is deliberately slow and CPU bound. hashed inline, every login or signup
+in flight burns a core for the whole hash, so a login storm of a few hundred
+requests takes every core and starves the threads serving socket.io traffic.
+
+PasswordPool runs the hashes on a fixed number of worker threads (bcrypt
+releases the GIL while hashing, so they do run in parallel) and allows a
+limited number of hashes to wait for a worker. once that many are waiting,
+further requests are turned away at once with PoolSaturated instead of
+piling up, which the routes turn into a 503 with a Retry-After header
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import metrics
+import offload
+
+metrics.describe("smc_password_hashes_total", "counter", "Password hashes run on the hashing pool.")
+metrics.describe("smc_password_hashes_rejected_total", "counter", "Password hashes turned away because the hashing pool was full.")
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when the hashing pool already has as many hashes running and waiting as it allows.
+    """
+
+
+class PasswordPool:
+    """
+    Wraps a flask_bcrypt.Bcrypt so its hashes run on `workers` threads,
+    with at most `max_queue` more waiting for a free worker.
+    """
+    def __init__(self, bcrypt, workers: int, max_queue: int, timeout: float = 30):
+        self.bcrypt = bcrypt
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def pending(self) -> int:
+        """
+        Hashes running or waiting for a worker.
+        """
+        return self._pending
+
+    def run(self, function, *args):
+        """
+        Runs function(*args) on the pool and waits for its result.
+        Raises PoolSaturated straight away if the pool is full, or if the hash
+        doesn't finish within the timeout.
+        """
+        if not self._slots.acquire(blocking=False):
+            metrics.inc("smc_password_hashes_rejected_total")
+            raise PoolSaturated()
+        with self._lock:
+            self._pending += 1
+        try:
+            # on a green thread hub the pool's threads are green too, so the hash
+            # itself still has to go to a native thread
+            future = self._executor.submit(offload.run_blocking, function, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        metrics.inc("smc_password_hashes_total")
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # the pool is too far behind to answer in time, the hash keeps its slot until it finishes
+            raise PoolSaturated()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def generate_password_hash(self, password) -> bytes:
+        return self.run(self.bcrypt.generate_password_hash, password)
+
+    def check_password_hash(self, pw_hash, password) -> bool:
+        return self.run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,370 @@
+'''
+logstore
+append-only per-room log storage for chat messages, an alternative to the message table
+
+selected with SMC_MESSAGE_BACKEND=log (see config.py). chat history is written
+far more than it is read and always read in order, so instead of an ORM insert
+and commit per message each room's messages are appended to log segments under
+SMC_MESSAGE_LOG_DIR:
+
+    room-<id>/<first id>.log    framed records: length (4 bytes) | crc32 (4) | record
+    room-<id>/<first id>.idx    sparse index, (id, offset) of every Nth record
+
+message ids count up from 1 in each room, so a page of history is a contiguous
+range of ids: the sparse index finds the closest record at or before its first
+id and the segment is read forward from there
+
+records are written to the file straight away and fsynced in batches by a
+background thread every SMC_MESSAGE_LOG_FSYNC_INTERVAL_MS (0 fsyncs on every
+append). a crash can lose what was written since the last fsync and leave a
+torn record at the end of a room's newest segment. when a room is first opened
+its newest segment is checked from its last index entry on and cut off at the
+first record that is incomplete or fails its crc
+
+only one server process can use a log directory at a time, run several
+processes on the sqlite backend
+'''
+
+import bisect
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# length and crc32 of the record that follows
+FRAME = struct.Struct("<II")
+# id, created_at (unix time), sender length, packed payload length (-1 for none),
+# followed by the sender, the payload and the content
+RECORD = struct.Struct("<qdHi")
+INDEX_ENTRY = struct.Struct("<qQ")
+
+# bytes read at a time when scanning a segment
+READ_SIZE = 64 * 1024
+# a longer length can only be a corrupt frame
+MAX_RECORD_BYTES = 64 * 1024 * 1024
+
+
+def encode_record(message_id, sender, content, content_blob, created_at) -> bytes:
+    sender = sender.encode()
+    body = RECORD.pack(message_id, created_at, len(sender), -1 if content_blob is None else len(content_blob)) \
+        + sender + (content_blob or b"") + (content or "").encode()
+    return FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(body) -> dict:
+    message_id, _, sender_length, blob_length = RECORD.unpack_from(body)
+    offset = RECORD.size
+    sender = bytes(body[offset:offset + sender_length]).decode()
+    offset += sender_length
+    message = {'id': message_id, 'content': None, 'sender': sender}
+    if blob_length >= 0:
+        message['payload'] = bytes(body[offset:offset + blob_length])
+        offset += blob_length
+    message['content'] = bytes(body[offset:]).decode()
+    return message
+
+
+def scan(fd, start: int, end: int = None):
+    """
+    (offset, record body) of every intact record of a segment from start, stopping
+    at end, the end of the file, or the first torn or corrupt record.
+    """
+    buffer = b""
+    # file offset of the start of buffer, and how far into buffer the scan is
+    base = start
+    at = 0
+    while end is None or base + at < end:
+        needed = FRAME.size
+        if len(buffer) - at >= FRAME.size:
+            length, crc = FRAME.unpack_from(buffer, at)
+            if length > MAX_RECORD_BYTES:
+                return
+            needed += length
+        if len(buffer) - at < needed:
+            chunk = os.pread(fd, max(READ_SIZE, needed), base + len(buffer))
+            if not chunk:
+                return
+            buffer = buffer[at:] + chunk
+            base += at
+            at = 0
+            continue
+        body = buffer[at + FRAME.size:at + needed]
+        if zlib.crc32(body) != crc:
+            return
+        yield base + at, body
+        at += needed
+
+
+class RoomLog:
+    """
+    Segments of one room. Appends hold the lock, reads only take it to see where the log ends.
+    """
+    def __init__(self, directory: Path, index_interval: int):
+        self.directory = directory
+        self.index_interval = index_interval
+        self.lock = threading.Lock()
+        # first id of each segment, oldest first, and each segment's sparse index as parallel lists
+        self.segments = []
+        self.index_ids = {}
+        self.index_offsets = {}
+        self.read_fds = {}
+        self.fd = None
+        self.index_fd = None
+        self.size = 0
+        self.next_id = 1
+        self.since_index = 0
+        self.dirty = False
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self.segments = sorted(int(path.stem) for path in directory.glob("*.log"))
+        for segment in self.segments:
+            self._load_index(segment)
+            self.read_fds[segment] = os.open(self._path(segment, ".log"), os.O_RDONLY)
+        if self.segments:
+            self._recover(self.segments[-1])
+        else:
+            self._start_segment(1)
+
+    def _path(self, segment, suffix) -> Path:
+        return self.directory / f"{segment:020d}{suffix}"
+
+    def _load_index(self, segment):
+        try:
+            data = self._path(segment, ".idx").read_bytes()
+        except FileNotFoundError:
+            data = b""
+        # a torn entry at the end only means the index is a little sparser
+        entries = list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+        self.index_ids[segment] = [entry[0] for entry in entries]
+        self.index_offsets[segment] = [entry[1] for entry in entries]
+
+    def _recover(self, segment):
+        # trust the index up to its last entry that still points inside the file, check the rest
+        fd = os.open(self._path(segment, ".log"), os.O_RDWR | os.O_APPEND)
+        file_size = os.fstat(fd).st_size
+        ids, offsets = self.index_ids[segment], self.index_offsets[segment]
+        while offsets and offsets[-1] >= file_size:
+            ids.pop()
+            offsets.pop()
+        start = offsets.pop() if offsets else 0
+        if ids:
+            ids.pop()
+
+        end = start
+        next_id = segment
+        since_index = 0
+        for offset, body in scan(fd, start):
+            message_id = RECORD.unpack_from(body)[0]
+            if since_index % self.index_interval == 0:
+                ids.append(message_id)
+                offsets.append(offset)
+            since_index += 1
+            end = offset + FRAME.size + len(body)
+            next_id = message_id + 1
+        if end < file_size:
+            print(f"logstore: {self.directory.name} had a torn tail, dropped {file_size - end} bytes")
+            os.ftruncate(fd, end)
+            os.fsync(fd)
+        with open(self._path(segment, ".idx"), "wb") as index_file:
+            index_file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in zip(ids, offsets)))
+
+        self.fd = fd
+        self.index_fd = os.open(self._path(segment, ".idx"), os.O_WRONLY | os.O_APPEND)
+        self.size = end
+        self.next_id = next_id
+        self.since_index = since_index % self.index_interval
+
+    def _start_segment(self, first_id):
+        if self.fd is not None:
+            # a full segment is synced before the next one is started, only the newest can be torn
+            os.fsync(self.fd)
+            os.fsync(self.index_fd)
+            os.close(self.fd)
+            os.close(self.index_fd)
+        self.fd = os.open(self._path(first_id, ".log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self._path(first_id, ".idx"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.read_fds[first_id] = os.open(self._path(first_id, ".log"), os.O_RDONLY)
+        self.index_ids[first_id] = []
+        self.index_offsets[first_id] = []
+        self.segments.append(first_id)
+        self.size = 0
+        self.since_index = 0
+
+    def append(self, sender, content, content_blob, segment_max_bytes: int, sync: bool) -> int:
+        with self.lock:
+            if self.size >= segment_max_bytes:
+                self._start_segment(self.next_id)
+            message_id = self.next_id
+            frame = encode_record(message_id, sender, content, content_blob, time.time())
+            segment = self.segments[-1]
+            if self.since_index == 0:
+                os.write(self.index_fd, INDEX_ENTRY.pack(message_id, self.size))
+                # the offset goes in before the id, so a reader that finds the id finds its offset
+                self.index_offsets[segment].append(self.size)
+                self.index_ids[segment].append(message_id)
+            written = 0
+            while written < len(frame):
+                written += os.write(self.fd, frame[written:])
+            if sync:
+                os.fsync(self.fd)
+            else:
+                self.dirty = True
+            self.size += len(frame)
+            self.next_id += 1
+            self.since_index = (self.since_index + 1) % self.index_interval
+            return message_id
+
+    def sync(self):
+        """
+        fsyncs what was appended since the last sync.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            # synced through copies of the descriptors, so appends can carry on meanwhile
+            fds = [os.dup(self.fd), os.dup(self.index_fd)]
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def read(self, first_id: int, last_id: int) -> list:
+        """
+        Messages first_id to last_id, oldest first.
+        """
+        with self.lock:
+            last_id = min(last_id, self.next_id - 1)
+            segments = list(self.segments)
+            end = self.size
+        first_id = max(first_id, 1)
+        if first_id > last_id:
+            return []
+
+        messages = []
+        position = max(bisect.bisect_right(segments, first_id) - 1, 0)
+        for number, segment in enumerate(segments[position:], position):
+            ids = self.index_ids[segment]
+            entry = bisect.bisect_right(ids, first_id, 0, len(ids)) - 1
+            start = self.index_offsets[segment][entry] if entry >= 0 else 0
+            newest = number == len(segments) - 1
+            for _, body in scan(self.read_fds[segment], start, end if newest else None):
+                message_id = RECORD.unpack_from(body)[0]
+                if message_id > last_id:
+                    return messages
+                if message_id >= first_id:
+                    messages.append(decode_record(body))
+        return messages
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.fsync(self.index_fd)
+            for fd in [self.fd, self.index_fd, *self.read_fds.values()]:
+                if fd is not None:
+                    os.close(fd)
+            self.fd = self.index_fd = None
+            self.read_fds = {}
+
+
+class LogStore:
+    """
+    Message logs of every room under one directory.
+    """
+    def __init__(self, directory: str, segment_max_bytes: int, index_interval: int, fsync_interval: float):
+        self.directory = Path(directory)
+        self.segment_max_bytes = segment_max_bytes
+        self.index_interval = index_interval
+        self.fsync_interval = fsync_interval
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self._lock_file = self._claim_directory()
+
+        self._stopping = threading.Event()
+        self._flusher = None
+        if fsync_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="message-log-fsync", daemon=True)
+            self._flusher.start()
+
+    def _claim_directory(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.directory / ".lock", "w")
+        try:
+            import fcntl
+        except ImportError:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(f"{self.directory} is in use by another server process, "
+                               "the log message backend only supports one process")
+        return lock_file
+
+    def room(self, room_id, create: bool = False):
+        """
+        The room's log, opened (and recovered) on first use. None if the room
+        has no log yet, unless create is set.
+        """
+        room_id = int(room_id)
+        log = self._rooms.get(room_id)
+        if log is None:
+            directory = self.directory / f"room-{room_id}"
+            # reads of a room nobody has written to don't leave files behind
+            if not create and not directory.exists():
+                return None
+            with self._lock:
+                log = self._rooms.get(room_id)
+                if log is None:
+                    log = self._rooms[room_id] = RoomLog(directory, self.index_interval)
+        return log
+
+    def append(self, room_id, sender, content, content_blob=None) -> int:
+        """
+        Appends a message to the room's log and returns its id.
+        """
+        return self.room(room_id, create=True).append(sender, content, content_blob, self.segment_max_bytes,
+                                                      sync=self.fsync_interval <= 0)
+
+    def last_id(self, room_id) -> int:
+        log = self.room(room_id)
+        return 0 if log is None else log.next_id - 1
+
+    def read(self, room_id, first_id: int, last_id: int) -> list:
+        log = self.room(room_id)
+        return [] if log is None else log.read(first_id, last_id)
+
+    def page(self, room_id, before_id=None, limit: int = 50):
+        """
+        Same as db.get_messages_page: up to `limit` messages before before_id, oldest
+        first, and the cursor for the page before them or None.
+        """
+        newest = self.last_id(room_id) if before_id is None else before_id - 1
+        first_id = max(newest - limit + 1, 1)
+        messages = self.read(room_id, first_id, newest)
+        return messages, (first_id if first_id > 1 and messages else None)
+
+    def flush(self):
+        for log in list(self._rooms.values()):
+            log.sync()
+
+    def _flush_periodically(self):
+        while not self._stopping.wait(self.fsync_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"logstore: fsync failed: {e}")
+
+    def close(self):
+        self._stopping.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            for log in self._rooms.values():
+                log.close()
+            self._rooms = {}
+        self._lock_file.close()
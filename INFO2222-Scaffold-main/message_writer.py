@@ -0,0 +1,154 @@
+'''
+message_writer
+write-behind persistence for chat messages
+
+the send handler queues messages here and returns straight away, a background
+thread then commits them in batches so a burst of messages costs one
+transaction (and one fsync) instead of one per message
+
+all messages go through a single FIFO queue and a single writer thread and
+each batch is inserted in queue order, so messages keep their order within
+a room (and their ids stay increasing)
+'''
+
+import queue
+import threading
+import time
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from models import Message
+
+
+class MessageWriter:
+    def __init__(self, engine, batch_size: int = 100, flush_interval: float = 0.05, max_pending: int = 10000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue()
+        # one slot per message queued or being written, bounded so a stalled disk pushes
+        # back on senders instead of growing forever. kept apart from the queue so a
+        # sender waiting for a slot doesn't hold the lock the other senders need
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        # sequence numbers of the last message submitted and the last one committed
+        self._submitted = 0
+        self._committed = 0
+        self._lock = threading.Lock()
+        self._committed_changed = threading.Condition(self._lock)
+
+        # set to cut the flush interval short
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, content, sender_username, room_id, content_blob=None):
+        """
+        Queues a message to be written. Blocks only while max_pending messages are waiting to be saved.
+        """
+        if self._closed:
+            raise RuntimeError("message writer is closed")
+        # every row has the same keys, so a batch is one executemany
+        row = {'content': content, 'content_blob': content_blob, 'sender_username': sender_username, 'room_id': room_id}
+        self._slots.acquire()
+        # the lock makes the sequence number match the queue order, the queue is unbounded so this never blocks
+        with self._lock:
+            self._submitted += 1
+            self._queue.put_nowait((self._submitted, row))
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until every message submitted so far has been committed.
+        Returns False if the timeout ran out first.
+        """
+        with self._lock:
+            target = self._submitted
+            if self._committed >= target:
+                return True
+            self._wake.set()
+            return self._committed_changed.wait_for(lambda: self._committed >= target, timeout)
+
+    def close(self, timeout: float = None):
+        """
+        Stops accepting messages and commits whatever is still queued.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"message writer: gave up waiting, {self._queue.qsize()} messages were not saved")
+
+    def _next_batch(self):
+        # wait for the first message, then gather more until the batch is full
+        # or the flush interval is up
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._closed or self._wake.is_set():
+                break
+            self._wake.wait(min(remaining, 0.005))
+        return batch
+
+    def _write(self, batch):
+        # keep retrying while the database is busy or unavailable, the queue holding back
+        # senders is better than losing messages
+        delay = self.flush_interval
+        while True:
+            try:
+                with Session(self.engine) as session:
+                    session.execute(insert(Message), [row for _, row in batch])
+                    session.commit()
+                return
+            except OperationalError as e:
+                print(f"message writer: failed to save {len(batch)} messages, retrying: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            except Exception as e:
+                # anything else is a bad row, which would fail every retry and hold up every message behind it
+                print(f"message writer: failed to save {len(batch)} messages, saving them one by one: {e}")
+                self._write_each(batch)
+                return
+
+    def _write_each(self, batch):
+        # in queue order, so ids stay increasing. a row that fails on its own is dropped
+        for sequence, row in batch:
+            try:
+                with Session(self.engine) as session:
+                    session.execute(insert(Message), [row])
+                    session.commit()
+            except OperationalError:
+                self._write([(sequence, row)])
+            except Exception as e:
+                print(f"message writer: dropped message {sequence} from {row['sender_username']}: {e}")
+
+    def _run(self):
+        while not (self._closed and self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                self._wake.clear()
+                continue
+
+            self._write(batch)
+            for _ in batch:
+                self._slots.release()
+            with self._lock:
+                self._committed = batch[-1][0]
+                if self._committed >= self._submitted:
+                    self._wake.clear()
+                self._committed_changed.notify_all()
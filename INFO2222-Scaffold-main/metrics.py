@@ -0,0 +1,249 @@
+'''
+metrics
+low overhead instrumentation for the server, exposed at /metrics in the
+prometheus text exposition format
+
+records
+    latency of every flask route and every socket.io event handler
+    SQL statements and time spent in SQL, per route or event
+    socket.io events emitted, connected socket ids and online users
+
+recording a sample is a couple of dictionary lookups and additions under a
+lock, so it is cheap enough to leave on in production
+'''
+
+import bisect
+import hmac
+import inspect
+import threading
+import time
+from functools import wraps
+from flask import Response, abort, g, request
+from sqlalchemy import event
+import config
+
+# addresses the debug server's /metrics answers when no SMC_METRICS_TOKEN is set
+LOOPBACK_ADDRESSES = {"127.0.0.1", "::1"}
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+# name -> (type, help text)
+_descriptions = {}
+# name -> {labels: value}, labels being a tuple of (label, value) pairs
+_samples = {}
+# name -> function returning the current value of a gauge, called at scrape time
+_gauges = {}
+
+# which route or socket event this thread is serving, used to attribute SQL statements
+_current = threading.local()
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def describe(name: str, kind: str, help_text: str):
+    _descriptions[name] = (kind, help_text)
+    _samples.setdefault(name, {})
+
+
+def inc(name: str, labels: tuple = (), amount: float = 1):
+    with _lock:
+        samples = _samples[name]
+        samples[labels] = samples.get(labels, 0) + amount
+
+
+def observe(name: str, labels: tuple, value: float):
+    with _lock:
+        samples = _samples[name]
+        histogram = samples.get(labels)
+        if histogram is None:
+            histogram = samples[labels] = Histogram()
+        histogram.observe(value)
+
+
+def gauge(name: str, help_text: str, function):
+    """
+    Registers a gauge whose value is read from function when metrics are scraped.
+    """
+    describe(name, "gauge", help_text)
+    _gauges[name] = function
+
+
+def current_handler() -> str:
+    return getattr(_current, "handler", None) or "background"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def render() -> str:
+    """
+    Every metric in the prometheus text exposition format (version 0.0.4).
+    """
+    lines = []
+    for name, function in _gauges.items():
+        try:
+            value = function()
+        except Exception:
+            continue
+        with _lock:
+            _samples[name] = {(): value}
+
+    with _lock:
+        for name, (kind, help_text) in _descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in _samples[name].items():
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+    return "\n".join(lines) + "\n"
+
+
+describe("smc_http_request_duration_seconds", "histogram", "Time spent serving HTTP requests.")
+describe("smc_socketio_event_duration_seconds", "histogram", "Time spent in socket.io event handlers.")
+describe("smc_sql_statements_total", "counter", "SQL statements run, by the route or event that ran them.")
+describe("smc_sql_seconds_total", "counter", "Time spent running SQL statements, by the route or event that ran them.")
+describe("smc_socketio_emits_total", "counter", "Socket.IO events emitted by the server.")
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    labels = (("handler", current_handler()),)
+    with _lock:
+        statements = _samples["smc_sql_statements_total"]
+        statements[labels] = statements.get(labels, 0) + 1
+        seconds = _samples["smc_sql_seconds_total"]
+        seconds[labels] = seconds.get(labels, 0) + elapsed
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    g._metrics_labels = (("route", rule), ("method", request.method))
+    _current.handler = f"http {request.method} {rule}"
+
+
+def _after_request(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exception):
+    start = g.pop("_metrics_start", None)
+    if start is not None:
+        status = g.pop("_metrics_status", 500)
+        observe("smc_http_request_duration_seconds", g._metrics_labels + (("status", status),), time.perf_counter() - start)
+    _current.handler = None
+
+
+def _timed_handler(message, handler):
+    # flask-socketio retries connect and disconnect handlers with fewer arguments
+    # when they raise TypeError, so pass those only the arguments they accept
+    trim = None
+    if message in ("connect", "disconnect"):
+        parameters = inspect.signature(handler).parameters.values()
+        if not any(p.kind == p.VAR_POSITIONAL for p in parameters):
+            trim = sum(1 for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD))
+
+    labels = (("event", message),)
+
+    @wraps(handler)
+    def timed(*args):
+        if trim is not None:
+            args = args[:trim]
+        previous = getattr(_current, "handler", None)
+        _current.handler = f"socket {message}"
+        start = time.perf_counter()
+        try:
+            return handler(*args)
+        finally:
+            observe("smc_socketio_event_duration_seconds", labels, time.perf_counter() - start)
+            _current.handler = previous
+    return timed
+
+
+def init_app(app, socketio, engines):
+    """
+    Instruments the flask app, the socket.io server and the database engines,
+    and adds the /metrics route. Must be called before the socket.io handlers
+    are registered (before socket_routes is imported).
+    """
+    if not config.METRICS_ENABLED:
+        return
+
+    for engine in set(engines):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+    # time every handler registered with @socketio.on from here on
+    register = socketio.on
+
+    def on(message, namespace=None):
+        decorator = register(message, namespace)
+        return lambda handler: decorator(_timed_handler(message, handler))
+    socketio.on = on
+
+    # count every emit, flask_socketio.emit goes through socketio.emit as well
+    send_event = socketio.emit
+
+    @wraps(send_event)
+    def emit(event_name, *args, **kwargs):
+        inc("smc_socketio_emits_total", (("event", event_name),))
+        return send_event(event_name, *args, **kwargs)
+    socketio.emit = emit
+
+    def connected_sids():
+        return sum(len(socketio.server.manager.rooms.get(namespace, {}).get(None, {}))
+                   for namespace in socketio.server.manager.get_namespaces())
+    gauge("smc_socketio_connected_sids", "Socket.IO clients connected to this process.", connected_sids)
+
+    @app.route("/metrics")
+    def metrics():
+        # route latencies and gauges shouldn't be public: with a token set it must be sent.
+        # without one only the debug server answers, and only a scraper on the same machine.
+        # behind a reverse proxy on this machine every request comes from loopback, so a
+        # deployment has to set the token
+        if config.METRICS_TOKEN:
+            sent = request.headers.get("Authorization", "").encode()
+            if not hmac.compare_digest(sent, f"Bearer {config.METRICS_TOKEN}".encode()):
+                abort(404)
+        elif not config.SERVER_DEBUG or request.remote_addr not in LOOPBACK_ADDRESSES:
+            abort(404)
+        return Response(render(), mimetype="text/plain; version=0.0.4")
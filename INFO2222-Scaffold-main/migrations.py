@@ -0,0 +1,308 @@
+'''
+migrations
+versioned schema changes for databases created by older versions
+
+Base.metadata.create_all only creates missing tables, it never changes one that
+exists, so columns and indexes added to models.py later are added here. every
+migration has a version number and the database keeps the last one applied in
+sqlite's user_version, so each one runs once per database. db.py applies the
+pending ones when it is imported, before anything else touches the database
+
+each migration runs in its own BEGIN IMMEDIATE transaction together with its
+version bump, so one that fails or is cut short leaves nothing behind and runs
+again next time. readers carry on while it runs and other writers wait on the
+busy timeout. backfills over many rows run in batches, each in its own
+transaction with a short pause after it, so writers get a turn in between.
+databases from before this runner already have some of these changes, so
+every migration first checks whether its change is already there
+
+to add a migration append it to MIGRATIONS with the next version. never edit
+or renumber one that has shipped
+
+    python migrations.py            apply pending migrations and list them all
+    python migrations.py --check    also check every hot query uses an index (EXPLAIN QUERY PLAN)
+'''
+
+import argparse
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+from models import room_member_key
+import search
+
+# how long a migration waits for other writers to finish before giving up
+BUSY_TIMEOUT_MS = 30000
+# rows changed per transaction by the backfills
+BATCH_SIZE = 5000
+# pause between those transactions
+BATCH_PAUSE_S = 0.02
+
+# a batched migration is applied again and again until it returns 0, then its version is recorded
+Migration = namedtuple("Migration", "version description apply batched")
+
+
+def table_columns(connection, table: str) -> set:
+    return {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table}")')}
+
+
+def add_column(connection, table: str, column: str, definition: str) -> bool:
+    """
+    Adds a column unless the table already has it. Returns True if it was added.
+    """
+    if column in table_columns(connection, table):
+        return False
+    connection.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}')
+    return True
+
+
+def create_index(connection, name: str, table: str, columns: str):
+    connection.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({columns})')
+
+
+def add_room_member_key(connection):
+    add_column(connection, "room", "member_key", "VARCHAR")
+    create_index(connection, "ix_room_member_key", "room", "member_key")
+
+
+def backfill_room_member_keys(connection) -> int:
+    room_ids = [row[0] for row in connection.exec_driver_sql(
+        "SELECT id FROM room WHERE member_key IS NULL LIMIT ?", (BATCH_SIZE,))]
+    if not room_ids:
+        return 0
+    # the members of the whole batch in one query
+    members = {room_id: [] for room_id in room_ids}
+    placeholders = ",".join("?" * len(room_ids))
+    for user_id, room_id in connection.exec_driver_sql(
+            f"SELECT user_id, room_id FROM user_room WHERE room_id IN ({placeholders})", tuple(room_ids)):
+        members[room_id].append(user_id)
+    connection.execute(
+        text("UPDATE room SET member_key = :key WHERE id = :id"),
+        [{"id": room_id, "key": room_member_key(usernames)} for room_id, usernames in members.items()]
+    )
+    return len(room_ids)
+
+
+def add_room_archive_policy(connection):
+    add_column(connection, "room", "archive_after_days", "INTEGER")
+
+
+def add_message_content_blob(connection):
+    # existing rows keep their text content, only encrypted messages use the new column
+    add_column(connection, "message", "content_blob", "BLOB")
+
+
+def add_message_created_at(connection):
+    add_column(connection, "message", "created_at", "DATETIME")
+
+
+def backfill_message_created_at(connection) -> int:
+    # existing messages have no time, so their age counts from the upgrade
+    return connection.exec_driver_sql(
+        "UPDATE message SET created_at = ? WHERE id IN "
+        "(SELECT id FROM message WHERE created_at IS NULL LIMIT ?)",
+        (datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" "), BATCH_SIZE)
+    ).rowcount
+
+
+def add_message_room_index(connection):
+    create_index(connection, "ix_message_room_id_id", "message", "room_id, id")
+
+
+def add_article_comment_count(connection):
+    if add_column(connection, "articles", "comment_count", "INTEGER NOT NULL DEFAULT 0"):
+        connection.exec_driver_sql(
+            "UPDATE articles SET comment_count = "
+            "(SELECT COUNT(*) FROM comments WHERE comments.article_id = articles.id)"
+        )
+
+
+def add_comment_article_index(connection):
+    create_index(connection, "ix_comments_article_id_id", "comments", "article_id, id")
+
+
+def add_article_search_index(connection):
+    # filled from the existing articles when it is created
+    if search.create_index(connection):
+        search.rebuild_index(connection)
+
+
+def add_user_role_index(connection):
+    create_index(connection, "ix_user_role_username", "user", "role, username")
+
+
+def add_lookup_indexes(connection):
+    create_index(connection, "ix_friendrequests_receiver_id_status", "friendrequests", "receiver_id, status")
+    create_index(connection, "ix_friendrequests_sender_id_receiver_id", "friendrequests", "sender_id, receiver_id")
+    create_index(connection, "ix_user_room_room_id", "user_room", "room_id")
+    create_index(connection, "ix_todo_items_user_id", "todo_items", "user_id")
+
+
+def add_user_public_key(connection):
+    add_column(connection, "user", "public_key", "TEXT")
+    add_column(connection, "user", "key_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def make_room_member_key_unique(connection):
+    unique = any(row[1] == "ix_room_member_key" and row[2]
+                 for row in connection.exec_driver_sql('PRAGMA index_list("room")'))
+    if unique:
+        return
+    # create_room could make a room twice for the same members, the oldest one keeps the key.
+    # the others stay reachable by id but are no longer found by their members
+    connection.exec_driver_sql(
+        "UPDATE room SET member_key = NULL WHERE member_key IS NOT NULL AND id NOT IN "
+        "(SELECT MIN(id) FROM room WHERE member_key IS NOT NULL GROUP BY member_key)"
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_room_member_key")
+    connection.exec_driver_sql('CREATE UNIQUE INDEX ix_room_member_key ON "room" (member_key)')
+
+
+MIGRATIONS = [
+    Migration(1, "room.member_key and its index", add_room_member_key, False),
+    Migration(2, "fill in room.member_key", backfill_room_member_keys, True),
+    Migration(3, "room.archive_after_days", add_room_archive_policy, False),
+    Migration(4, "message.content_blob", add_message_content_blob, False),
+    Migration(5, "message.created_at", add_message_created_at, False),
+    Migration(6, "fill in message.created_at", backfill_message_created_at, True),
+    Migration(7, "index message (room_id, id)", add_message_room_index, False),
+    Migration(8, "articles.comment_count", add_article_comment_count, False),
+    Migration(9, "index comments (article_id, id)", add_comment_article_index, False),
+    Migration(10, "article search index", add_article_search_index, False),
+    Migration(11, "index user (role, username)", add_user_role_index, False),
+    Migration(12, "index friend requests, room members and todo items", add_lookup_indexes, False),
+    Migration(13, "user.public_key and user.key_version", add_user_public_key, False),
+    Migration(14, "make room.member_key unique", make_room_member_key_unique, False),
+]
+LATEST = MIGRATIONS[-1].version
+
+
+def current_version(connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _migration_engine(url):
+    migration_engine = create_engine(url, poolclass=NullPool)
+
+    @event.listens_for(migration_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # the driver would only open a transaction before data changes, leaving
+        # ALTER and CREATE outside of it, so transactions are begun explicitly below
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
+    @event.listens_for(migration_engine, "begin")
+    def begin(connection):
+        # take the write lock up front, so of two processes starting together only one migrates
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return migration_engine
+
+
+def migrate(engine) -> list:
+    """
+    Applies every migration the database behind engine is missing, in order.
+    Returns the versions applied.
+    """
+    with engine.connect() as connection:
+        if current_version(connection) >= LATEST:
+            return []
+
+    applied = []
+    migration_engine = _migration_engine(engine.url)
+    try:
+        for migration in MIGRATIONS:
+            while True:
+                with migration_engine.begin() as connection:
+                    # another process may have got here first
+                    if current_version(connection) >= migration.version:
+                        break
+                    more = migration.apply(connection) and migration.batched
+                    if not more:
+                        connection.exec_driver_sql(f"PRAGMA user_version = {migration.version}")
+                if not more:
+                    applied.append(migration.version)
+                    break
+                # writers waiting for the lock only retry every so often, leave it free long enough to catch it
+                time.sleep(BATCH_PAUSE_S)
+    finally:
+        migration_engine.dispose()
+    if applied:
+        print(f"migrations: applied {', '.join(map(str, applied))}, the database is at version {LATEST}")
+    return applied
+
+
+# the queries behind the busiest pages and events, as the routes in app.py,
+# socket_routes.py and db.py run them, with placeholder values
+HOT_QUERIES = {
+    "friends of a user (/home)":
+        "SELECT user.username, user.role FROM user JOIN friends ON friends.friend_id = user.username "
+        "WHERE friends.user_id = 'a'",
+    "pending friend requests of a user (/home)":
+        "SELECT id, sender_id, receiver_id FROM friendrequests WHERE status = 'pending' "
+        "AND (receiver_id = 'a' OR sender_id = 'a') ORDER BY id",
+    "existing friend request (/add_friend)":
+        "SELECT id FROM friendrequests WHERE sender_id = 'a' AND receiver_id = 'b' LIMIT 1",
+    "rooms of a user (/home)":
+        "SELECT room.id, room.name FROM room JOIN user_room ON user_room.room_id = room.id "
+        "WHERE user_room.user_id = 'a' ORDER BY room.id",
+    "room by its members (create)":
+        "SELECT id FROM room WHERE member_key = 'k' LIMIT 1",
+    "members of rooms":
+        "SELECT user_id, room_id FROM user_room WHERE room_id IN (1, 2)",
+    "history page (join, history)":
+        "SELECT id, content, content_blob, sender_username FROM message "
+        "WHERE room_id = 1 AND id < 100 ORDER BY id DESC LIMIT 51",
+    "missed messages (resume)":
+        "SELECT id, content, content_blob, sender_username FROM message "
+        "WHERE room_id = 1 AND id > 100 ORDER BY id LIMIT 201",
+    "todo items of a user (/todo)":
+        "SELECT id, description, completed FROM todo_items WHERE user_id = 'a'",
+    "comments of an article (/get_comments)":
+        "SELECT id, content, author_id FROM comments WHERE article_id = 1 ORDER BY id",
+    "public keys of a room's members (/api/rooms/<id>/keys)":
+        "SELECT user.username, user.public_key, user.key_version FROM user "
+        "JOIN user_room ON user_room.user_id = user.username WHERE user_room.room_id = 1 "
+        "AND EXISTS (SELECT room_id FROM user_room AS membership WHERE user_id = 'a' AND room_id = 1)",
+    "users of a role (/fetch_users)":
+        "SELECT username, role FROM user WHERE role = 1 AND username > 'a' ORDER BY username LIMIT 501",
+    "expired sessions (purge)":
+        "SELECT id FROM sessions WHERE expires_at <= '2024-01-01 00:00:00.000000'",
+}
+
+
+def check_query_plans(connection) -> dict:
+    """
+    Query name -> plan of every hot query that reads a whole table instead of going through an index.
+    After migrating through another connection use a new one, a connection keeps the plans of the
+    statements it has already run.
+    """
+    # EXPLAIN doesn't notice a schema changed by another connection, a read does
+    connection.exec_driver_sql("SELECT COUNT(*) FROM sqlite_master").scalar()
+    failures = {}
+    for name, query in HOT_QUERIES.items():
+        plan = [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + query)]
+        if any(step.startswith("SCAN ") and " USING " not in step for step in plan):
+            failures[name] = plan
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the database up to date.")
+    parser.add_argument("--check", action="store_true", help="check that every hot query uses an index")
+    args = parser.parse_args()
+
+    # importing db applies the pending migrations
+    import db
+    with db.engine.connect() as connection:
+        version = current_version(connection)
+        for migration in MIGRATIONS:
+            print(f"{migration.version:>3} {'applied' if migration.version <= version else 'pending':<8} {migration.description}")
+        if args.check:
+            failures = check_query_plans(connection)
+            for name, plan in failures.items():
+                print(f"full table scan in {name}: {'; '.join(plan)}")
+            print(f"{len(HOT_QUERIES) - len(failures)} of {len(HOT_QUERIES)} hot queries use an index")
+            sys.exit(1 if failures else 0)
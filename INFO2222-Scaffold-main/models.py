@@ -10,11 +10,12 @@ Prisma docs also looks so much better in comparison
 or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attacks :) )
 '''
 
-from sqlalchemy import String, Table, Column, Integer, ForeignKey, Text, Boolean
+from sqlalchemy import String, Table, Column, Integer, ForeignKey, Text, Boolean, Index, LargeBinary
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from typing import Dict, List
+from typing import Dict, List, Optional
 from sqlalchemy import DateTime
 from datetime import datetime, timezone
+import hashlib
 # for friends database, using Table, Column, Integer, ForeignKey & relationship
 
 # data models
@@ -33,7 +34,9 @@ friend_table = Table('friends', Base.metadata,
 user_room_table = Table(
     'user_room', Base.metadata,
     Column('user_id', String, ForeignKey('user.username'), primary_key=True),
-    Column('room_id', Integer, ForeignKey('room.id'), primary_key=True)
+    Column('room_id', Integer, ForeignKey('room.id'), primary_key=True),
+    # the primary key finds a user's rooms, this finds a room's members
+    Index('ix_user_room_room_id', 'room_id')
 )
 
 
@@ -43,12 +46,16 @@ class User(Base):
     username: Mapped[str] = mapped_column(String, primary_key=True)
     password: Mapped[str] = mapped_column(String)
     role: Mapped[int] = mapped_column(Integer) # [0, 1, 2, 3] = [student, academic, admin-staff, admin-user]
+    # the admin user listing pages through one role at a time in username order
+    __table_args__ = (Index('ix_user_role_username', 'role', 'username'),)
     todo_items = relationship("ToDoItem", back_populates="user")
     articles = relationship('Article', back_populates='author', cascade="all, delete-orphan")
     comments = relationship('Comment', back_populates='author', cascade="all, delete-orphan")
     
-    # deprecated - no more keys
-    # public_key: Mapped[str] = mapped_column(Text, nullable=True) # Storing public key as text
+    # RSA-OAEP public key generated in the browser, base64 of its SPKI form (see the key directory in app.py)
+    public_key: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # bumped every time the key is replaced, clients holding an older version refetch it
+    key_version: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
 
     # establishing relationship with user model. joins with the friend_table.
     # back_populates ensures that adding friends is bi-directional
@@ -84,11 +91,31 @@ class FriendRequest(Base):
     sender_id: Mapped[str] = mapped_column(String, ForeignKey('user.username'))
     receiver_id: Mapped[str] = mapped_column(String, ForeignKey('user.username'))
     status: Mapped[str] = mapped_column(String) # ["rejected", "pending", "accepted"]   
+    # a user's pending requests are looked up from both ends, and add_friend looks up a sender and receiver pair
+    __table_args__ = (
+        Index('ix_friendrequests_receiver_id_status', 'receiver_id', 'status'),
+        Index('ix_friendrequests_sender_id_receiver_id', 'sender_id', 'receiver_id'),
+    )
+
+def room_member_key(usernames) -> str:
+    """
+    Canonical key for a set of room members.
+    The usernames are de-duplicated and sorted, so the same members always
+    give the same key no matter the order they were passed in.
+    """
+    canonical = "\x00".join(sorted(set(usernames)))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 class Room(Base):
     __tablename__ = 'room'
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String)
+    # canonical digest of the sorted member usernames (see room_member_key)
+    # indexed so a room can be looked up by its members in a single query,
+    # and unique so two rooms can't be made for the same members
+    member_key: Mapped[str] = mapped_column(String, nullable=True, index=True, unique=True)
+    # days after which the room's messages are archived, None for the default (see archive.py)
+    archive_after_days: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     users: Mapped[List["User"]] = relationship(
         "User",
         secondary=user_room_table,
@@ -102,10 +129,16 @@ class Room(Base):
 
 class Message(Base):
     __tablename__ = 'message'
+    # history is paged per room by id, so (room_id, id) serves both the filter and the sort
+    __table_args__ = (Index('ix_message_room_id_id', 'room_id', 'id'),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     content: Mapped[str] = mapped_column(Text)
+    # end-to-end encrypted messages are stored packed here (see payload.py), with content left empty
+    content_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
     sender_username: Mapped[str]  = mapped_column(String, ForeignKey('user.username'))
     room_id: Mapped[int] = mapped_column(Integer, ForeignKey('room.id'))
+    # decides when the message is archived
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, default=lambda: datetime.now(timezone.utc))
 
     sender: Mapped["User"] = relationship("User")
     room: Mapped["Room"] = relationship("Room", back_populates="messages")
@@ -118,6 +151,8 @@ class ToDoItem(Base):
     completed = Column(Boolean, default=False)
     user = relationship("User", back_populates="todo_items")
 
+    __table_args__ = (Index('ix_todo_items_user_id', 'user_id'),)
+
 class Article(Base):
     __tablename__ = 'articles'
     id = Column(Integer, primary_key=True)
@@ -127,6 +162,8 @@ class Article(Base):
     author = relationship('User', back_populates='articles')
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     comments = relationship('Comment', back_populates='article', cascade="all, delete-orphan")
+    # kept up to date by post_comment so listings don't have to count comments
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
 
 # Comment model
 class Comment(Base):
@@ -138,3 +175,15 @@ class Comment(Base):
     article = relationship('Article', back_populates='comments')
     author = relationship('User', back_populates='comments')
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # an article's comments in order, for paging through them
+    __table_args__ = (Index('ix_comments_article_id_id', 'article_id', 'id'),)
+
+# server side flask sessions, see session_store.py
+class SessionRecord(Base):
+    __tablename__ = 'sessions'
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    # the session's contents, serialized the way flask serializes session cookies
+    data: Mapped[str] = mapped_column(Text)
+    # indexed for purging the expired ones
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
@@ -0,0 +1,126 @@
+'''
+offload
+runs blocking calls on real OS threads when the server runs on eventlet or gevent
+
+under cooperative concurrency (SMC_ASYNC_MODE=eventlet or gevent, see serve.py)
+every connection is a green thread on one hub. C code like sqlite3 and bcrypt
+doesn't yield to the hub, so a slow query or a password hash would stall every
+connection in the process. run_blocking() hands such calls to the async
+library's native thread pool and lets the hub carry on until they return.
+in the default threading mode it just calls the function
+
+database connections are wrapped in OffloadedConnection (see db.make_engine),
+so every SQLAlchemy query is offloaded without the routes having to know
+'''
+
+import config
+
+
+def run_blocking(function, *args, **kwargs):
+    """
+    function(*args, **kwargs), run on a native thread if the server is on a green thread hub.
+    """
+    if config.SERVER_ASYNC_MODE == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(function, *args, **kwargs)
+    if config.SERVER_ASYNC_MODE == "gevent":
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+    return function(*args, **kwargs)
+
+
+def offloading() -> bool:
+    return config.SERVER_ASYNC_MODE in ("eventlet", "gevent")
+
+
+def thread_pool_size() -> int:
+    """
+    Native threads needed so that every call that can be in flight at once gets one.
+    A smaller pool can deadlock: calls waiting on an sqlite lock would hold every
+    thread while the commit that releases the lock waits for one.
+    """
+    if config.OFFLOAD_THREADS:
+        return config.OFFLOAD_THREADS
+    profile = config.db_profile()
+    size = profile.get("pool_size", 5) + profile.get("max_overflow", 10)
+    if config.DB_READ_ENGINE:
+        size += config.DB_READ_POOL_SIZE + profile.get("max_overflow", 10)
+    return size + config.HASH_WORKERS
+
+
+def configure():
+    """
+    Sizes the native thread pool, call once at startup before any call is offloaded.
+    """
+    size = thread_pool_size()
+    if config.SERVER_ASYNC_MODE == "eventlet":
+        from eventlet import tpool
+        tpool.set_num_threads(size)
+    elif config.SERVER_ASYNC_MODE == "gevent":
+        import gevent
+        gevent.get_hub().threadpool.maxsize = size
+
+
+class OffloadedCursor:
+    """
+    DB-API cursor whose statements and fetches run through run_blocking.
+    """
+    def __init__(self, cursor):
+        object.__setattr__(self, "_cursor", cursor)
+
+    def execute(self, *args):
+        run_blocking(self._cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        run_blocking(self._cursor.executemany, *args)
+        return self
+
+    def fetchone(self):
+        return run_blocking(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return run_blocking(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return run_blocking(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class OffloadedConnection:
+    """
+    DB-API connection whose cursors, commits and rollbacks run through run_blocking.
+    The sqlite3 connection must be opened with check_same_thread=False, as the
+    native thread pool may run each call on a different thread.
+    """
+    def __init__(self, connection):
+        object.__setattr__(self, "_connection", connection)
+
+    def cursor(self, *args):
+        return OffloadedCursor(self._connection.cursor(*args))
+
+    def execute(self, *args):
+        return OffloadedCursor(run_blocking(self._connection.execute, *args))
+
+    def commit(self):
+        run_blocking(self._connection.commit)
+
+    def rollback(self):
+        run_blocking(self._connection.rollback)
+
+    def close(self):
+        run_blocking(self._connection.close)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
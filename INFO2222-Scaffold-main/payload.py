@@ -0,0 +1,81 @@
+'''
+payload
+compact binary form of end-to-end encrypted message payloads
+
+the browser encrypts a message into {cipherText, iv, hmac}: the AES-GCM
+ciphertext as base64, the 12 byte IV as a JSON list of numbers and the HMAC as
+hex. spelled out like that a payload is a third to twice the size of the bytes
+it carries. the packed form is the same three fields as raw bytes:
+
+    version (1 byte) | iv length (1) | iv | hmac length (1) | hmac | ciphertext
+
+encrypted messages are stored packed in Message.content_blob. with
+SMC_BINARY_MESSAGES on they also travel packed, as Socket.IO binary
+attachments, otherwise the server unpacks them back into the JSON form for
+clients. the server accepts either form on "safe-send" whatever the setting,
+so clients can be moved to the binary form before the setting is switched
+'''
+
+import base64
+import binascii
+
+VERSION = 1
+
+
+class PayloadError(ValueError):
+    """
+    Raised for a payload that is neither a well formed packed payload nor a JSON one.
+    """
+
+
+def pack(message: dict) -> bytes:
+    """
+    Packs a JSON form payload {cipherText, iv, hmac} into bytes.
+    """
+    try:
+        ciphertext = base64.b64decode(message["cipherText"], validate=True)
+        iv = bytes(message["iv"])
+        hmac = bytes.fromhex(message["hmac"])
+    except (KeyError, TypeError, ValueError, binascii.Error) as e:
+        raise PayloadError(f"malformed payload: {e}")
+    if not 0 < len(iv) < 256 or not 0 < len(hmac) < 256:
+        raise PayloadError("iv and hmac must be 1 to 255 bytes")
+    return bytes((VERSION, len(iv))) + iv + bytes((len(hmac),)) + hmac + ciphertext
+
+
+def _fields(blob: bytes):
+    # (iv, hmac, ciphertext) views into a packed payload
+    blob = memoryview(blob)
+    if len(blob) < 2 or blob[0] != VERSION:
+        raise PayloadError("unknown payload version")
+    iv_end = 2 + blob[1]
+    if len(blob) <= iv_end:
+        raise PayloadError("truncated payload")
+    hmac_end = iv_end + 1 + blob[iv_end]
+    if len(blob) < hmac_end or blob[1] == 0 or blob[iv_end] == 0:
+        raise PayloadError("truncated payload")
+    return blob[2:iv_end], blob[iv_end + 1:hmac_end], blob[hmac_end:]
+
+
+def unpack(blob: bytes) -> dict:
+    """
+    The JSON form {cipherText, iv, hmac} of a packed payload.
+    """
+    iv, hmac, ciphertext = _fields(blob)
+    return {
+        "cipherText": base64.b64encode(ciphertext).decode("ascii"),
+        "iv": list(iv),
+        "hmac": hmac.hex(),
+    }
+
+
+def to_blob(message) -> bytes:
+    """
+    A payload as received on "safe-send", in either form, as checked packed bytes.
+    """
+    if isinstance(message, dict):
+        return pack(message)
+    if isinstance(message, (bytes, bytearray)):
+        _fields(message)
+        return bytes(message)
+    raise PayloadError("payload must be an object or binary")
@@ -0,0 +1,151 @@
+'''
+presence
+in-memory copy of the friend graph, used to fan out online/offline events
+
+presence changes are emitted to socket.io rooms: each user's tabs are in
+user_room(username), and every tab of X's friends is in friends_room(X), so X
+going online or offline is one emit to friends_room(X). socket_routes keeps
+the rooms up to date on connect and on friend accepts and removals
+
+the whole friends table is loaded once on first use, after that every
+presence change is answered from memory. friend accepts and removals update
+the cache directly, so it never has to go back to the database
+
+with several server processes, each one has its own cache. every friend
+accept or removal bumps a friend graph generation in the shared session
+registry and records the two users it changed. at most every
+SMC_PRESENCE_SYNC_INTERVAL_MS a process asks the registry which users changed
+since it last looked, and reloads only their friends
+'''
+
+import threading
+import time
+from sqlalchemy.orm import Session
+import config
+import db
+from models import friend_table
+from shared_state import user_sessions
+
+# username -> set of friend usernames
+_friends = {}
+_loaded = False
+_lock = threading.Lock()
+
+# registry generation the cache is up to date with, and when we last checked it
+GENERATION = "friends"
+_generation = 0
+_synced_at = 0.0
+
+
+def _load_friends(usernames=None) -> dict:
+    # username -> friends of everyone in usernames, or of everyone with a friend
+    friends = {username: set() for username in usernames or ()}
+    queries = [friend_table.select()]
+    if usernames is not None:
+        usernames = list(usernames)
+        # stay under sqlite's limit on bound parameters
+        queries = [
+            friend_table.select().where(friend_table.c.user_id.in_(usernames[start:start + 500]))
+            for start in range(0, len(usernames), 500)
+        ]
+    with Session(db.engine) as session:
+        for query in queries:
+            for user_id, friend_id in session.execute(query):
+                friends.setdefault(user_id, set()).add(friend_id)
+    return friends
+
+
+def _ensure_loaded():
+    global _loaded, _generation, _synced_at
+    now = time.monotonic()
+    if _loaded and now - _synced_at < config.PRESENCE_SYNC_INTERVAL_MS / 1000:
+        return
+    with _lock:
+        if not _loaded:
+            # read the generation first, so a change made while we load is picked up by the next sync
+            _generation = user_sessions.get_generation(GENERATION)
+            _friends.clear()
+            _friends.update(_load_friends())
+            _loaded = True
+        elif now - _synced_at >= config.PRESENCE_SYNC_INTERVAL_MS / 1000:
+            generation, changed = user_sessions.changed_since(GENERATION, _generation)
+            if changed:
+                _friends.update(_load_friends(changed))
+            _generation = generation
+        _synced_at = now
+
+
+def friends_of(username: str) -> frozenset:
+    """
+    Usernames of everyone who is friends with username.
+    """
+    _ensure_loaded()
+    with _lock:
+        return frozenset(_friends.get(username, ()))
+
+
+def online_friends(username: str) -> list:
+    """
+    Usernames of every friend that is connected.
+    """
+    return list(user_sessions.get_many(friends_of(username)))
+
+
+def user_room(username: str) -> str:
+    """
+    Socket.IO room holding every connected tab of username.
+    """
+    return f"user:{username}"
+
+
+def friends_room(username: str) -> str:
+    """
+    Socket.IO room holding every connected tab of username's friends,
+    so username's presence changes are a single emit to it.
+    """
+    return f"friends:{username}"
+
+
+def add_friendship(username: str, friend_username: str):
+    """
+    Records a new friendship, call after it is committed to the database.
+    """
+    _ensure_loaded()
+    with _lock:
+        _friends.setdefault(username, set()).add(friend_username)
+        _friends.setdefault(friend_username, set()).add(username)
+    # other processes reload these two, and so do we on the next sync, which costs little
+    user_sessions.bump_generation(GENERATION, (username, friend_username))
+
+
+def remove_friendship(username: str, friend_username: str):
+    """
+    Forgets a friendship, call after it is removed from the database.
+    """
+    _ensure_loaded()
+    with _lock:
+        _friends.get(username, set()).discard(friend_username)
+        _friends.get(friend_username, set()).discard(username)
+    user_sessions.bump_generation(GENERATION, (username, friend_username))
+
+
+def refresh(*usernames: str):
+    """
+    Reloads the friends of usernames from the database now, rather than on the next sync.
+    For when another process may have just changed them.
+    """
+    _ensure_loaded()
+    friends = _load_friends(usernames)
+    with _lock:
+        _friends.update(friends)
+
+
+def invalidate():
+    """
+    Drops the whole cache, it is reloaded on next use.
+    Only needed if the friends table is changed outside of the app.
+    """
+    global _loaded
+    with _lock:
+        _friends.clear()
+        _loaded = False
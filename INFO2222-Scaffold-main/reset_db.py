@@ -1,28 +1,301 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-from models import Base  # Ensure Base has all the metadata
+'''
+reset_db
+wipes the database, and optionally fills it with generated data for benchmarking
+
+    python reset_db.py                          an empty database, as before
+    python reset_db.py --preset small           a few thousand users, 100,000 messages
+    python reset_db.py --preset production      100,000 users, 50,000 rooms, 10,000,000 messages
+    python reset_db.py --preset small --messages 500000 --seed 7
+
+the data is generated from --seed, so the same options give the same users,
+friendships, rooms, messages and articles every time. message times are spread
+over the --days days before --end (today by default), inside the archive window.
+friendships follow a power law (preferential attachment): most users have a
+handful of friends and a few have thousands, like real social graphs. room and
+article activity is skewed the same way. every generated user logs in with
+--password and has a random stand-in public key
+
+rows go in with executemany in large batches on a single connection, with the
+indexes dropped until the table is filled and the journal kept in memory, so
+the production preset takes minutes rather than hours. the database is then
+brought to the latest migration (see migrations.py), the search index is
+rebuilt and ANALYZE is run
+'''
+
+import argparse
+import base64
+import hashlib
+import random
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+from flask_bcrypt import generate_password_hash
+from sqlalchemy import create_engine, insert
+from models import Base, User, FriendRequest, Room, Message, ToDoItem, Article, Comment, \
+    friend_table, user_room_table, room_member_key  # Ensure Base has all the metadata
 from pathlib import Path
+import config
+import migrations
+import search
+
+# row counts of each preset, see --help for what they mean
+PRESETS = {
+    "small": {"users": 2000, "friends": 10, "rooms": 1000, "messages": 100000,
+              "articles": 200, "comments": 2000, "todos": 2},
+    "production": {"users": 100000, "friends": 10, "rooms": 50000, "messages": 10000000,
+                   "articles": 10000, "comments": 200000, "todos": 2},
+}
 
-def reset_database():
+# rows per executemany
+BATCH_SIZE = 50000
+
+# share of users in each role: students, academics, admin staff, admin users
+ROLE_WEIGHTS = (80, 15, 4, 1)
+
+# words messages, articles and comments are made of, some common enough for the search to match many articles
+WORDS = (
+    "the a to and of in is it you that for on we this with be are have not at "
+    "can do so but what all will just about if get out up one time when there "
+    "lecture tutorial assignment exam quiz lab week due marks feedback group project "
+    "report deadline extension submission slides notes reading question answer "
+    "security password encryption key certificate hash salt session cookie token "
+    "server client socket message room friend chat database query index cache "
+    "python flask sqlite javascript browser network request response error bug fix "
+    "meeting tomorrow today later thanks please sorry okay sure maybe great cool"
+).split()
+
+
+def reset_database(path=config.DB_PATH):
     # Path to the database file
-    database_path = Path("database/main.db")
-    
+    database_path = Path(path)
+
     # Check if the database file exists and remove it
     if database_path.exists():
         database_path.unlink()
-    
+
+    # archived and logged messages belong to the old rooms, which new rooms would reuse the ids of
+    for directory in (config.ARCHIVE_DIR, config.MESSAGE_LOG_DIR):
+        shutil.rmtree(directory, ignore_errors=True)
+
     # Recreate the database directory if not exists
-    database_path.parent.mkdir(exist_ok=True)
-    
+    database_path.parent.mkdir(parents=True, exist_ok=True)
+
     # Create a new database engine instance
     engine = create_engine(f"sqlite:///{database_path}", echo=False)
-    
+
     # Drop all data and recreate the tables
     Base.metadata.drop_all(engine)  # This is not strictly necessary as we delete the file
     Base.metadata.create_all(engine)
+    # a new database already has every change, so this only records the version (and creates the search index)
+    migrations.migrate(engine)
 
     print("Database has been reset.")
+    return engine
+
+
+def skewed_weights(rng, count: int, exponent: float = 1.2) -> list:
+    """
+    Cumulative weights for count items where the k-th busiest gets 1/k^exponent of the activity,
+    shuffled so the busy ones aren't all at the start.
+    """
+    weights = [1 / (k ** exponent) for k in range(1, count + 1)]
+    rng.shuffle(weights)
+    total, cumulative = 0.0, []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def words(rng, low: int, high: int) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def friend_graph(rng, users: int, friends: int) -> list:
+    """
+    Preferential attachment: every user befriends friends / 2 earlier users, picked in proportion
+    to how many friends they have already, so the number of friends follows a power law.
+    Returns the friendships as (earlier user, later user) index pairs.
+    """
+    per_user = max(1, friends // 2)
+    edges = []
+    # every user appears here once per friendship, so a uniform pick from it is a pick by degree
+    endpoints = []
+    for user in range(1, users):
+        targets = set()
+        wanted = min(per_user, user)
+        while len(targets) < wanted:
+            # now and then anyone at all, so users who joined late still get befriended
+            targets.add(rng.choice(endpoints) if endpoints and rng.random() < 0.9 else rng.randrange(user))
+        for target in targets:
+            edges.append((target, user))
+            endpoints += (target, user)
+    return edges
+
+
+def insert_rows(connection, table, rows) -> int:
+    """
+    Inserts the dicts rows yields into table in batches. Returns the number of rows inserted.
+    """
+    inserted, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.execute(insert(table), batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert(table), batch)
+        inserted += len(batch)
+    return inserted
+
+
+def seed(engine, counts: dict, seed: int = 2222, password: str = "password", days: int = 7, end=None):
+    """
+    Fills the (empty) database behind engine with generated data, see the module docstring.
+    counts has the keys of a PRESETS entry. Returns the number of rows inserted per table.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    users, rooms, messages = counts["users"], counts["rooms"], counts["messages"]
+    inserted = {}
+
+    # logging in sends the password hashed the way the login page does, the server stores a bcrypt hash of that.
+    # one hash for everyone, hashing every user separately would take hours
+    client_hash = hashlib.sha256(password.encode()).hexdigest()
+    password_hash = generate_password_hash(client_hash, config.BCRYPT_LOG_ROUNDS).decode('utf-8')
+
+    def timed(name, table, rows):
+        started = time.perf_counter()
+        inserted[name] = insert_rows(connection, table, rows)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<16} {inserted[name]:>10} rows {elapsed:>7.1f}s")
+
+    usernames = [f"user{i}" for i in range(users)]
+    with engine.connect() as connection:
+        # the database is thrown away if this fails, so skip the crash safety
+        connection.exec_driver_sql("PRAGMA journal_mode = MEMORY")
+        connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        connection.commit()
+        # indexes are built once at the end instead of row by row
+        indexes = [index for table in Base.metadata.sorted_tables for index in table.indexes]
+        for index in indexes:
+            index.drop(connection)
+
+        roles = rng.choices(range(len(ROLE_WEIGHTS)), weights=ROLE_WEIGHTS, k=users)
+        # random stand-ins for the RSA-2048 public keys browsers upload (294 bytes in SPKI form)
+        timed("user", User.__table__, ({"username": username, "password": password_hash, "role": role,
+                                        "public_key": base64.b64encode(b"\x30" + rng.randbytes(293)).decode(),
+                                        "key_version": 1}
+                                       for username, role in zip(usernames, roles)))
+
+        edges = friend_graph(rng, users, counts["friends"]) if users > 1 else []
+        friends = {i: [] for i in range(users)}
+        for a, b in edges:
+            friends[a].append(b)
+            friends[b].append(a)
+        # befriending adds both directions and keeps the accepted request
+        timed("friends", friend_table, ({"user_id": usernames[a], "friend_id": usernames[b]}
+                                        for edge in edges for a, b in (edge, edge[::-1])))
+
+        def requests():
+            for a, b in edges:
+                yield {"sender_id": usernames[a], "receiver_id": usernames[b], "status": "accepted"}
+            # and some still waiting or turned down
+            for _ in range(users // 2 if users > 1 else 0):
+                a, b = rng.sample(range(users), 2)
+                yield {"sender_id": usernames[a], "receiver_id": usernames[b],
+                       "status": rng.choice(("pending", "pending", "rejected"))}
+        timed("friendrequests", FriendRequest.__table__, requests())
+
+        # rooms are made between friends, mostly pairs and sometimes a user and several of their friends
+        members, keys = [], {}
+        candidates = [user for user in range(users) if friends[user]]
+        attempts = 0
+        while candidates and len(members) < rooms and attempts < rooms * 10:
+            attempts += 1
+            owner = rng.choice(candidates)
+            size = 1 if rng.random() < 0.8 else rng.randint(2, 5)
+            room = [owner] + rng.sample(friends[owner], min(size, len(friends[owner])))
+            key = room_member_key(usernames[user] for user in room)
+            if key not in keys:
+                keys[key] = len(members) + 1
+                members.append(room)
+        timed("room", Room.__table__, ({"id": room_id, "name": f"{usernames[members[room_id - 1][0]]}'s room",
+                                        "member_key": key} for key, room_id in keys.items()))
+        timed("user_room", user_room_table, ({"user_id": usernames[user], "room_id": i + 1}
+                                             for i, room in enumerate(members) for user in room))
+
+        def chat():
+            if not members:
+                return
+            weights = skewed_weights(rng, len(members))
+            room_indexes = range(len(members))
+            start = end - timedelta(days=days)
+            step = timedelta(days=days) / max(1, messages)
+            for i in range(messages):
+                room = rng.choices(room_indexes, cum_weights=weights)[0]
+                yield {"content": words(rng, 1, 20), "sender_username": usernames[rng.choice(members[room])],
+                       "room_id": room + 1, "created_at": start + step * i}
+        timed("message", Message.__table__, chat())
+
+        staff = [username for username, role in zip(usernames, roles) if role != 0] or usernames
+        weights = skewed_weights(rng, counts["articles"]) if counts["articles"] else []
+        comment_counts = [0] * counts["articles"]
+        comment_articles = rng.choices(range(counts["articles"]), cum_weights=weights, k=counts["comments"]) \
+            if counts["articles"] else []
+        for article in comment_articles:
+            comment_counts[article] += 1
+        timed("articles", Article.__table__, ({
+            "id": i + 1, "title": words(rng, 3, 8).capitalize(), "author_id": rng.choice(staff),
+            "content": "\n\n".join(words(rng, 30, 120) for _ in range(rng.randint(1, 6))),
+            "created_at": end - timedelta(days=365) * rng.random(), "comment_count": comment_counts[i]
+        } for i in range(counts["articles"])))
+        timed("comments", Comment.__table__, ({
+            "content": words(rng, 3, 40), "article_id": article + 1, "author_id": rng.choice(usernames),
+            "created_at": end - timedelta(days=30) * rng.random()
+        } for article in comment_articles))
+
+        timed("todo_items", ToDoItem.__table__, ({"user_id": username, "description": words(rng, 2, 8),
+                                                   "completed": rng.random() < 0.3}
+                                                  for username in usernames for _ in range(rng.randint(0, 2 * counts["todos"]))))
+        connection.commit()
+
+        started = time.perf_counter()
+        for index in indexes:
+            index.create(connection)
+        search.rebuild_index(connection)
+        connection.commit()
+        connection.exec_driver_sql("ANALYZE")
+        print(f"{'indexes':<16} {'':>15} {time.perf_counter() - started:>7.1f}s")
+    return inserted
 
 
 if __name__ == "__main__":
-    reset_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=list(PRESETS), help="row counts to start from, the options below override them")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--friends", type=int, help="average friends per user")
+    parser.add_argument("--rooms", type=int)
+    parser.add_argument("--messages", type=int)
+    parser.add_argument("--articles", type=int)
+    parser.add_argument("--comments", type=int, help="comments over all articles")
+    parser.add_argument("--todos", type=int, help="average todo items per user")
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--password", default="password", help="password of every generated user")
+    parser.add_argument("--days", type=int, default=7, help="days the messages are spread over")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="time of the last message, today by default")
+    parser.add_argument("--db", default=config.DB_PATH, help="database file")
+    args = parser.parse_args()
+
+    counts = dict(PRESETS[args.preset]) if args.preset else {name: 0 for name in PRESETS["small"]}
+    counts.update({name: getattr(args, name) for name in counts if getattr(args, name) is not None})
+
+    if any(counts.values()) and not counts["users"]:
+        parser.error("--users is needed to generate anything else")
+
+    engine = reset_database(args.db)
+    if any(counts.values()):
+        started = time.perf_counter()
+        seed(engine, counts, args.seed, args.password, args.days, args.end)
+        print(f"Seeded {args.db} in {time.perf_counter() - started:.0f}s, every user's password is \"{args.password}\".")
@@ -0,0 +1,99 @@
+'''
+search
+full-text search over knowledge repository articles, backed by an sqlite FTS5 index
+
+article_fts holds the title and content of every article under the article's id.
+post_article, edit_article and delete_article update it in the same transaction
+as the article itself, so the two can't drift apart
+
+to rebuild the index of an existing database, run
+    python search.py
+'''
+
+import re
+from sqlalchemy import text
+
+# tokens are split the same way FTS5's unicode61 tokenizer does, on anything that isn't a letter or digit
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def create_index(connection) -> bool:
+    """
+    Creates the FTS5 table if it doesn't exist yet. Returns True if it was created.
+    """
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'article_fts'")
+    ).first()
+    if exists:
+        return False
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE article_fts USING fts5(title, content, tokenize = 'porter unicode61')"
+    ))
+    return True
+
+
+def rebuild_index(connection) -> int:
+    """
+    Refills the index from the articles table. Returns the number of articles indexed.
+    """
+    connection.execute(text("DELETE FROM article_fts"))
+    result = connection.execute(text(
+        "INSERT INTO article_fts (rowid, title, content) SELECT id, title, content FROM articles"
+    ))
+    return result.rowcount
+
+
+def index_article(session, article_id: int, title: str, content: str):
+    """
+    Adds or replaces an article in the index.
+    """
+    session.execute(text("DELETE FROM article_fts WHERE rowid = :id"), {"id": article_id})
+    session.execute(
+        text("INSERT INTO article_fts (rowid, title, content) VALUES (:id, :title, :content)"),
+        {"id": article_id, "title": title or "", "content": content or ""}
+    )
+
+
+def remove_article(session, article_id: int):
+    session.execute(text("DELETE FROM article_fts WHERE rowid = :id"), {"id": article_id})
+
+
+def match_query(query: str):
+    """
+    Turns what the user typed into an FTS5 MATCH expression, or None if it has no words.
+    Every word is quoted so FTS5 operators in the input are searched for literally,
+    and the last word also matches as a prefix so results show up while typing.
+    """
+    tokens = TOKEN.findall(query or "")
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search(session, query: str, offset: int, limit: int):
+    """
+    Ids of the articles matching query, best match first, and the total number of matches.
+    """
+    expression = match_query(query)
+    if expression is None:
+        return [], 0
+    total = session.execute(
+        text("SELECT COUNT(*) FROM article_fts WHERE article_fts MATCH :query"), {"query": expression}
+    ).scalar()
+    if not total:
+        return [], 0
+    # title matches count for more than content matches
+    ids = session.execute(text(
+        "SELECT rowid FROM article_fts WHERE article_fts MATCH :query "
+        "ORDER BY bm25(article_fts, 5.0, 1.0) LIMIT :limit OFFSET :offset"
+    ), {"query": expression, "limit": limit, "offset": offset}).scalars().all()
+    return ids, total
+
+
+if __name__ == "__main__":
+    import db
+    with db.engine.begin() as connection:
+        create_index(connection)
+        print(f"Search index rebuilt, {rebuild_index(connection)} articles indexed.")
@@ -0,0 +1,44 @@
+'''
+serve
+production entry point, runs the app on cooperative green threads
+
+with the default threaded server every socket.io connection (websocket or
+long-polling) holds an OS thread for as long as it is open. on eventlet or
+gevent a connection is a green thread instead, a few KiB of memory, so one
+process can hold thousands of idle connections. blocking database and bcrypt
+calls are handed to a native thread pool so they don't stall the hub, see offload.py
+
+usage:
+    SMC_ASYNC_MODE=eventlet python3 serve.py
+    SMC_ASYNC_MODE=gevent python3 serve.py
+
+`python3 app.py` is still the development server (threaded, with the debugger and reloader)
+'''
+
+import config
+
+# the standard library has to be patched before anything else imports it
+if config.SERVER_ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif config.SERVER_ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    raise SystemExit("serve.py needs SMC_ASYNC_MODE=eventlet or SMC_ASYNC_MODE=gevent, use app.py for the threaded server")
+
+import offload
+offload.configure()
+
+from app import app, socketio
+
+if __name__ == "__main__":
+    options = {}
+    if config.SERVER_SSL:
+        options.update(certfile=config.SERVER_SSL_CERT, keyfile=config.SERVER_SSL_KEY)
+    if config.SERVER_ASYNC_MODE == "eventlet":
+        # eventlet's server stops accepting past 1024 open connections by default
+        options["max_size"] = config.SERVER_MAX_CONNECTIONS
+    print(f"Serving on {config.SERVER_HOST}:{config.SERVER_PORT} with {config.SERVER_ASYNC_MODE}")
+    socketio.run(app, host=config.SERVER_HOST, port=config.SERVER_PORT, debug=False,
+                 log_output=config.SERVER_DEBUG, **options)
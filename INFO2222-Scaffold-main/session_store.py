@@ -0,0 +1,271 @@
+'''
+session_store
+server side flask sessions, cached in each process and written to sqlite sparingly
+
+flask keeps the session in a signed cookie by default. kept server side, the
+cookie only carries a random id: the user and role aren't readable by the
+client, logging out really ends the session, and every server process sees
+the same sessions. stored naively that costs a read and a write on every
+request, so
+    reads     every process keeps the SMC_SESSION_CACHE_SIZE most recently used
+              sessions in memory and only reads one from the database again after
+              SMC_SESSION_CACHE_TTL_S, so a logout in another process is noticed
+              within that time
+    writes    a request that changes the session writes it once, at the end of the
+              request, and only if its contents really changed
+    expiry    a session's expiry is only pushed back once it would move by more than
+              SMC_SESSION_TOUCH_INTERVAL_S. those updates are queued and written
+              together every SMC_SESSION_FLUSH_INTERVAL_MS, in one statement
+    purging   a background thread deletes expired sessions every SMC_SESSION_PURGE_INTERVAL_S
+
+an id the store doesn't know is never taken up, the session gets a new one, and
+a session that is cleared (as logging in and out do) moves to a new id too, so
+an id planted in someone's browser can't be ridden into their login
+'''
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.datastructures import CallbackDict
+import metrics
+from models import SessionRecord
+
+metrics.describe("smc_session_lookups_total", "counter",
+                 "Session lookups by where the session was found: cache, database or missing.")
+metrics.describe("smc_session_writes_total", "counter",
+                 "Session rows written, by kind: save (contents changed), touch (expiry pushed back) or delete.")
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """
+    A flask session backed by the store. stored is its contents as last written, so a
+    rewrite with the same values isn't written again. cleared is set once it has been emptied.
+    """
+    def __init__(self, initial=None, sid=None, stored=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.stored = stored
+        self.expires = expires
+        self.modified = False
+        self.cleared = False
+
+    def clear(self):
+        super().clear()
+        self.cleared = True
+
+
+class SessionStore:
+    """
+    Sessions in the sessions table, with the max_cached most recently used ones kept in
+    memory for cache_ttl seconds. With write_behind, expiry updates are queued until flush.
+    """
+    def __init__(self, engine, max_cached: int = 10000, cache_ttl: float = 30, write_behind: bool = True):
+        self.engine = engine
+        self.max_cached = max_cached
+        self.cache_ttl = cache_ttl
+        self.write_behind = write_behind
+        # sid -> (serialized contents, expiry, monotonic time it was read or written)
+        self._cache = OrderedDict()
+        # sid -> expiry waiting to be written
+        self._touched = {}
+        self._lock = threading.Lock()
+
+    def cached(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, sid: str, data: str, expires: datetime):
+        self._cache[sid] = (data, expires, time.monotonic())
+        self._cache.move_to_end(sid)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def get(self, sid: str):
+        """
+        (serialized contents, expiry) of the session, or None if there is no such session or it has expired.
+        """
+        now = utcnow()
+        with self._lock:
+            cached = self._cache.get(sid)
+            if cached is not None and cached[1] > now and time.monotonic() - cached[2] < self.cache_ttl:
+                self._cache.move_to_end(sid)
+                metrics.inc("smc_session_lookups_total", (("source", "cache"),))
+                return cached[0], cached[1]
+
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select(SessionRecord.data, SessionRecord.expires_at).where(SessionRecord.id == sid)
+            ).first()
+        if row is None or row.expires_at <= now:
+            metrics.inc("smc_session_lookups_total", (("source", "missing"),))
+            return None
+        with self._lock:
+            # an expiry this process hasn't written yet is the later one
+            expires = max(row.expires_at, self._touched.get(sid, row.expires_at))
+            self._remember(sid, row.data, expires)
+        metrics.inc("smc_session_lookups_total", (("source", "database"),))
+        return row.data, expires
+
+    def save(self, sid: str, data: str, expires: datetime):
+        """
+        Writes the session's contents and expiry straight away.
+        """
+        statement = insert(SessionRecord).values(id=sid, data=data, expires_at=expires)
+        statement = statement.on_conflict_do_update(
+            index_elements=[SessionRecord.id], set_={"data": data, "expires_at": expires}
+        )
+        with self.engine.begin() as connection:
+            connection.execute(statement)
+        with self._lock:
+            self._touched.pop(sid, None)
+            self._remember(sid, data, expires)
+        metrics.inc("smc_session_writes_total", (("kind", "save"),))
+
+    def touch(self, sid: str, expires: datetime):
+        """
+        Pushes back the session's expiry, queued until the next flush with write_behind.
+        """
+        with self._lock:
+            cached = self._cache.get(sid)
+            if cached is not None:
+                self._cache[sid] = (cached[0], expires, cached[2])
+            self._touched[sid] = expires
+        if not self.write_behind:
+            self.flush()
+
+    def delete(self, sid: str):
+        with self.engine.begin() as connection:
+            connection.execute(delete(SessionRecord).where(SessionRecord.id == sid))
+        with self._lock:
+            self._cache.pop(sid, None)
+            self._touched.pop(sid, None)
+        metrics.inc("smc_session_writes_total", (("kind", "delete"),))
+
+    def flush(self) -> int:
+        """
+        Writes the queued expiry updates in one statement. Returns how many there were.
+        """
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return 0
+        table = SessionRecord.__table__
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(table).where(table.c.id == bindparam("sid")).values(expires_at=bindparam("expires")),
+                [{"sid": sid, "expires": expires} for sid, expires in touched.items()]
+            )
+        metrics.inc("smc_session_writes_total", (("kind", "touch"),), len(touched))
+        return len(touched)
+
+    def purge(self, now: datetime = None) -> int:
+        """
+        Deletes the sessions that have expired. Returns how many there were.
+        """
+        # queued expiries first, or a session kept alive since the last flush would go
+        self.flush()
+        with self.engine.begin() as connection:
+            return connection.execute(
+                delete(SessionRecord).where(SessionRecord.expires_at <= (now or utcnow()))
+            ).rowcount
+
+
+class Maintainer(threading.Thread):
+    """
+    Flushes the store's queued expiry updates every flush_interval seconds and
+    purges expired sessions every purge_interval seconds.
+    """
+    def __init__(self, store: SessionStore, flush_interval: float, purge_interval: float):
+        super().__init__(name="session-maintainer", daemon=True)
+        self.store = store
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        next_purge = time.monotonic()
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.store.flush()
+                if self.purge_interval > 0 and time.monotonic() >= next_purge:
+                    purged = self.store.purge()
+                    if purged:
+                        print(f"sessions: purged {purged} expired sessions")
+                    next_purge = time.monotonic() + self.purge_interval
+            except Exception as e:
+                print(f"sessions: maintenance failed: {e}")
+
+    def stop(self):
+        self._stopping.set()
+        self.store.flush()
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps flask sessions in a SessionStore, the cookie only holds the session id.
+    Sessions are serialized the way flask serializes its session cookies.
+    """
+    serializer = TaggedJSONSerializer()
+    session_class = StoredSession
+
+    def __init__(self, store: SessionStore, touch_interval: float = 60):
+        self.store = store
+        self.touch_interval = timedelta(seconds=touch_interval)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.get(sid)
+            if stored is not None:
+                data, expires = stored
+                return self.session_class(self.serializer.loads(data), sid=sid, stored=data, expires=expires)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        cookie = {
+            "domain": self.get_cookie_domain(app),
+            "path": self.get_cookie_path(app),
+            "secure": self.get_cookie_secure(app),
+            "partitioned": self.get_cookie_partitioned(app),
+            "samesite": self.get_cookie_samesite(app),
+            "httponly": self.get_cookie_httponly(app),
+        }
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            # emptied, by logging out for example
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, **cookie)
+            return
+
+        expires = utcnow() + app.permanent_session_lifetime
+        if session.sid is None or session.cleared:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            sid = secrets.token_urlsafe(32)
+            self.store.save(sid, self.serializer.dumps(dict(session)), expires)
+        else:
+            sid = session.sid
+            data = self.serializer.dumps(dict(session)) if session.modified else session.stored
+            if data != session.stored:
+                self.store.save(sid, data, expires)
+            elif expires - session.expires >= self.touch_interval:
+                self.store.touch(sid, expires)
+            else:
+                # nothing to write, and the cookie the browser holds is still good
+                return
+        response.set_cookie(name, sid, expires=self.get_expiration_time(app, session), **cookie)
@@ -1,2 +1,466 @@
-# dictionary to map users and user sessions
-user_sessions = {}
\ No newline at end of file
+'''
+shared_state
+registry mapping users to their socket session ids, which is also how we know who is online
+
+the registry backend is chosen with SMC_SESSION_REGISTRY (see config.py)
+    memory                  a dict in this process, only works with a single server process
+    sqlite:///path/file.db  a file shared by every server process on this machine
+    redis://host:port/db    a redis server shared by every server process
+every backend behaves like a read-only dict of username -> set of sids, one per
+connected tab, changed through add() and discard()
+
+it also keeps generation counters other modules use to tell every process about
+a change to data they cache. bump_generation() can name the keys that changed,
+and changed_since() tells a process which keys changed after the generation it
+last saw, so it only reloads those
+
+the shared backends record which server process owns each sid. a process
+drops the sids left behind by an earlier run of itself when it starts, and its
+Heartbeat thread tells the others it is still alive. sids of a process that
+stopped heartbeating (it crashed or was killed) are dropped after
+SMC_SESSION_REGISTRY_EXPIRY_S, so their users don't look online forever
+'''
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+import config
+
+
+class MemoryRegistry(Mapping):
+    """
+    Registry kept in this process.
+    """
+    def __init__(self):
+        self._sids = {}
+        self._lock = threading.Lock()
+        self._generations = {}
+        # generation name -> {key -> generation it last changed at}
+        self._changes = {}
+
+    def __getitem__(self, username):
+        return frozenset(self._sids[username])
+
+    def __contains__(self, username):
+        return username in self._sids
+
+    def __iter__(self):
+        return iter(list(self._sids))
+
+    def __len__(self):
+        return len(self._sids)
+
+    def add(self, username: str, sid: str):
+        """
+        Records a connected socket of username.
+        """
+        with self._lock:
+            self._sids.setdefault(username, set()).add(sid)
+
+    def discard(self, username: str, sid: str) -> bool:
+        """
+        Forgets a socket of username. Returns True if that was their last one, i.e. they went offline.
+        """
+        with self._lock:
+            sids = self._sids.get(username)
+            if sids is None:
+                return False
+            sids.discard(sid)
+            if sids:
+                return False
+            del self._sids[username]
+            return True
+
+    def get_many(self, usernames) -> dict:
+        """
+        username -> socket session ids for every username in usernames that is connected.
+        """
+        return {username: self[username] for username in usernames if username in self._sids}
+
+    def get_generation(self, name: str) -> int:
+        """
+        Counter shared by every server process, bumped when shared data changes.
+        """
+        return self._generations.get(name, 0)
+
+    def bump_generation(self, name: str, keys=()) -> int:
+        """
+        Bumps a generation counter, recording that keys changed at the new generation. Returns it.
+        """
+        with self._lock:
+            generation = self._generations[name] = self._generations.get(name, 0) + 1
+            changes = self._changes.setdefault(name, {})
+            for key in keys:
+                changes[key] = generation
+            return generation
+
+    def changed_since(self, name: str, generation: int) -> tuple:
+        """
+        (current generation, keys that changed after generation).
+        """
+        with self._lock:
+            changes = self._changes.get(name, {})
+            return self._generations.get(name, 0), frozenset(key for key, at in changes.items() if at > generation)
+
+    def heartbeat(self) -> list:
+        """
+        Tells the other server processes this one is alive, and drops the sids
+        of processes that stopped heartbeating. Returns the users that went offline.
+        A registry in this process dies with it, so there is nothing to do.
+        """
+        return []
+
+
+def process_owner() -> str:
+    """
+    Identifies this server process to the other ones sharing a registry.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SQLiteRegistry(Mapping):
+    """
+    Registry kept in an sqlite file, so every server process on one machine shares it.
+    Used as the stand-in for redis when scaling out on a single machine.
+    """
+    def __init__(self, path: str, expiry: float = 60):
+        self.path = path
+        self.expiry = expiry
+        self.owner = process_owner()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        connection = self._connection()
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(user_sids)")]
+        if columns and "owner" not in columns:
+            # from before sids had owners. it only holds who is connected right now, so start it over
+            connection.execute("DROP TABLE user_sids")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS user_sids "
+            "(username TEXT NOT NULL, sid TEXT NOT NULL, owner TEXT NOT NULL, PRIMARY KEY (username, sid))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_user_sids_owner ON user_sids (owner)")
+        # the last time each server process said it was alive
+        connection.execute("CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS generation_changes "
+            "(name TEXT NOT NULL, key TEXT NOT NULL, generation INTEGER NOT NULL, PRIMARY KEY (name, key))"
+        )
+        # sids an earlier process with our pid left behind can't be connected any more
+        self._forget(self.owner)
+        self._beat()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # the registry is rebuilt as clients reconnect, so it doesn't need to survive a power cut
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def __getitem__(self, username):
+        rows = self._connection().execute("SELECT sid FROM user_sids WHERE username = ?", (username,)).fetchall()
+        if not rows:
+            raise KeyError(username)
+        return frozenset(row[0] for row in rows)
+
+    def __contains__(self, username):
+        return self._connection().execute(
+            "SELECT 1 FROM user_sids WHERE username = ? LIMIT 1", (username,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self._connection().execute("SELECT DISTINCT username FROM user_sids")])
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(DISTINCT username) FROM user_sids").fetchone()[0]
+
+    def add(self, username: str, sid: str):
+        self._connection().execute(
+            "INSERT OR IGNORE INTO user_sids (username, sid, owner) VALUES (?, ?, ?)", (username, sid, self.owner)
+        )
+
+    def discard(self, username: str, sid: str) -> bool:
+        connection = self._connection()
+        # one transaction, so two tabs closing at once can't both (or neither) see the last one go
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            removed = connection.execute(
+                "DELETE FROM user_sids WHERE username = ? AND sid = ?", (username, sid)
+            ).rowcount
+            remaining = connection.execute(
+                "SELECT 1 FROM user_sids WHERE username = ? LIMIT 1", (username,)
+            ).fetchone()
+        finally:
+            connection.execute("COMMIT")
+        return bool(removed) and remaining is None
+
+    def get_many(self, usernames) -> dict:
+        usernames = list(usernames)
+        found = {}
+        # stay under sqlite's limit on bound parameters
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for username, sid in self._connection().execute(
+                f"SELECT username, sid FROM user_sids WHERE username IN ({placeholders})", chunk
+            ):
+                found.setdefault(username, set()).add(sid)
+        return {username: frozenset(sids) for username, sids in found.items()}
+
+    def get_generation(self, name: str) -> int:
+        row = self._connection().execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_generation(self, name: str, keys=()) -> int:
+        connection = self._connection()
+        # one transaction, so nobody sees the new generation without the keys that changed at it
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO generations (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,)
+            )
+            generation = connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()[0]
+            connection.executemany(
+                "INSERT INTO generation_changes (name, key, generation) VALUES (?, ?, ?) "
+                "ON CONFLICT(name, key) DO UPDATE SET generation = excluded.generation",
+                [(name, key, generation) for key in keys]
+            )
+        finally:
+            connection.execute("COMMIT")
+        return generation
+
+    def changed_since(self, name: str, generation: int) -> tuple:
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            current = connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+            keys = connection.execute(
+                "SELECT key FROM generation_changes WHERE name = ? AND generation > ?", (name, generation)
+            ).fetchall()
+        finally:
+            connection.execute("COMMIT")
+        return (current[0] if current else 0), frozenset(row[0] for row in keys)
+
+    def _beat(self):
+        self._connection().execute(
+            "INSERT INTO owners (owner, heartbeat) VALUES (?, ?) "
+            "ON CONFLICT(owner) DO UPDATE SET heartbeat = excluded.heartbeat",
+            (self.owner, time.time())
+        )
+
+    def _forget(self, owner: str) -> list:
+        # drops every sid of owner, returns the users left with none
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            usernames = [row[0] for row in connection.execute(
+                "SELECT DISTINCT username FROM user_sids WHERE owner = ?", (owner,)
+            )]
+            connection.execute("DELETE FROM user_sids WHERE owner = ?", (owner,))
+            connection.execute("DELETE FROM owners WHERE owner = ?", (owner,))
+            offline = [username for username in usernames if connection.execute(
+                "SELECT 1 FROM user_sids WHERE username = ? LIMIT 1", (username,)
+            ).fetchone() is None]
+        finally:
+            connection.execute("COMMIT")
+        return offline
+
+    def heartbeat(self) -> list:
+        self._beat()
+        dead = self._connection().execute(
+            "SELECT owner FROM owners WHERE heartbeat < ?", (time.time() - self.expiry,)
+        ).fetchall()
+        offline = []
+        for (owner,) in dead:
+            offline.extend(self._forget(owner))
+        return offline
+
+
+class RedisRegistry(Mapping):
+    """
+    Registry kept in redis, shared by server processes on any machine.
+    Each user's sids are a redis set, and a set of online usernames tracks who has any.
+    Each server process has a hash of the sids it owns (sid -> username), and a key
+    that expires unless the process keeps heartbeating.
+    """
+    # removes a sid and, if it was the user's last one, the user from the online set
+    DISCARD = """
+        redis.call('HDEL', KEYS[3], ARGV[1])
+        local removed = redis.call('SREM', KEYS[1], ARGV[1])
+        if removed == 1 and redis.call('SCARD', KEYS[1]) == 0 then
+            redis.call('SREM', KEYS[2], ARGV[2])
+            return 1
+        end
+        return 0
+    """
+    # bumps a generation and records the keys that changed at it, in a sorted set scored by generation
+    BUMP = """
+        local generation = redis.call('INCR', KEYS[1])
+        for _, key in ipairs(ARGV) do
+            redis.call('ZADD', KEYS[2], generation, key)
+        end
+        return generation
+    """
+    # drops every sid an owner holds, returns the users left with none
+    FORGET = """
+        local entries = redis.call('HGETALL', KEYS[1])
+        local offline = {}
+        for i = 1, #entries, 2 do
+            local sids = ARGV[2] .. ':sids:' .. entries[i + 1]
+            if redis.call('SREM', sids, entries[i]) == 1 and redis.call('SCARD', sids) == 0 then
+                redis.call('SREM', ARGV[2], entries[i + 1])
+                table.insert(offline, entries[i + 1])
+            end
+        end
+        redis.call('DEL', KEYS[1])
+        redis.call('SREM', KEYS[2], ARGV[1])
+        return offline
+    """
+
+    def __init__(self, url: str, key: str = "smc:online", expiry: float = 60):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('redis package is not installed (Run "pip install redis" in your virtualenv).')
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.key = key
+        self.expiry = expiry
+        self.owner = process_owner()
+        self._discard = self.redis.register_script(self.DISCARD)
+        self._bump = self.redis.register_script(self.BUMP)
+        self._forget_script = self.redis.register_script(self.FORGET)
+        # sids an earlier process with our pid left behind can't be connected any more
+        self._forget(self.owner)
+        self._beat()
+
+    def _sids_key(self, username):
+        return f"{self.key}:sids:{username}"
+
+    def _owner_key(self, owner):
+        return f"{self.key}:owner:{owner}"
+
+    def __getitem__(self, username):
+        sids = self.redis.smembers(self._sids_key(username))
+        if not sids:
+            raise KeyError(username)
+        return frozenset(sids)
+
+    def __contains__(self, username):
+        return bool(self.redis.sismember(self.key, username))
+
+    def __iter__(self):
+        return iter(self.redis.smembers(self.key))
+
+    def __len__(self):
+        return self.redis.scard(self.key)
+
+    def add(self, username: str, sid: str):
+        pipeline = self.redis.pipeline()
+        pipeline.sadd(self._sids_key(username), sid)
+        pipeline.sadd(self.key, username)
+        pipeline.hset(self._owner_key(self.owner), sid, username)
+        pipeline.execute()
+
+    def discard(self, username: str, sid: str) -> bool:
+        return bool(self._discard(
+            keys=[self._sids_key(username), self.key, self._owner_key(self.owner)], args=[sid, username]
+        ))
+
+    def get_many(self, usernames) -> dict:
+        usernames = list(usernames)
+        if not usernames:
+            return {}
+        pipeline = self.redis.pipeline()
+        for username in usernames:
+            pipeline.smembers(self._sids_key(username))
+        return {username: frozenset(sids) for username, sids in zip(usernames, pipeline.execute()) if sids}
+
+    def get_generation(self, name: str) -> int:
+        return int(self.redis.get(f"{self.key}:generation:{name}") or 0)
+
+    def bump_generation(self, name: str, keys=()) -> int:
+        return int(self._bump(
+            keys=[f"{self.key}:generation:{name}", f"{self.key}:changes:{name}"], args=list(keys)
+        ))
+
+    def changed_since(self, name: str, generation: int) -> tuple:
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.get(f"{self.key}:generation:{name}")
+        pipeline.zrangebyscore(f"{self.key}:changes:{name}", f"({generation}", "+inf")
+        current, keys = pipeline.execute()
+        return int(current or 0), frozenset(keys)
+
+    def _beat(self):
+        pipeline = self.redis.pipeline()
+        pipeline.set(f"{self.key}:alive:{self.owner}", 1, ex=max(1, round(self.expiry)))
+        pipeline.sadd(f"{self.key}:owners", self.owner)
+        pipeline.execute()
+
+    def _forget(self, owner: str) -> list:
+        return list(self._forget_script(keys=[self._owner_key(owner), f"{self.key}:owners"], args=[owner, self.key]))
+
+    def heartbeat(self) -> list:
+        self._beat()
+        owners = [owner for owner in self.redis.smembers(f"{self.key}:owners") if owner != self.owner]
+        pipeline = self.redis.pipeline()
+        for owner in owners:
+            pipeline.exists(f"{self.key}:alive:{owner}")
+        offline = []
+        for owner, alive in zip(owners, pipeline.execute()):
+            if not alive:
+                offline.extend(self._forget(owner))
+        return offline
+
+
+class Heartbeat(threading.Thread):
+    """
+    Calls registry.heartbeat() every interval seconds, and on_offline with the
+    users that went offline because their server process stopped.
+    """
+    def __init__(self, registry, interval: float, on_offline=None):
+        super().__init__(name="registry-heartbeat", daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.on_offline = on_offline
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                offline = self.registry.heartbeat()
+                if offline:
+                    print(f"registry: {len(offline)} users of stopped server processes went offline")
+                    if self.on_offline is not None:
+                        self.on_offline(offline)
+            except Exception as e:
+                print(f"registry: heartbeat failed: {e}")
+
+    def stop(self):
+        self._stopping.set()
+
+
+def make_registry(url: str):
+    """
+    Creates the registry backend described by url.
+    """
+    if url == "memory":
+        return MemoryRegistry()
+    if url.startswith("sqlite:///"):
+        return SQLiteRegistry(url[len("sqlite:///"):], expiry=config.SESSION_REGISTRY_EXPIRY_S)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRegistry(url, expiry=config.SESSION_REGISTRY_EXPIRY_S)
+    raise ValueError(f"unknown session registry {url!r}")
+
+
+# maps users to their socket session ids
+user_sessions = make_registry(config.SESSION_REGISTRY_URL)
@@ -0,0 +1,90 @@
+'''
+socket_queue
+message queue that lets several server processes act as one socket.io server
+
+every emit is published to the queue, and each process delivers it to the
+clients connected to it. production deployments can use any queue python-socketio
+supports (redis, rabbitmq, kafka, zmq). for a single machine without any external
+services, SQLiteQueueManager keeps the queue in an sqlite file instead
+'''
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from socketio import PubSubManager
+import config
+
+
+class SQLiteQueueManager(PubSubManager):
+    """
+    python-socketio client manager that publishes through an sqlite file.
+    Each process polls the file for messages published by the others.
+    """
+    name = 'sqlite'
+
+    # published messages are deleted once they are this old (seconds)
+    retention = 60
+
+    def __init__(self, url: str, channel: str = 'socketio', poll_interval: float = 0.01,
+                 write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len("sqlite:///"):]
+        self.poll_interval = poll_interval
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS socketio_queue ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, created REAL NOT NULL, data TEXT NOT NULL)"
+        )
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # queued messages are only useful for a moment, no need to fsync them
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def _publish(self, data):
+        self._connection().execute(
+            "INSERT INTO socketio_queue (channel, created, data) VALUES (?, ?, ?)",
+            (self.channel, time.time(), json.dumps(data))
+        )
+
+    def _listen(self):
+        connection = self._connection()
+        # only deliver messages published after this process started listening
+        last_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_queue").fetchone()[0]
+        next_prune = 0
+        while True:
+            rows = connection.execute(
+                "SELECT id, data FROM socketio_queue WHERE id > ? AND channel = ? ORDER BY id",
+                (last_id, self.channel)
+            ).fetchall()
+            for message_id, data in rows:
+                last_id = message_id
+                yield data
+
+            now = time.time()
+            if now >= next_prune:
+                connection.execute("DELETE FROM socketio_queue WHERE created < ?", (now - self.retention,))
+                next_prune = now + self.retention / 2
+
+            if not rows:
+                time.sleep(self.poll_interval)
+
+
+def socketio_options(url: str) -> dict:
+    """
+    Keyword arguments for SocketIO() that attach the message queue described by url.
+    """
+    if not url:
+        return {}
+    if url.startswith("sqlite:///"):
+        return {"client_manager": SQLiteQueueManager(url, poll_interval=config.SOCKETIO_QUEUE_POLL_MS / 1000)}
+    return {"message_queue": url}
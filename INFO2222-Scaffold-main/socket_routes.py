@@ -4,8 +4,8 @@ file containing all the routes related to socket.io
 '''
 
 
-from flask_socketio import join_room, emit, leave_room
-from flask import request, jsonify
+from flask_socketio import join_room, emit, leave_room, rooms
+from flask import request, jsonify, session
 from bleach import clean 
 from typing import List
 
@@ -16,10 +16,22 @@ except ImportError:
 
 from models import Room
 
+import backpressure
+import config
 import db
+import metrics
+import payload
+import presence
+import time
 
 from shared_state import user_sessions
 
+# limits on how fast chat messages are accepted and a bounded delivery queue per room, see backpressure.py
+user_limits = backpressure.RateLimiter("user", config.SEND_USER_RATE, config.SEND_USER_BURST)
+room_limits = backpressure.RateLimiter("room", config.SEND_ROOM_RATE, config.SEND_ROOM_BURST)
+outbox = backpressure.RoomOutbox(socketio.emit, socketio.start_background_task, config.ROOM_QUEUE_MAX)
+metrics.gauge("smc_room_outbound_queued", "Chat messages waiting to be delivered to their rooms.", outbox.queued)
+
 def find_or_create_room(room_name, usernames):
     """
     Finds or creates a room and adds users to it
@@ -29,62 +41,196 @@ def find_or_create_room(room_name, usernames):
         return existing_room.id
     room_id = db.create_room(room_name, usernames)
 
-    #emit new room event to all users
+    #emit new room event to all users, to every tab they have open
     for username in usernames:
-        if username in user_sessions:
-            socketio.emit("new_room", {"room_id": room_id, "room_name": room_name}, room=user_sessions[username])
+        socketio.emit("new_room", {"room_id": room_id, "room_name": room_name}, to=presence.user_room(username))
     return room_id
 
+
+def chat_room(room_id):
+    """
+    room_id if it is a chat room the logged in user is a member of, otherwise None.
+    Socket.IO rooms are also named after users (see presence.py), those are never chat rooms.
+    """
+    username = session.get("username")
+    # bool is an int too
+    if type(room_id) is not int or username is None:
+        return None
+    return room_id if db.is_room_member(username, room_id) else None
+
+
+def enter_friend_rooms(username, friend_username):
+    """
+    Puts every tab of two new friends in each other's friends room,
+    so they get each other's presence changes from now on.
+    """
+    move_friend_rooms(username, friend_username, socketio.server.enter_room)
+
+
+def leave_friend_rooms(username, friend_username):
+    """
+    Takes every tab of two former friends out of each other's friends room.
+    """
+    move_friend_rooms(username, friend_username, socketio.server.leave_room)
+
+
+def move_friend_rooms(username, friend_username, move):
+    # a process can only move its own sockets between rooms. tabs connected to
+    # another process are told to ask it to (see sync_friend_rooms), and sids
+    # of sockets that are gone are skipped
+    for user, friend in ((username, friend_username), (friend_username, username)):
+        elsewhere = False
+        for sid in user_sessions.get(user, ()):
+            if socketio.server.manager.is_connected(sid, "/"):
+                move(sid, presence.friends_room(friend), namespace="/")
+            else:
+                elsewhere = True
+        if elsewhere:
+            socketio.emit("friend_rooms_changed", to=presence.user_room(user))
+
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
 @socketio.on('connect')
 def connect():
-    username = request.cookies.get("username")
+    # the logged in user, the username cookie is set by the page and could name anyone
+    username = session.get("username")
     room_id = request.cookies.get("room_id")
 
-    # mapping user to session id
+    # mapping user to session id, a user has one per open tab
     if username:
-        user_sessions[username] = request.sid
-        print(f"{username} connected with SID {user_sessions.get(username)}")
+        user_sessions.add(username, request.sid)
+        print(f"{username} connected with SID {request.sid}")
+        # the user's own room, for notifications meant for every tab they have open
+        join_room(presence.user_room(username))
+        # and a seat in each friend's friends room, to hear about their presence
+        for friend_username in presence.friends_of(username):
+            join_room(presence.friends_room(friend_username))
 
     if room_id is None or username is None:
         return
+    room_id = chat_room(int(room_id)) if room_id.isdigit() else None
+    if room_id is None:
+        return
     # socket automatically leaves a room on client disconnect
     # so on client connect, the room needs to be rejoined
     print(f"Joining room {room_id} for {username}")
-    join_room(int(room_id))
-    emit("incoming", (f"{username} has connected", "green"), to=int(room_id))
+    join_room(room_id)
+    emit("incoming", (f"{username} has connected", "green"), to=room_id)
 
 # event when client disconnects
 # quite unreliable use sparingly
 @socketio.on('disconnect')
 def disconnect():
-    username = request.cookies.get("username")
+    username = session.get("username")
     print(f"{username} disconnected")
     room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    if username is None:
         return
-      
-    if username in user_sessions:
-        del user_sessions[username]
+
+    # the user is only offline once their last tab is gone
+    if user_sessions.discard(username, request.sid):
         # emit to friends that user is offline
-        active_user_friends = db.get_friends(username)
-        for friend in active_user_friends:
-            if friend.username in user_sessions:
-                emit("friend_offline", {"username": username}, room=user_sessions[friend.username])
+        emit("friend_offline", {"username": username}, to=presence.friends_room(username))
+
+    room_id = chat_room(int(room_id)) if room_id is not None and room_id.isdigit() else None
+    if room_id is None:
+        return
+    emit("incoming", (f"{username} has disconnected", "red"), to=room_id)
+    leave_room(room_id)
+
+def admit_message(username, room_id):
+    """
+    Waits until the sender's and the room's rate limits let a message through and takes
+    a slot in the room's queue for it. Raises backpressure.Throttled if it is turned away.
+    """
+    # under the drop policy nothing waits
+    max_wait = config.SEND_MAX_WAIT_MS / 1000 if config.SEND_POLICY == "slow" else 0
+    deadline = time.monotonic() + max_wait
+    wait = user_limits.reserve(username, max_wait)
+    # only what was taken is given back, refunding the room after its own reserve
+    # failed would let every other rejected message through
+    try:
+        wait = max(wait, room_limits.reserve(room_id, max_wait))
+    except backpressure.Throttled:
+        user_limits.refund(username)
+        raise
+    if wait:
+        socketio.sleep(wait)
+    try:
+        outbox.acquire(room_id, max(0, deadline - time.monotonic()))
+    except backpressure.Throttled:
+        user_limits.refund(username)
+        room_limits.refund(room_id)
+        raise
+
+
+def relay_message(room_id, content, event, make_args, content_blob=None):
+    """
+    Stores a chat message from the logged in user and queues event for the room with
+    make_args(sender, message id), if backpressure lets it through. Returns the acknowledgement for the sender.
+    """
+    # the sender is whoever is logged in, never the name the client sent, so a flooder
+    # can't get a fresh rate limit (or speak as someone else) by changing it
+    username = session.get("username")
+    if chat_room(room_id) is None:
+        return {"success": False, "message": "Not a member of this room"}
+    try:
+        admit_message(username, room_id)
+    except backpressure.Throttled as e:
+        return {"success": False, "message": str(e), "retry_after": e.retry_after}
+    try:
+        message_id = db.insert_message(content, username, room_id, content_blob=content_blob)
+    except BaseException:
+        outbox.release(room_id)
+        raise
+    outbox.put(room_id, event, make_args(username, message_id))
+    return {"success": True}
 
-    emit("incoming", (f"{username} has disconnected", "red"), to=int(room_id))
-    leave_room(int(room_id))
 
 # send message event handler
 @socketio.on("send")
 def send(username, message, room_id):
-    db.insert_message(message, username, room_id)
-    emit("incoming", (f"{username}: {message}"), to=room_id)
+    # anything but text would only fail once it reaches the database
+    if not isinstance(message, str):
+        return {"success": False, "message": "Message must be text"}
+    # the id lets clients resume from this message after a reconnect, it is None with write-behind on
+    return relay_message(room_id, message, "incoming",
+                         lambda sender, message_id: (f"{sender}: {message}", "black", message_id))
+
+
+def wire_payload(blob):
+    """
+    A stored encrypted payload in the form clients are sent, packed bytes or JSON (see payload.py).
+    """
+    return blob if config.MESSAGE_BINARY_TRANSPORT else payload.unpack(blob)
+
+
+def wire_messages(messages):
+    """
+    Stored messages with their encrypted payloads in the form clients are sent.
+    """
+    for message in messages:
+        if 'payload' in message:
+            message['payload'] = wire_payload(message['payload'])
+    return messages
+
+
+# end-to-end encrypted message, either form of payload is accepted
+@socketio.on("safe-send")
+def safe_send(username, message, room_id):
+    try:
+        blob = payload.to_blob(message)
+    except payload.PayloadError as e:
+        return {"success": False, "message": str(e)}
+    return relay_message(room_id, "", "safe-incoming",
+                         lambda sender, message_id: (sender, wire_payload(blob), message_id), content_blob=blob)
 
 @socketio.on("create")
 def create(data):
-    sender_name = data['sender']
+    # the room is made for the logged in user, whoever the client says is sending
+    sender_name = session.get("username")
+    if sender_name is None:
+        return "Not logged in"
     room_name = data['room_name']
     other_usernames = data['friends']
     all_users = other_usernames + [sender_name]
@@ -106,6 +252,8 @@ def join(data):
 
     if not sender_name or not room_id:
         return {"success": False, "message": "Missing sender name or room ID"}
+    if chat_room(room_id) is None:
+        return {"success": False, "message": "Not a member of this room"}
 
     # Join the room
     join_room(room_id)
@@ -113,46 +261,114 @@ def join(data):
     # Emit messages to notify users
     emit("incoming", (f"{sender_name} has joined the room.", "green"), to=room_id)
     
-    # Retrieve and emit message history to the joining user
-    messages = db.get_messages(room_id)
-    emit("message_history", messages, to=request.sid)
+    # emit the newest page of history to the joining user, older pages are requested with "history"
+    emit_history_page(room_id)
     
     return {"success": True, "room_id": room_id}
 
 
+def emit_history_page(room_id, before_id=None, limit=db.HISTORY_PAGE_SIZE):
+    """
+    Sends one bounded page of a room's history to the requesting client.
+    """
+    messages, next_before_id = db.get_messages_page(room_id, before_id, limit)
+    emit("message_history", {
+        "room_id": room_id,
+        "messages": wire_messages(messages),
+        "before_id": next_before_id,
+        "older": before_id is not None
+    }, to=request.sid)
+
+
+# request an older page of history, before_id is the cursor from the last "message_history"
+@socketio.on("history")
+def history(data):
+    room_id = data.get('room_id')
+    before_id = data.get('before_id')
+    limit = data.get('limit', db.HISTORY_PAGE_SIZE)
+
+    if not room_id or not isinstance(before_id, int) or not isinstance(limit, int):
+        return {"success": False, "message": "Missing room ID or history cursor"}
+    if chat_room(room_id) is None:
+        return {"success": False, "message": "Not a member of this room"}
+
+    emit_history_page(room_id, before_id, limit)
+    return {"success": True}
+
+
+# a (re)connecting client catches up on the room it is in, last_id is the newest
+# message it already has. it is sent only what it missed, or the newest page of
+# history if it has nothing yet or missed too much
+@socketio.on("resume")
+def resume(data):
+    room_id = data.get('room_id')
+    last_id = data.get('last_id')
+    if not room_id:
+        return {"success": False, "message": "Missing room ID"}
+    if chat_room(room_id) is None:
+        return {"success": False, "message": "Not a member of this room"}
+
+    join_room(room_id)
+    if isinstance(last_id, int):
+        messages, complete = db.get_messages_after(room_id, last_id)
+        if complete:
+            emit("message_delta", {"room_id": room_id, "messages": wire_messages(messages), "reset": False},
+                 to=request.sid)
+            return {"success": True}
+
+    messages, before_id = db.get_messages_page(room_id)
+    emit("message_delta", {"room_id": room_id, "messages": wire_messages(messages), "reset": True,
+                           "before_id": before_id}, to=request.sid)
+    return {"success": True}
+
+
 # leave room event handler
 @socketio.on("leave")
 def leave(username, room_id):
+    if chat_room(room_id) is None:
+        return
     emit("incoming", (f"{username} has left the room.", "red"), to=room_id)
     leave_room(room_id)
 
 @socketio.on("online")
-def heartbeat_online(username):
-    active_user = db.get_user(username)
-    if active_user:
-        active_user_friends = db.get_friends(active_user.username)
-        main_sid = user_sessions[active_user.username]
-        friends_session_ids = [user_sessions[x.username] for x in active_user_friends if x.username in user_sessions]
-
-        # notify all friends that the user is online
-        for friend_sid in friends_session_ids:
-            emit("friend_online", {"username": username}, room=friend_sid)
-        
-        # notify the user of their friends' online statuses
-        for friend in active_user_friends:
-            if friend.username in user_sessions:
-                emit("friend_online", {"username": friend.username}, room=main_sid)
+def heartbeat_online(_username=None):
+    # the page sends its username, but only the logged in user is announced
+    username = session.get("username")
+    if username is None:
+        return
+    # notify all friends that the user is online, one emit to the friends room
+    emit("friend_online", {"username": username}, to=presence.friends_room(username))
+
+    # notify this tab of their friends' online statuses,
+    # friends come from the in-memory presence cache, no database round-trip
+    for friend_username in presence.online_friends(username):
+        emit("friend_online", {"username": friend_username}, to=request.sid)
     
 @socketio.on("offline")
-def heartbeat_offline(username):
-    inactive_user = db.get_user(username)
-    if inactive_user:
-        inactive_user_friends = db.get_friends(inactive_user.username)
-        friends_session_ids = [user_sessions[x.username] for x in inactive_user_friends if x.username in user_sessions]
-
-        # notify all friends that user is offline
-        for friend_sid in friends_session_ids:
-            emit("friend_offline", {"username": username}, room=friend_sid)
+def heartbeat_offline(_username=None):
+    username = session.get("username")
+    if username is None:
+        return
+    # notify all friends that user is offline, unless they still have another tab open
+    if user_sessions.get(username, frozenset()) - {request.sid}:
+        return
+    emit("friend_offline", {"username": username}, to=presence.friends_room(username))
+
+@socketio.on("sync_friend_rooms")
+def sync_friend_rooms():
+    # another server process changed this user's friends and couldn't move this
+    # socket itself, so bring its friends rooms in line with the database
+    username = session.get("username")
+    if username is None:
+        return
+    presence.refresh(username)
+    wanted = {presence.friends_room(friend_username) for friend_username in presence.friends_of(username)}
+    # chat rooms are ints, friends rooms are named like presence.friends_room
+    joined = {room for room in rooms() if isinstance(room, str) and room.startswith(presence.friends_room(""))}
+    for room in wanted - joined:
+        join_room(room)
+    for room in joined - wanted:
+        leave_room(room)
 
 ##############
 # ENCRYPTION #
@@ -138,6 +138,30 @@ async function fetchPublicKey(username){
     }
 }
 
+// function to fetch the public keys of every member of a room in one request, as
+// {username: {public_key, key_version}}. the browser keeps the response and revalidates
+// it with its ETag, so asking again costs a 304 until a member rotates their key
+async function fetchRoomPublicKeys(room_id){
+    try {
+        let response = await axios.get(`/api/rooms/${room_id}/keys`);
+        return response.data.keys;
+    } catch (error) {
+        console.error('Error fetching room public keys:', error);
+        return null;
+    }
+}
+
+// function to upload (or rotate) the logged in user's public key, returns its new key version
+async function uploadPublicKey(publicKeyBase64){
+    try {
+        let response = await axios.put('/api/keys', {public_key: publicKeyBase64});
+        return response.data.key_version;
+    } catch (error) {
+        console.error('Error uploading public key:', error);
+        return null;
+    }
+}
+
 // function to decrypt the encrypted symmetric key
 async function decryptSymmetricKey(encryptedKey) {
     // get the private key
@@ -195,6 +219,16 @@ function base64ToArrayBuffer(base64) {
     return bytes.buffer;
 }
 
+// Helper function to convert bytes to a base64 string. the bytes go through String.fromCharCode
+// a chunk at a time, spreading a large payload into one call's arguments throws a RangeError
+function bytesToBase64(bytes) {
+    let binary = "";
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+}
+
 // function to derive a HMAC key from the symmetric key
 async function deriveHMACKey(symmetricKey, salt) {
     // export key to raw format
@@ -304,7 +338,7 @@ async function encryptMessage(message, symKey) {
     );
 
     // convert arraybuffer to base64
-    const cipherText = btoa(String.fromCharCode(...new Uint8Array(encryptedMessage)));
+    const cipherText = bytesToBase64(new Uint8Array(encryptedMessage));
 
     return { cipherText, iv };
 }
@@ -327,6 +361,36 @@ async function decryptMessage(cipherText, iv, symKey) {
     return decryptedMessage;
 }
 
+// packs {cipherText, iv, hmac} into raw bytes, the binary form the server stores (see payload.py)
+// version (1 byte) | iv length (1) | iv | hmac length (1) | hmac | ciphertext
+function packPayload({ cipherText, iv, hmac }) {
+    const cipherBytes = new Uint8Array(base64ToArrayBuffer(cipherText));
+    const hmacBytes = new Uint8Array(hmac.match(/[\da-f]{2}/gi).map(h => parseInt(h, 16)));
+    const packed = new Uint8Array(3 + iv.length + hmacBytes.length + cipherBytes.length);
+    let offset = 0;
+    packed[offset++] = 1;
+    packed[offset++] = iv.length;
+    packed.set(iv, offset);
+    offset += iv.length;
+    packed[offset++] = hmacBytes.length;
+    packed.set(hmacBytes, offset);
+    offset += hmacBytes.length;
+    packed.set(cipherBytes, offset);
+    return packed;
+}
+
+// the reverse of packPayload, back to {cipherText, iv, hmac} so it can be verified and decrypted as before
+function unpackPayload(buffer) {
+    const packed = new Uint8Array(buffer);
+    const ivEnd = 2 + packed[1];
+    const hmacEnd = ivEnd + 1 + packed[ivEnd];
+    return {
+        cipherText: bytesToBase64(packed.subarray(hmacEnd)),
+        iv: Array.from(packed.subarray(2, ivEnd)),
+        hmac: Array.from(packed.subarray(ivEnd + 1, hmacEnd)).map(b => b.toString(16).padStart(2, '0')).join('')
+    };
+}
+
 // function to sign a message using HMAC
 async function signMessage(data, hmacKey) {
     const encoder = new TextEncoder();
@@ -370,7 +434,9 @@ async function send() {
     const { cipherText, iv } = await encryptMessage(message, symKey);
     const hmac = await signMessage(cipherText + iv, hmacKey);
 
-    socket.emit("safe-send", username, { cipherText, iv: Array.from(iv), hmac }, room_id);  
+    const payload = { cipherText, iv: Array.from(iv), hmac };
+    // binary mode sends the payload as a socket.io binary attachment
+    socket.emit("safe-send", username, binaryMessages ? packPayload(payload) : payload, room_id);
 } 
 
 // listen for the encrypted key. after decrytion, the symmetric key is stored in the IndexedDB
@@ -465,7 +531,7 @@ socket.on("room_ready", async function(data) {
 });
 
 socket.on("safe-incoming", async (username, message) => {
-    const { cipherText, iv, hmac } = message;
+    const { cipherText, iv, hmac } = message instanceof ArrayBuffer ? unpackPayload(message) : message;
     const symKey = await getSymmetricKey(room_id);
     const hmacKey = await getHMACKey(room_id);
 